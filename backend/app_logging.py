@@ -0,0 +1,187 @@
+"""
+構造化ログ
+1レコード1行の JSON を標準出力へ書く。書き込みは QueueHandler → バックグラウンドスレッドで行い、
+リクエストスレッドは I/O を待たない（キューが溢れたら捨てて数える）
+リクエストごとの文脈（トレースID・ユーザーIDのハッシュ・エンドポイント）を自動で付け、
+大量に出る行は sample_rate で間引ける
+"""
+
+import os
+import sys
+import json
+import atexit
+import queue
+import random
+import hashlib
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# --- ログ設定 ---
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# json / text
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_QUEUE_MAX = int(os.environ.get('LOG_QUEUE_MAX', '10000'))
+# 成功したリクエストのアクセスログを出す割合（5xx は常に出す）
+LOG_ACCESS_SAMPLE_RATE = float(os.environ.get('LOG_ACCESS_SAMPLE_RATE', '1.0'))
+# 生成の開始・完了など、リクエストごとに出る行を出す割合
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+
+ROOT_LOGGER = 'hairstyle'
+
+_context = contextvars.ContextVar('hairstyle_log_context', default={})
+
+# LogRecord 標準の属性（これ以外の extra はそのまま JSON のフィールドにする）
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample_rate'}
+
+
+def user_hash(user_id):
+    """ログに残すユーザーID（生の ID は出さない）"""
+    if not user_id:
+        return None
+    return hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:12]
+
+
+def bind(**fields):
+    """以降のログに fields を付ける（戻り値のトークンを unbind に渡して戻す）"""
+    return _context.set({**_context.get(), **fields})
+
+
+def unbind(token):
+    _context.reset(token)
+
+
+def sampled(rate=None, **fields):
+    """logger.info(..., extra=sampled(preset=...)) で LOG_SAMPLE_RATE の割合だけ出す"""
+    return {**fields, 'sample_rate': LOG_SAMPLE_RATE if rate is None else rate}
+
+
+class ContextFilter(logging.Filter):
+    """呼び出し元スレッドで文脈を付け、サンプリングする"""
+
+    def filter(self, record):
+        sample_rate = getattr(record, 'sample_rate', 1.0)
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return False
+
+        record.context = dict(_context.get())
+        # 循環 import を避けるためここで読む
+        from backend import tracing
+
+        record.trace_id = tracing.current_trace_id()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        entry.update(getattr(record, 'context', None) or {})
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and key not in ('context', 'trace_id'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ローカル開発用の読みやすい形式"""
+
+    def format(self, record):
+        fields = {**(getattr(record, 'context', None) or {})}
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and key not in ('context', 'trace_id'):
+                fields[key] = value
+        suffix = ' '.join(f'{key}={value}' for key, value in fields.items())
+        line = f'{record.levelname[0]} {record.name}: {record.getMessage()}'
+        if suffix:
+            line = f'{line} [{suffix}]'
+        if record.exc_info:
+            line = f'{line}\n{self.formatException(record.exc_info)}'
+        return line
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """キューが満杯でも待たない QueueHandler（書き出しスレッドはプロセスごとに起動）"""
+
+    def __init__(self, max_queue=LOG_QUEUE_MAX):
+        super().__init__(queue.Queue(maxsize=max_queue))
+        self._listener = None
+        self._listener_pid = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def _ensure_listener(self):
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._start_lock:
+            if self._listener_pid == pid:
+                return
+            # fork 前のキューに残ったレコードは親プロセスが書くので捨てる
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(logging.Formatter('%(message)s'))
+            self._listener = QueueListener(self.queue, stream)
+            self._listener.start()
+            self._listener_pid = pid
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self._listener is not None and self._listener_pid == os.getpid():
+            self._listener.stop()
+
+
+_handler = None
+_configure_lock = threading.Lock()
+
+
+def configure():
+    """hairstyle.* ロガーにキューハンドラーを設定（何度呼んでも1回だけ）"""
+    global _handler
+
+    if _handler is not None:
+        return _handler
+    with _configure_lock:
+        if _handler is not None:
+            return _handler
+        handler = NonBlockingQueueHandler()
+        handler.addFilter(ContextFilter())
+        handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(handler)
+        root.propagate = False
+        # 終了時にキューに残った行を書き切る
+        atexit.register(handler.stop)
+        _handler = handler
+        return handler
+
+
+def get_logger(name):
+    configure()
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+def stats():
+    handler = _handler
+    if handler is None:
+        return None
+    return {'queued': handler.queue.qsize(), 'dropped': handler.dropped, 'format': LOG_FORMAT}
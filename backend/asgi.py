@@ -0,0 +1,293 @@
+"""
+ASGI エントリポイント（uvicorn backend.asgi:app）
+生成系API は Gemini の非同期クライアントで応答を待ち、待機中にスレッドを占有しない
+入力検証・Supabase 呼び出しなどの短い同期処理は上限付きスレッドプールで実行し、
+それ以外のルート（静的ファイル・/health・Stripe など）は Flask アプリにそのまま渡す
+同期サーバー用の backend.server:app も引き続き使える
+
+Supabase（認証・クレジット予約・プロフィール）は同期サーバーと同じ同期クライアントのまま使う
+1件あたり数十ミリ秒の呼び出しで、同時に動く生成はガバナー（GEMINI_MAX_CONCURRENCY + GEMINI_QUEUE_MAX）で
+上限があるので、スレッドプールをその件数に合わせておけば Supabase 待ちで詰まることはない
+"""
+
+import io
+import os
+import sys
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+
+from backend import app_logging, gemini_pool, server, tracing
+
+# --- ASGI サーバー設定 ---
+# 入力検証・クレジット予約など Flask 側の同期処理を動かすスレッド数（Gemini 待ちには使わない）
+# 0 ならガバナーの同時実行数の上限 + 待ち行列の上限（枠を持って前半・後半を動かせる生成の最大数）
+ASGI_SYNC_WORKERS = int(os.environ.get('ASGI_SYNC_WORKERS', '0'))
+
+# ネイティブに非同期処理する生成系API（POST のみ）
+GENERATION_ROUTES = {
+    '/api/v1/vision/hairstyle/generate/guest': server.begin_generate_hairstyle_guest,
+    '/api/v1/vision/hairstyle/generate': server.begin_generate_hairstyle,
+    '/api/v1/vision/hairstyle/adjust': server.begin_adjust_hairstyle,
+}
+
+flask_app = WsgiToAsgi(server.app)
+
+_executor = None
+_executor_pid = None
+
+
+def sync_worker_count():
+    """同期処理のスレッド数
+
+    枠を持った生成（上限 max_limit）と枠を待つ生成（上限 max_queue）が同時に前半・後半を動かしても
+    Supabase 呼び出しがスレッド待ちにならない数。受け付け前の認証・レート制限はローカルで終わるので数えない
+    """
+    if ASGI_SYNC_WORKERS > 0:
+        return ASGI_SYNC_WORKERS
+    return server.upstream.max_limit + server.upstream.max_queue
+
+
+def get_executor():
+    """プロセスごとのスレッドプール（fork 後は作り直す）"""
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=sync_worker_count(), thread_name_prefix='asgi-sync')
+        _executor_pid = os.getpid()
+    return _executor
+
+
+async def run_sync(fn, *args):
+    # contextvars（現在のトレース）をスレッドに引き継ぐ
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), tracing.wrap_context(fn), *args)
+
+
+def build_environ(scope, body):
+    """ASGI の HTTP scope から WSGI environ を作る"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_in_request_context(environ, fn, *args, permit=None, check_only=False):
+    """Flask のリクエストコンテキスト内で fn を実行し、レスポンスなら after_request まで通す
+
+    check_only は認証・レート制限だけを行う受け付け前の確認（通れば server.ADMISSION_CHECKED）
+    permit は確認のあとに確保した Gemini 実行枠（upstream_admission が受け取る。レート制限は数え済み）
+    """
+    app = server.app
+    with app.request_context(environ):
+        if check_only:
+            server.g.admission_check_only = True
+        if permit is not None:
+            server.g.upstream_permit = permit
+            server.g.rate_limit_counted = True
+        try:
+            outcome = fn(*args)
+        finally:
+            # 認証エラーなどで upstream_admission まで届かなかった枠を返す
+            unused = server.g.pop('upstream_permit', None)
+            if unused is not None:
+                unused.cancel()
+        if isinstance(outcome, server.GenerationPlan) or outcome is server.ADMISSION_CHECKED:
+            return outcome
+        return app.process_response(app.make_response(outcome))
+
+
+async def read_body(receive, limit):
+    """リクエストボディを読む。上限を超えたら None"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('client disconnected')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def send_response(send, response):
+    """Werkzeug の Response を ASGI で送る"""
+    try:
+        headers = [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in response.headers.items()
+        ]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(response.iter_encoded())})
+    finally:
+        response.close()
+
+
+async def handle_generation(begin, scope, receive, send):
+    """生成系API: 前半と後半は同期スレッド、Gemini 呼び出しはイベントループで待つ"""
+    started_at = time.perf_counter()
+    try:
+        body = await read_body(receive, server.app.config['MAX_CONTENT_LENGTH'])
+    except ConnectionError:
+        return
+
+    environ = build_environ(scope, body or b'')
+    environ['hairstyle.started_at'] = started_at
+
+    # after_request（add_trace_headers）はこのスパンを現在のスパンとして参照する
+    span = tracing.start_span(
+        f"POST {scope['path']}", kind='SERVER',
+        attributes={'http.method': 'POST', 'http.route': scope['path'], 'server.mode': 'asgi'},
+        traceparent=environ.get('HTTP_TRACEPARENT'),
+    )
+    token = tracing.activate(span)
+    # run_sync はコンテキストを引き継ぐので、前半・後半のスレッドのログにも付く
+    log_token = app_logging.bind(endpoint=scope['path'], method='POST')
+    try:
+        response = await generation_response(begin, environ, body)
+        span.set_attribute('http.status_code', response.status_code)
+        if response.status_code >= 500:
+            span.status = 'ERROR'
+        await send_response(send, response)
+    except BaseException as e:
+        span.record_error(e)
+        raise
+    finally:
+        app_logging.unbind(log_token)
+        tracing.deactivate(token)
+        span.end()
+
+
+async def generation_response(begin, environ, body):
+    if body is None:
+        return await run_sync(
+            run_in_request_context, environ,
+            lambda: (server.jsonify({'error': server.IMAGE_TOO_LARGE_ERROR}), 413),
+        )
+
+    # 同期サーバーと同じく認証・レート制限を先に通す（未ログイン・制限超過のリクエストに枠を使わせない）
+    checked = await run_sync(functools.partial(run_in_request_context, environ, begin, check_only=True))
+    if checked is not server.ADMISSION_CHECKED:
+        return checked
+
+    # 混雑時は画像デコード・予約の前に断る。枠の空き待ちはスレッドを使わずイベントループで待つ
+    try:
+        permit = await server.upstream.acquire_async()
+    except server.upstream_governor.UpstreamOverloaded as e:
+        return await run_sync(
+            run_in_request_context, environ, server.upstream_overloaded_response, e.retry_after,
+        )
+
+    # キャンセル（切断・シャットダウン）されても前半は最後まで動くので、できた予約と枠をあとで返す
+    environ['wsgi.input'] = io.BytesIO(body)
+    begin_future = asyncio.ensure_future(
+        run_sync(functools.partial(run_in_request_context, environ, begin, permit=permit))
+    )
+    try:
+        outcome = await asyncio.shield(begin_future)
+    except asyncio.CancelledError:
+        begin_future.add_done_callback(abandon_begun_generation)
+        raise
+    if not isinstance(outcome, server.GenerationPlan):
+        return outcome
+
+    outcome.permit.start()
+    try:
+        gemini_response = await gemini_pool.generate_image_content_async(outcome.contents)
+    except Exception as e:
+        finish_args = (outcome, None, e)
+    except BaseException as e:
+        # CancelledError など: finish_generation_plan は動かないので、ここで枠と予約を返す
+        abandon_generation_plan(outcome, e)
+        raise
+    else:
+        finish_args = (outcome, gemini_response)
+    # 後半は新しいコンテキストで動かす（ボディは前半で読み終えている）
+    environ['wsgi.input'] = io.BytesIO(b'')
+    # 生成済みなので、待っている側がキャンセルされても確定・キャッシュ保存は最後まで行う
+    return await asyncio.shield(
+        run_sync(run_in_request_context, environ, server.finish_generation_plan, *finish_args)
+    )
+
+
+def abandon_generation_plan(plan, error=None):
+    """途中でキャンセルされた生成の Gemini 実行枠とクレジット予約を返す"""
+    if plan.permit:
+        if plan.permit.started_at is None:
+            plan.permit.cancel()
+        else:
+            plan.permit.finish(error)
+    if plan.hold:
+        # 予約の解放は Supabase への同期呼び出しなのでイベントループ外で行う
+        try:
+            get_executor().submit(server.credit_reservations.release, plan.hold)
+        except RuntimeError:
+            server.credit_reservations.release(plan.hold)
+
+
+def abandon_begun_generation(future):
+    """キャンセル後に終わった前半の結果が生成計画なら、その予約と枠を返す"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    outcome = future.result()
+    if isinstance(outcome, server.GenerationPlan):
+        abandon_generation_plan(outcome)
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            server.log_startup_config()
+            get_executor()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        begin = GENERATION_ROUTES.get(scope['path'])
+        if begin is not None:
+            await handle_generation(begin, scope, receive, send)
+            return
+
+    await flask_app(scope, receive, send)
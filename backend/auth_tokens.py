@@ -0,0 +1,234 @@
+"""
+Supabase JWT のローカル検証
+ES256/RS256 は JWKS（定期更新キャッシュ）、HS256 は JWT シークレットで検証し、
+検証済みトークンは有効期限まで LRU に保持する
+Supabase への get_user 問い合わせは鍵が見つからない場合のフォールバックのみ
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib.request
+from collections import OrderedDict
+
+import jwt
+
+from backend import app_logging, tracing
+
+logger = app_logging.get_logger('auth_tokens')
+
+# --- JWT 検証設定 ---
+AUTH_JWKS_REFRESH_SECONDS = int(os.environ.get('AUTH_JWKS_REFRESH_SECONDS', '600'))
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', '10000'))
+AUTH_REMOTE_FALLBACK = os.environ.get('AUTH_REMOTE_FALLBACK', 'true').lower() == 'true'
+
+JWT_AUDIENCE = 'authenticated'
+ASYMMETRIC_ALGORITHMS = ('ES256', 'RS256')
+
+
+def jwks_url_for(supabase_url):
+    return f"{supabase_url.rstrip('/')}/auth/v1/.well-known/jwks.json"
+
+
+class JwksCache:
+    """JWKS を取得・保持し、期限が来たらバックグラウンドで更新"""
+
+    FETCH_TIMEOUT = 5
+    # 未知の kid による再取得の最短間隔（鍵ローテーション直後用）
+    MIN_REFETCH_INTERVAL = 30
+
+    def __init__(self, url, refresh_seconds=AUTH_JWKS_REFRESH_SECONDS):
+        self.url = url
+        self.refresh_seconds = refresh_seconds
+        self._keys = {}
+        self._fetched_at = 0
+        self._last_attempt = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        with tracing.span('supabase jwks fetch', kind='CLIENT', **{'http.url': self.url}):
+            with urllib.request.urlopen(self.url, timeout=self.FETCH_TIMEOUT) as response:
+                data = json.loads(response.read())
+        keys = {}
+        for jwk in jwt.PyJWKSet.from_dict(data).keys:
+            keys[jwk.key_id] = jwk
+        return keys
+
+    def refresh(self):
+        """同期的に JWKS を再取得（失敗時は古い鍵を使い続ける）"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._last_attempt = time.time()
+        try:
+            keys = self._fetch()
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.time()
+        except Exception as e:
+            logger.warning('JWKS 取得エラー', extra={'error': str(e)})
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh_in_background(self):
+        threading.Thread(target=self.refresh, name='jwks-refresh', daemon=True).start()
+
+    def get_key(self, kid):
+        now = time.time()
+        with self._lock:
+            key = self._keys.get(kid)
+            stale = now - self._fetched_at > self.refresh_seconds
+            can_refetch = now - self._last_attempt > self.MIN_REFETCH_INTERVAL
+
+        if key:
+            if stale and can_refetch:
+                self._refresh_in_background()
+            return key
+
+        # 初回または未知の kid はその場で取得（取得失敗中・任意の kid でも MIN_REFETCH_INTERVAL に1回だけ。
+        # それ以外は待たずに None を返し、呼び出し側のフォールバックに任せる）
+        if can_refetch:
+            self.refresh()
+            with self._lock:
+                return self._keys.get(kid)
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._keys),
+                'age_seconds': round(time.time() - self._fetched_at, 1) if self._fetched_at else None,
+            }
+
+
+class VerifiedTokenCache:
+    """検証済みトークンの LRU（キーはトークンのハッシュ、期限は exp）"""
+
+    def __init__(self, max_size=AUTH_TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def token_hash(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self.token_hash(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, user_id, expires_at):
+        if not expires_at or expires_at <= time.time():
+            return
+        key = self.token_hash(token)
+        with self._lock:
+            self._entries[key] = (user_id, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class TokenVerifier:
+    """ローカル検証 → （必要なら）Supabase get_user の順で user_id を得る"""
+
+    # 検証結果が確定しなかったことを表す
+    UNDECIDED = object()
+
+    def __init__(self, jwks_url=None, jwt_secret='', remote_clients=(), remote_fallback=AUTH_REMOTE_FALLBACK):
+        self.jwks = JwksCache(jwks_url) if jwks_url else None
+        self.jwt_secret = jwt_secret
+        self.remote_clients = [client for client in remote_clients if client]
+        self.remote_fallback = remote_fallback
+        self.cache = VerifiedTokenCache()
+        self.remote_calls = 0
+
+    def verify_locally(self, token):
+        """(user_id, exp) を返す。無効なら None、判定できなければ UNDECIDED"""
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError:
+            return None
+
+        algorithm = header.get('alg')
+        if algorithm in ASYMMETRIC_ALGORITHMS and self.jwks:
+            jwk = self.jwks.get_key(header.get('kid'))
+            if not jwk:
+                return self.UNDECIDED
+            key = jwk.key
+        elif algorithm == 'HS256' and self.jwt_secret:
+            key = self.jwt_secret
+        else:
+            return self.UNDECIDED
+
+        try:
+            payload = jwt.decode(token, key, algorithms=[algorithm], audience=JWT_AUDIENCE)
+        except jwt.InvalidTokenError:
+            return None
+        return payload.get('sub'), payload.get('exp')
+
+    def verify_remotely(self, token):
+        """Supabase Auth API で検証（exp はトークンから読む）"""
+        for client in self.remote_clients:
+            try:
+                self.remote_calls += 1
+                result = client.auth.get_user(token)
+                if result and result.user:
+                    claims = jwt.decode(token, options={'verify_signature': False})
+                    return result.user.id, claims.get('exp')
+            except Exception:
+                pass
+        return None
+
+    def verify(self, token):
+        """トークンから user_id を返す（無効なら None）"""
+        user_id = self.cache.get(token)
+        if user_id:
+            return user_id
+
+        verified = self.verify_locally(token)
+        if verified is self.UNDECIDED:
+            verified = self.verify_remotely(token) if self.remote_fallback else None
+
+        if not verified or not verified[0]:
+            return None
+
+        user_id, expires_at = verified
+        self.cache.put(token, user_id, expires_at)
+        return user_id
+
+    def is_configured(self):
+        return bool(self.jwks or self.jwt_secret or (self.remote_fallback and self.remote_clients))
+
+    def stats(self):
+        return {
+            'jwks': self.jwks.stats() if self.jwks else None,
+            'token_cache': self.cache.stats(),
+            'remote_fallback': self.remote_fallback,
+            'remote_calls': self.remote_calls,
+        }
@@ -0,0 +1,204 @@
+"""
+クレジット予約（hold / commit / release）
+Gemini を呼ぶ前にクレジットを原子的に確保し、成功したら確定、失敗したら解放する
+予約はユーザーごとの同時実行数に上限があり、期限切れの予約はバックグラウンドで解放する
+"""
+
+import os
+import time
+import threading
+from collections import defaultdict
+
+from backend import app_logging
+
+logger = app_logging.get_logger('credit_holds')
+
+# --- クレジット予約設定 ---
+CREDIT_HOLD_TTL = int(os.environ.get('CREDIT_HOLD_TTL', '180'))
+CREDIT_MAX_INFLIGHT = int(os.environ.get('CREDIT_MAX_INFLIGHT', '3'))
+CREDIT_HOLD_SWEEP_INTERVAL = int(os.environ.get('CREDIT_HOLD_SWEEP_INTERVAL', '60'))
+
+
+class ReservationError(Exception):
+    """予約できなかった（reason: insufficient_credits / too_many_inflight）"""
+
+    def __init__(self, reason, available=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.available = available
+
+
+def is_missing_function_error(error, name):
+    """RPC 先の Postgres 関数が未作成か（supabase_schema.sql 未適用）"""
+    lowered = str(error).lower()
+    return name in lowered and (
+        'could not find the function' in lowered or 'does not exist' in lowered or 'pgrst202' in lowered
+    )
+
+
+class CreditReservations:
+    """Supabase の reserve_credits / commit_credit_hold / release_credit_hold を包む
+
+    client_getter は Supabase 管理クライアント（未設定なら None）を返す関数
+    legacy_consume は関数未作成時に使う従来の消費処理 (user_id, reason) -> 残高 or None
+    on_commit は確定後に呼ばれる (user_id, 残高, 生成回数)（キャッシュの書き通し用）
+    """
+
+    def __init__(self, client_getter, legacy_consume, legacy_credits, on_commit=None,
+                 ttl=CREDIT_HOLD_TTL, max_inflight=CREDIT_MAX_INFLIGHT):
+        self.client_getter = client_getter
+        self.legacy_consume = legacy_consume
+        self.legacy_credits = legacy_credits
+        self.on_commit = on_commit
+        self.ttl = ttl
+        self.max_inflight = max_inflight
+        # DB を使わない場合（未設定・関数未作成）のプロセス内同時実行数
+        self._local_inflight = defaultdict(int)
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+        self.stats_counters = defaultdict(int)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats_counters[name] += 1
+
+    # --- プロセス内の同時実行数（DB 予約が使えない場合） ---
+
+    def _acquire_local(self, user_id, amount):
+        with self._lock:
+            if self._local_inflight[user_id] >= self.max_inflight:
+                raise ReservationError('too_many_inflight')
+            self._local_inflight[user_id] += 1
+        return {'id': None, 'user_id': user_id, 'amount': amount, 'available': None, 'local': True}
+
+    def _release_local(self, hold):
+        with self._lock:
+            # 確定後の解放など、同じ予約を二度数えない
+            if hold.get('released'):
+                return
+            hold['released'] = True
+            self._local_inflight[hold['user_id']] -= 1
+            if self._local_inflight[hold['user_id']] <= 0:
+                del self._local_inflight[hold['user_id']]
+
+    # --- 公開API ---
+
+    def reserve(self, user_id, amount=1, ttl=None):
+        """クレジットを予約して hold を返す（失敗時は ReservationError）
+
+        ttl は予約の有効秒数（省略時は CREDIT_HOLD_TTL。一括生成のように長くかかる場合に延ばす）
+        """
+        client = self.client_getter()
+        if not client:
+            return self._acquire_local(user_id, amount)
+
+        self.start_sweeper()
+        try:
+            result = client.rpc('reserve_credits', {
+                'p_user_id': user_id,
+                'p_amount': amount,
+                'p_ttl_seconds': ttl or self.ttl,
+                'p_max_inflight': self.max_inflight,
+            }).execute()
+        except Exception as e:
+            if not is_missing_function_error(e, 'reserve_credits'):
+                raise
+            logger.warning('reserve_credits 関数が未作成です。supabase_schema.sql を適用してください')
+            # 従来どおり残高チェックのみ行い、消費は commit 時
+            available = self.legacy_credits(user_id)
+            if available != -1 and available < amount:
+                raise ReservationError('insufficient_credits', available)
+            return self._acquire_local(user_id, amount)
+
+        rows = result.data or []
+        row = rows[0] if rows else {}
+        if not row.get('ok'):
+            self._count(row.get('reason') or 'reserve_failed')
+            raise ReservationError(row.get('reason') or 'insufficient_credits', row.get('available'))
+
+        self._count('reserved')
+        return {
+            'id': row['hold_id'],
+            'user_id': user_id,
+            'amount': amount,
+            'available': row.get('available'),
+            'local': False,
+        }
+
+    def _consume_directly(self, hold, used, reason):
+        """予約なしで used 回分を通常どおり消費"""
+        remaining = None
+        for _ in range(hold['amount'] if used is None else used):
+            remaining = self.legacy_consume(hold['user_id'], reason)
+            if remaining is None:
+                break
+        return remaining
+
+    def commit(self, hold, used=None, reason='髪型生成'):
+        """予約を確定して残高を返す（確定できなければ None）"""
+        if hold.get('local'):
+            self._release_local(hold)
+            if not self.client_getter():
+                return 999
+            return self._consume_directly(hold, used, reason)
+
+        rows = self.client_getter().rpc('commit_credit_hold', {
+            'p_hold_id': hold['id'],
+            'p_used': used,
+            'p_reason': reason,
+        }).execute().data or []
+        if rows and rows[0].get('ok'):
+            self._count('committed')
+            remaining = rows[0].get('remaining')
+            if self.on_commit:
+                self.on_commit(hold['user_id'], remaining, hold['amount'] if used is None else used)
+            return remaining
+
+        # 期限切れで解放済みだった場合は、生成済みなので通常の消費を試みる
+        self._count('commit_expired')
+        return self._consume_directly(hold, used, reason)
+
+    def release(self, hold):
+        """予約を解放（例外は握りつぶして期限切れ処理に任せる）"""
+        if hold.get('local'):
+            self._release_local(hold)
+            return
+        try:
+            self.client_getter().rpc('release_credit_hold', {'p_hold_id': hold['id']}).execute()
+            self._count('released')
+        except Exception as e:
+            logger.warning('クレジット予約解放エラー（期限切れで解放されます）', extra={'hold': hold['id'], 'error': str(e)})
+
+    # --- 期限切れ予約の掃除 ---
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(CREDIT_HOLD_SWEEP_INTERVAL)
+            client = self.client_getter()
+            if not client:
+                continue
+            try:
+                result = client.rpc('expire_credit_holds', {}).execute()
+                if result.data:
+                    with self._lock:
+                        self.stats_counters['expired'] += result.data
+            except Exception as e:
+                logger.warning('期限切れ予約の解放エラー', extra={'error': str(e)})
+
+    def start_sweeper(self):
+        """期限切れ予約を定期的に解放するスレッドを開始（プロセスごとに1つ）"""
+        pid = os.getpid()
+        with self._lock:
+            if self._sweeper_pid == pid:
+                return
+            self._sweeper_pid = pid
+        threading.Thread(target=self._sweep_loop, name='credit-hold-sweeper', daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'max_inflight': self.max_inflight,
+                'local_inflight': sum(self._local_inflight.values()),
+                **self.stats_counters,
+            }
@@ -0,0 +1,254 @@
+"""
+Gemini クライアント共有レイヤー
+ワーカープロセスごとに genai.Client を1つだけ作成し、HTTP 接続を keep-alive で使い回す
+"""
+
+import os
+import threading
+
+import httpx
+
+from backend import app_logging, gemini_resilience, metrics, tracing
+
+logger = app_logging.get_logger('gemini_pool')
+
+# --- 接続プール設定 ---
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
+GEMINI_POOL_MAX_CONNECTIONS = int(os.environ.get('GEMINI_POOL_MAX_CONNECTIONS', '20'))
+GEMINI_POOL_MAX_KEEPALIVE = int(os.environ.get('GEMINI_POOL_MAX_KEEPALIVE', '10'))
+GEMINI_POOL_KEEPALIVE_EXPIRY = float(os.environ.get('GEMINI_POOL_KEEPALIVE_EXPIRY', '60'))
+# ASGI サーバー（backend.asgi）の非同期クライアント用。1プロセスで数百件を同時に待てるようにする
+GEMINI_ASYNC_POOL_MAX_CONNECTIONS = int(os.environ.get('GEMINI_ASYNC_POOL_MAX_CONNECTIONS', '200'))
+
+# 髪型合成に使うモデル
+GEMINI_IMAGE_MODEL = os.environ.get('GEMINI_IMAGE_MODEL', 'gemini-2.5-flash-preview-05-20')
+# 空なら Google の API。ベンチマーク（bench/）では偽の Gemini サーバーを指す
+GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL', '')
+
+_client = None
+_client_pid = None
+_transport = None
+_client_lock = threading.Lock()
+# 非同期クライアントで待機中の呼び出し数（イベントループのスレッドからのみ更新）
+_async_in_flight = 0
+
+
+class PooledTransport(httpx.HTTPTransport):
+    """接続プールの使用状況を数える httpx トランスポート"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._stats_lock = threading.Lock()
+        self._known = set()
+        self._dropped = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.opened = 0
+        self.reconnects = 0
+
+    def _connection_ids(self):
+        return {id(conn) for conn in self._pool.connections}
+
+    def handle_request(self, request):
+        with self._stats_lock:
+            current = self._connection_ids()
+            # 前回から消えた接続（切断・期限切れ）を記録しておく
+            self._dropped += len(self._known - current)
+            self._known = current
+            self.in_flight += 1
+            self.requests += 1
+
+        try:
+            return super().handle_request(request)
+        finally:
+            with self._stats_lock:
+                self.in_flight -= 1
+                after = self._connection_ids()
+                for _ in after - self._known:
+                    self.opened += 1
+                    # 切断済みの接続を張り直した場合は再接続として数える
+                    if self._dropped > 0:
+                        self.reconnects += 1
+                        self._dropped -= 1
+                self._known = after
+
+    def stats(self):
+        """プールの統計を返す"""
+        with self._stats_lock:
+            connections = list(self._pool.connections)
+            idle = sum(1 for conn in connections if conn.is_idle())
+            return {
+                'in_use': self.in_flight,
+                'idle': idle,
+                'connections': len(connections),
+                'opened': self.opened,
+                'reconnects': self.reconnects,
+                'requests': self.requests,
+                'max_connections': GEMINI_POOL_MAX_CONNECTIONS,
+                'max_keepalive': GEMINI_POOL_MAX_KEEPALIVE,
+            }
+
+
+def _pool_limits():
+    return httpx.Limits(
+        max_connections=GEMINI_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=GEMINI_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=GEMINI_POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+def _async_pool_limits():
+    return httpx.Limits(
+        max_connections=GEMINI_ASYNC_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=GEMINI_ASYNC_POOL_MAX_CONNECTIONS,
+        keepalive_expiry=GEMINI_POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_options(**kwargs):
+    from google.genai import types
+
+    if GEMINI_BASE_URL:
+        kwargs['base_url'] = GEMINI_BASE_URL
+    return types.HttpOptions(**kwargs)
+
+
+def _create_client():
+    """keep-alive 付きの genai.Client を作成（client.aio も同じ設定でプールする）"""
+    from google import genai
+
+    transport = PooledTransport(limits=_pool_limits())
+    try:
+        http_options = _http_options(
+            client_args={'transport': transport},
+            async_client_args={'transport': httpx.AsyncHTTPTransport(limits=_async_pool_limits())},
+        )
+        return genai.Client(api_key=GEMINI_API_KEY, http_options=http_options), transport
+    except Exception as e:
+        logger.warning('Gemini 非同期接続プール設定をスキップ', extra={'error': str(e)})
+
+    try:
+        http_options = _http_options(client_args={'transport': transport})
+        return genai.Client(api_key=GEMINI_API_KEY, http_options=http_options), transport
+    except Exception as e:
+        # client_args 非対応の古い SDK ではプールなしで動かす
+        logger.warning('Gemini 接続プール設定をスキップ', extra={'error': str(e)})
+        transport.close()
+        return genai.Client(api_key=GEMINI_API_KEY, http_options=_http_options()), None
+
+
+def get_client():
+    """プロセス共有の genai.Client を取得（fork 後は作り直す）"""
+    global _client, _client_pid, _transport
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            _client, _transport = _create_client()
+            _client_pid = pid
+        return _client
+
+
+def reset_client():
+    """共有クライアントを破棄（次回 get_client で再作成）"""
+    global _client, _client_pid, _transport
+
+    with _client_lock:
+        # fork 前の親プロセスの接続はソケットを共有しているので閉じずに捨てる
+        if _transport is not None and _client_pid == os.getpid():
+            _transport.close()
+        _client = None
+        _client_pid = None
+        _transport = None
+
+
+def pool_stats():
+    """接続プールの統計（未作成時は None）"""
+    transport = _transport
+    if transport is None or _client_pid != os.getpid():
+        return None
+    return {**transport.stats(), 'async_in_flight': _async_in_flight}
+
+
+def image_part(data, mime_type='image/jpeg'):
+    """エンコード済み画像をそのまま送る Part（SDK 側の再エンコードを避ける）"""
+    from google.genai import types
+
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+# 再試行・ヘッジ・期限（同期・非同期の呼び出しで共有）
+resilient_caller = gemini_resilience.ResilientCaller()
+
+
+def image_config(timeout=None):
+    """画像+テキスト出力の設定（timeout 秒で HTTP リクエストを打ち切る）"""
+    from google.genai.types import GenerateContentConfig, HttpOptions, Modality
+
+    return GenerateContentConfig(
+        response_modalities=[Modality.TEXT, Modality.IMAGE],
+        http_options=HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
+    )
+
+
+def _span_attributes(model, timeout):
+    return {'gen_ai.system': 'gemini', 'gen_ai.request.model': model, 'timeout_seconds': round(timeout, 1)}
+
+
+def generate_image_content(contents, model=None):
+    """画像+テキスト出力で generate_content を呼ぶ（再試行・ヘッジ付き）"""
+    model = model or GEMINI_IMAGE_MODEL
+
+    def attempt(timeout):
+        with tracing.span('gemini generate_content', kind='CLIENT', **_span_attributes(model, timeout)):
+            return get_client().models.generate_content(
+                model=model,
+                contents=contents,
+                config=image_config(timeout),
+            )
+
+    with metrics.stage_timer('gemini'):
+        return resilient_caller.call(attempt)
+
+
+async def generate_image_content_async(contents, model=None):
+    """generate_image_content の非同期版（スレッドを占有せずに応答を待つ）"""
+    global _async_in_flight
+    model = model or GEMINI_IMAGE_MODEL
+
+    async def attempt(timeout):
+        with tracing.span('gemini generate_content', kind='CLIENT', **_span_attributes(model, timeout)):
+            return await get_client().aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=image_config(timeout),
+            )
+
+    _async_in_flight += 1
+    try:
+        with metrics.stage_timer('gemini'):
+            return await resilient_caller.call_async(attempt)
+    finally:
+        _async_in_flight -= 1
+
+
+def resilience_stats():
+    """再試行・ヘッジの回数"""
+    return resilient_caller.stats()
+
+
+def extract_image_and_text(response):
+    """レスポンスから (画像バイト列, テキスト) を取り出す"""
+    image_data = None
+    response_text = ""
+
+    for part in response.candidates[0].content.parts:
+        if hasattr(part, 'text') and part.text:
+            response_text = part.text
+        elif hasattr(part, 'inline_data') and part.inline_data:
+            image_data = part.inline_data.data
+
+    return image_data, response_text
@@ -0,0 +1,236 @@
+"""
+Gemini 呼び出しの再試行・ヘッジ・期限
+- 1回ごとの期限（attempt timeout）と呼び出し全体の期限（deadline）
+- 再試行できるエラー（429/5xx/タイムアウト/接続断）は指数バックオフ + ジッターで再試行
+- ヘッジ: 1回目が p95 程度の時間を過ぎても返らなければ2本目を送り、先に成功した方を使う
+  ヘッジは asyncio の呼び出し（call_async）だけで行い、負けた方のタスクはキャンセルする
+  同期の呼び出し（call）はヘッジしない。スレッドで走らせた2本目や期限切れの試行は止められず、
+  課金される重複呼び出しがガバナーの枠の外で Gemini に残り続けるため
+  同期の試行は呼び出し元のスレッドで実行し、1回の期限は fn に渡す HTTP タイムアウトで守る
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+
+from backend import app_logging
+
+logger = app_logging.get_logger('gemini_resilience')
+
+# --- 再試行・ヘッジ設定 ---
+GEMINI_RETRY_MAX_ATTEMPTS = int(os.environ.get('GEMINI_RETRY_MAX_ATTEMPTS', '3'))
+GEMINI_RETRY_BASE_DELAY = float(os.environ.get('GEMINI_RETRY_BASE_DELAY', '1'))
+GEMINI_RETRY_MAX_DELAY = float(os.environ.get('GEMINI_RETRY_MAX_DELAY', '8'))
+GEMINI_ATTEMPT_TIMEOUT = float(os.environ.get('GEMINI_ATTEMPT_TIMEOUT', '60'))
+# gunicorn の timeout（GUNICORN_TIMEOUT、120秒）より短くしてワーカーが強制終了されないようにする
+GEMINI_CALL_DEADLINE = float(os.environ.get('GEMINI_CALL_DEADLINE', '100'))
+GEMINI_HEDGE_ENABLED = os.environ.get('GEMINI_HEDGE_ENABLED', 'false').lower() == 'true'
+# 0 なら直近の成功レイテンシの p95 を使う
+GEMINI_HEDGE_DELAY = float(os.environ.get('GEMINI_HEDGE_DELAY', '0'))
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_STATUS_NAMES = ('RESOURCE_EXHAUSTED', 'UNAVAILABLE', 'DEADLINE_EXCEEDED', 'INTERNAL')
+
+
+class GeminiDeadlineExceeded(TimeoutError):
+    """1回の試行、または呼び出し全体の期限を過ぎた"""
+
+
+def is_retryable_error(error):
+    """再試行で回復する見込みのあるエラーか（入力不正・認証エラーは再試行しない）"""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    try:
+        import httpx
+
+        if isinstance(error, (httpx.TimeoutException, httpx.TransportError)):
+            return True
+    except ImportError:
+        pass
+
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if code in RETRYABLE_STATUS_CODES:
+        return True
+    message = str(error)
+    return any(name in message for name in RETRYABLE_STATUS_NAMES)
+
+
+def is_timeout_error(error):
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    try:
+        import httpx
+
+        return isinstance(error, httpx.TimeoutException)
+    except ImportError:
+        return False
+
+
+class ResilientCaller:
+    """fn(timeout) を期限・再試行・ヘッジ付きで呼ぶ
+
+    fn は1回の試行に使える秒数を受け取り、その時間内に終わるように HTTP タイムアウトを設定する
+    """
+
+    LATENCY_SAMPLES = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, max_attempts=GEMINI_RETRY_MAX_ATTEMPTS, base_delay=GEMINI_RETRY_BASE_DELAY,
+                 max_delay=GEMINI_RETRY_MAX_DELAY, attempt_timeout=GEMINI_ATTEMPT_TIMEOUT,
+                 deadline=GEMINI_CALL_DEADLINE, hedge=GEMINI_HEDGE_ENABLED, hedge_delay=GEMINI_HEDGE_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+        self.counters = {
+            'calls': 0, 'attempts': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0,
+            'timeouts': 0, 'failures': 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def current_hedge_delay(self):
+        """ヘッジを送るまでの秒数（無効・サンプル不足なら None）"""
+        if not self.hedge:
+            return None
+        if self.hedge_delay > 0:
+            return self.hedge_delay
+        with self._lock:
+            if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def backoff_delay(self, retry_index):
+        """full jitter: 0 〜 min(上限, 基準 * 2^n) の一様乱数"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry_index)))
+
+    def _next_retry_delay(self, error, attempt, deadline_at):
+        """再試行するなら待ち秒数、しないなら None"""
+        if not is_retryable_error(error) or attempt + 1 >= self.max_attempts:
+            return None
+        delay = self.backoff_delay(attempt)
+        if time.monotonic() + delay >= deadline_at:
+            return None
+        return delay
+
+    # --- 同期 ---
+
+    def _timed(self, fn, timeout):
+        started = time.monotonic()
+        self._count('attempts')
+        result = fn(timeout)
+        self._record_latency(time.monotonic() - started)
+        return result
+
+    def call(self, fn):
+        """fn(timeout) を同期で呼ぶ（再試行と期限のみ。ヘッジは call_async だけ）"""
+        self._count('calls')
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self._count('failures')
+                raise GeminiDeadlineExceeded(f'call exceeded {self.deadline:.1f}s')
+            try:
+                # 同期ではヘッジしない（モジュールの説明を参照）
+                return self._timed(fn, min(self.attempt_timeout, remaining))
+            except Exception as e:
+                if is_timeout_error(e):
+                    self._count('timeouts')
+                delay = self._next_retry_delay(e, attempt, deadline_at)
+                if delay is None:
+                    self._count('failures')
+                    raise
+                logger.warning('Gemini 呼び出し再試行', extra={'retry': attempt + 1, 'delay': round(delay, 2), 'error': str(e)})
+                self._count('retries')
+                time.sleep(delay)
+                attempt += 1
+
+    # --- asyncio ---
+
+    async def _timed_async(self, fn, timeout):
+        started = time.monotonic()
+        self._count('attempts')
+        try:
+            result = await asyncio.wait_for(fn(timeout), timeout)
+        except asyncio.TimeoutError:
+            raise GeminiDeadlineExceeded(f'attempt exceeded {timeout:.1f}s') from None
+        self._record_latency(time.monotonic() - started)
+        return result
+
+    async def _attempt_async(self, fn, timeout):
+        hedge_delay = self.current_hedge_delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await self._timed_async(fn, timeout)
+
+        primary = asyncio.ensure_future(self._timed_async(fn, timeout))
+        done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        self._count('hedges')
+        hedged = asyncio.ensure_future(self._timed_async(fn, timeout - hedge_delay))
+        pending = {primary, hedged}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            self._count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error
+
+    async def call_async(self, fn):
+        """fn(timeout) が返すコルーチンを待つ（call の asyncio 版）"""
+        self._count('calls')
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self._count('failures')
+                raise GeminiDeadlineExceeded(f'call exceeded {self.deadline:.1f}s')
+            try:
+                return await self._attempt_async(fn, min(self.attempt_timeout, remaining))
+            except Exception as e:
+                if is_timeout_error(e):
+                    self._count('timeouts')
+                delay = self._next_retry_delay(e, attempt, deadline_at)
+                if delay is None:
+                    self._count('failures')
+                    raise
+                logger.warning('Gemini 呼び出し再試行', extra={'retry': attempt + 1, 'delay': round(delay, 2), 'error': str(e)})
+                self._count('retries')
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stats(self):
+        hedge_delay = self.current_hedge_delay()
+        with self._lock:
+            return {
+                **self.counters,
+                'hedge_enabled': self.hedge,
+                'hedge_delay': round(hedge_delay, 3) if hedge_delay is not None else None,
+            }
@@ -2,89 +2,97 @@
 """
 プリセット髪型サンプル画像を生成するスクリプト
 Gemini 2.5 Flash Image を使用して統一感のあるサンプル画像を生成
+- 複数プリセットを並列に生成（--workers / --rate で同時数と呼び出し間隔を制限）
+- プロンプトのハッシュを manifest.json に記録し、変わっていないプリセットは生成しない（中断後の再実行も続きから）
+- --only / --force で対象を選ぶ、--dry-run は Gemini の代わりにローカルの偽モデルで一通り動かす
+- 生成後に表示用サムネイル（1x / 2x / 3x の AVIF / WebP / PNG）を作る（backend/preset_thumbnails.py）
+
+python backend/generate_presets.py                    # プロンプトが変わったものだけ生成
+python backend/generate_presets.py --only mens/wolf   # 1件だけ
+python backend/generate_presets.py --force --workers 2
+python backend/generate_presets.py --dry-run          # GCP の設定なしで動作確認
 """
 
 import os
+import io
 import sys
 import json
+import time
+import argparse
+import hashlib
 import tempfile
-import base64
+import threading
 from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# 環境変数の設定
-GCP_CREDENTIALS_JSON = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-GCP_PROJECT_ID = os.environ.get('GCP_PROJECT_ID')
+from backend import preset_registry, preset_thumbnails
+from backend.gemini_resilience import ResilientCaller
 
-if GCP_CREDENTIALS_JSON:
-    try:
-        creds_dict = json.loads(GCP_CREDENTIALS_JSON)
-        if not GCP_PROJECT_ID:
-            GCP_PROJECT_ID = creds_dict.get('project_id')
+# --- 生成設定 ---
+PRESET_IMAGE_MODEL = os.environ.get('PRESET_IMAGE_MODEL', 'gemini-2.5-flash-image')
+PRESET_WORKERS = int(os.environ.get('PRESET_WORKERS', '4'))
+# 1分あたりの Gemini 呼び出し数の上限（Vertex AI のクォータに合わせる）
+PRESET_RATE_PER_MINUTE = float(os.environ.get('PRESET_RATE_PER_MINUTE', '20'))
 
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            f.write(GCP_CREDENTIALS_JSON)
-            credentials_path = f.name
+# 「なし」のプレースホルダーの描画を変えたら上げる（manifest のハッシュが変わり作り直される）
+PLACEHOLDER_VERSION = 'placeholder-v2'
+MANIFEST_VERSION = 1
 
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
-        print(f"認証設定完了: {credentials_path}")
-    except Exception as e:
-        print(f"認証設定エラー: {e}")
-        sys.exit(1)
+# 再試行・期限（サーバーと同じ GEMINI_RETRY_* / GEMINI_ATTEMPT_TIMEOUT 設定を使う）
+gemini_caller = ResilientCaller()
 
-if not GCP_PROJECT_ID:
-    print("エラー: GCP_PROJECT_ID が設定されていません")
-    print("export GCP_PROJECT_ID='your-project-id'")
-    sys.exit(1)
-
-os.environ['GOOGLE_CLOUD_PROJECT'] = GCP_PROJECT_ID
-os.environ['GOOGLE_CLOUD_LOCATION'] = 'global'
-os.environ['GOOGLE_GENAI_USE_VERTEXAI'] = 'True'
-
-from google import genai
-from google.genai.types import GenerateContentConfig, Modality
-
-# プリセット定義
-PRESETS = {
-    'mens': [
-        {'id': 'none', 'name': 'なし', 'prompt': None},
-        {'id': 'short', 'name': 'ショート', 'prompt': '清潔感のある短髪、サイドすっきり、トップに軽い動き'},
-        {'id': 'twoblock', 'name': 'ツーブロック', 'prompt': 'サイドを刈り上げたツーブロック、トップは長めで流す'},
-        {'id': 'mash', 'name': 'マッシュ', 'prompt': '丸みのあるマッシュヘア、前髪重め、柔らかい印象'},
-        {'id': 'center', 'name': 'センターパート', 'prompt': 'センター分け、顔周りをフレーミング、韓国風'},
-        {'id': 'wolf', 'name': 'ウルフ', 'prompt': 'ウルフカット、襟足長め、レイヤー多め、動きのあるスタイル'},
-        {'id': 'perm', 'name': 'パーマ', 'prompt': 'ゆるめのパーマ、ナチュラルなウェーブ、こなれ感'},
-        {'id': 'long', 'name': 'ロング', 'prompt': '肩につく長さ、ナチュラルなストレート、清潔感'},
-    ],
-    'ladies': [
-        {'id': 'none', 'name': 'なし', 'prompt': None},
-        {'id': 'short', 'name': 'ショート', 'prompt': '耳が出るショートヘア、すっきりシルエット、女性らしい'},
-        {'id': 'bob', 'name': 'ボブ', 'prompt': 'あご下ラインのボブ、内巻き、清楚な印象'},
-        {'id': 'lob', 'name': 'ロブ', 'prompt': '肩につくロングボブ、外ハネ、こなれ感'},
-        {'id': 'medium', 'name': 'ミディアム', 'prompt': '鎖骨ラインのミディアム、レイヤー入り、ナチュラル'},
-        {'id': 'layer', 'name': 'レイヤー', 'prompt': 'たっぷりレイヤーの動きのあるスタイル、顔周りに軽さ'},
-        {'id': 'long', 'name': 'ロング', 'prompt': '胸下までのロングヘア、つやつやストレート、清楚'},
-        {'id': 'wave', 'name': 'ウェーブ', 'prompt': 'ゆるふわウェーブ、巻き髪、華やかな印象'},
-    ]
-}
+# プリセット定義（サーバーと共有する backend/presets.json）
+preset_catalog = preset_registry.load()
+PRESETS = {gender: preset_catalog.presets_for(gender) for gender in preset_catalog.genders}
 
 # 出力ディレクトリ
 BASE_DIR = Path(__file__).parent.parent
 OUTPUT_DIR = BASE_DIR / 'frontend' / 'images' / 'presets'
+MANIFEST_NAME = 'manifest.json'
+
+
+def configure_vertex():
+    """Vertex AI の認証設定（--dry-run では呼ばない）。プロジェクトIDを返す"""
+    credentials_json = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
+    project_id = os.environ.get('GCP_PROJECT_ID')
+
+    if credentials_json:
+        try:
+            creds_dict = json.loads(credentials_json)
+            if not project_id:
+                project_id = creds_dict.get('project_id')
+
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
+                f.write(credentials_json)
+                credentials_path = f.name
+
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
+            print(f"認証設定完了: {credentials_path}")
+        except Exception as e:
+            print(f"認証設定エラー: {e}")
+            sys.exit(1)
+
+    if not project_id:
+        print("エラー: GCP_PROJECT_ID が設定されていません")
+        print("export GCP_PROJECT_ID='your-project-id'")
+        print("（GCP なしで動作確認する場合は --dry-run）")
+        sys.exit(1)
 
-def generate_preset_image(gender: str, preset: dict) -> bytes:
-    """プリセット画像を生成"""
+    os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
+    os.environ['GOOGLE_CLOUD_LOCATION'] = 'global'
+    os.environ['GOOGLE_GENAI_USE_VERTEXAI'] = 'True'
+    return project_id
 
-    if preset['prompt'] is None:
-        # 「なし」の場合はプレースホルダー画像を返す
-        return None
 
-    gender_ja = 'メンズ' if gender == 'mens' else 'レディース'
-    gender_en = 'man' if gender == 'mens' else 'woman'
+def build_prompt(gender: str, preset: dict) -> str:
+    """プリセット画像の生成プロンプト"""
+    gender_en = preset_catalog.genders[gender]['subject']
 
-    prompt = f"""Generate a hairstyle sample image for a mobile app preset button.
+    return f"""Generate a hairstyle sample image for a mobile app preset button.
 
 Requirements:
 - Show ONLY the hairstyle on a simple mannequin head silhouette
@@ -100,86 +108,288 @@ Requirements:
 
 Style reference: Beauty app preset thumbnails like BeautyPlus or SNOW app"""
 
-    client = genai.Client()
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash-image",
-        contents=[prompt],
-        config=GenerateContentConfig(
-            response_modalities=[Modality.TEXT, Modality.IMAGE]
-        ),
-    )
+def prompt_hash(gender: str, preset: dict, model: str) -> str:
+    """出力を決める入力（プロンプト・モデル）のハッシュ"""
+    source = PLACEHOLDER_VERSION if preset['prompt'] is None else f"{model}\n{build_prompt(gender, preset)}"
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
 
-    for part in response.candidates[0].content.parts:
-        if hasattr(part, 'inline_data') and part.inline_data:
-            return part.inline_data.data
+# --- モデル ---
+
+class GeminiModel:
+    """Vertex AI の Gemini（クライアントは1つを全スレッドで共有する）"""
+
+    def __init__(self, model=PRESET_IMAGE_MODEL):
+        from google import genai
+
+        self.model = model
+        self.client = genai.Client()
+
+    def generate(self, prompt: str) -> bytes:
+        from google.genai.types import GenerateContentConfig, HttpOptions, Modality
+
+        response = gemini_caller.call(lambda timeout: self.client.models.generate_content(
+            model=self.model,
+            contents=[prompt],
+            config=GenerateContentConfig(
+                response_modalities=[Modality.TEXT, Modality.IMAGE],
+                http_options=HttpOptions(timeout=int(timeout * 1000)),
+            ),
+        ))
+
+        for part in response.candidates[0].content.parts:
+            if hasattr(part, 'inline_data') and part.inline_data:
+                return part.inline_data.data
+
+        return None
+
+
+class FakeModel:
+    """--dry-run 用の偽モデル（少し待ってプロンプトから決まる色の画像を返す）"""
+
+    def __init__(self, model=PRESET_IMAGE_MODEL, latency=0.5):
+        self.model = model
+        self.latency = latency
+
+    def generate(self, prompt: str) -> bytes:
+        from PIL import Image
+
+        time.sleep(self.latency)
+        digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+        buffer = io.BytesIO()
+        Image.new('RGB', (256, 256), color=tuple(digest[:3])).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+
+class CallPacer:
+    """呼び出し間隔を 60 / rate_per_minute 秒以上あける（スレッド間で共有）"""
+
+    def __init__(self, rate_per_minute):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        time.sleep(max(0.0, start_at - now))
 
-    return None
 
 def create_none_placeholder(gender: str) -> bytes:
     """「なし」用のプレースホルダー画像を作成"""
-    from PIL import Image, ImageDraw, ImageFont
-    import io
+    from PIL import Image, ImageDraw
 
-    # 72x72のグレー画像を作成
-    img = Image.new('RGB', (144, 144), color='#F5F5F5')
+    # 表示サイズ（72x72）の 3x で描き、1x / 2x はサムネイル作成で縮小する
+    size = preset_thumbnails.THUMBNAIL_SIZE * max(preset_thumbnails.THUMBNAIL_SCALES)
+    scale = size / 144
+    img = Image.new('RGB', (size, size), color='#F5F5F5')
     draw = ImageDraw.Draw(img)
 
     # 円を描画
-    draw.ellipse([22, 22, 122, 122], outline='#CCCCCC', width=2)
+    draw.ellipse([22 * scale, 22 * scale, 122 * scale, 122 * scale], outline='#CCCCCC', width=round(2 * scale))
 
     # 斜線を描画（禁止マーク風）
-    draw.line([40, 40, 104, 104], fill='#CCCCCC', width=2)
+    draw.line([40 * scale, 40 * scale, 104 * scale, 104 * scale], fill='#CCCCCC', width=round(2 * scale))
 
     # バイトに変換
     buffer = io.BytesIO()
     img.save(buffer, format='PNG')
     return buffer.getvalue()
 
-def main():
-    print("=" * 50)
-    print("プリセット髪型画像生成スクリプト")
-    print("=" * 50)
-    print(f"Project: {GCP_PROJECT_ID}")
-    print(f"出力先: {OUTPUT_DIR}")
-    print()
 
-    # 出力ディレクトリ作成
-    (OUTPUT_DIR / 'mens').mkdir(parents=True, exist_ok=True)
-    (OUTPUT_DIR / 'ladies').mkdir(parents=True, exist_ok=True)
+# --- manifest ---
 
-    total = sum(len(presets) for presets in PRESETS.values())
-    current = 0
+class Manifest:
+    """manifest.json（"<gender>/<id>" → ハッシュ・ファイル・生成日時）。1件ごとに保存して中断に備える"""
+
+    def __init__(self, directory: Path):
+        self.path = directory / MANIFEST_NAME
+        self.entries = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('presets', {})
+        except (OSError, ValueError):
+            pass
+
+    def is_current(self, key: str, digest: str, directory: Path) -> bool:
+        entry = self.entries.get(key)
+        return bool(entry and entry.get('hash') == digest and (directory / entry['file']).exists())
+
+    def record(self, key: str, **entry):
+        with self._lock:
+            self.entries[key] = entry
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix='.manifest-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'presets': self.entries}, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
-    for gender, presets in PRESETS.items():
-        print(f"\n--- {gender.upper()} ---")
 
+def write_atomic(path: Path, data: bytes):
+    """途中で止まっても壊れたファイルが残らないように書く"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.stem}-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# --- 生成 ---
+
+def select_presets(only):
+    """--only の指定（mens / mens/wolf / wolf、カンマ区切り）に合う (gender, preset) の一覧"""
+    selectors = [value.strip() for value in (only or '').split(',') if value.strip()]
+    selected = []
+    for gender, presets in PRESETS.items():
         for preset in presets:
-            current += 1
-            print(f"[{current}/{total}] {preset['name']}...", end=' ', flush=True)
+            key = f"{gender}/{preset['id']}"
+            if not selectors or any(selector in (gender, preset['id'], key) for selector in selectors):
+                selected.append((gender, preset))
 
-            output_path = OUTPUT_DIR / gender / f"{preset['id']}.png"
+    unknown = [
+        selector for selector in selectors
+        if not any(selector in (gender, preset['id'], f"{gender}/{preset['id']}") for gender, preset in selected)
+    ]
+    return selected, unknown
 
-            try:
-                if preset['prompt'] is None:
-                    # 「なし」の場合
-                    image_data = create_none_placeholder(gender)
-                else:
-                    image_data = generate_preset_image(gender, preset)
-
-                if image_data:
-                    with open(output_path, 'wb') as f:
-                        f.write(image_data)
-                    print("✓")
-                else:
-                    print("✗ (画像生成失敗)")
 
+def generate_one(gender, preset, model, pacer, output_dir, manifest, digest):
+    """1件生成して保存し、manifest に記録する。(成否, 秒数, メッセージ)"""
+    key = f"{gender}/{preset['id']}"
+    started = time.monotonic()
+
+    if preset['prompt'] is None:
+        # 「なし」の場合
+        image_data = create_none_placeholder(gender)
+    else:
+        pacer.wait()
+        image_data = model.generate(build_prompt(gender, preset))
+
+    if not image_data:
+        return False, time.monotonic() - started, '画像生成失敗'
+
+    relative_path = f"{key}.png"
+    write_atomic(output_dir / relative_path, image_data)
+    manifest.record(
+        key,
+        hash=digest,
+        file=relative_path,
+        model=None if preset['prompt'] is None else model.model,
+        bytes=len(image_data),
+        generated_at=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    )
+    return True, time.monotonic() - started, None
+
+
+def run_tasks(tasks, model, pacer, output_dir, manifest, workers):
+    """tasks を並列に生成して失敗数を返す"""
+    failures = 0
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='preset') as executor:
+        futures = {
+            executor.submit(generate_one, gender, preset, model, pacer, output_dir, manifest, digest):
+                (gender, preset)
+            for gender, preset, digest in tasks
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            gender, preset = futures[future]
+            label = f"[{done}/{len(tasks)}] {gender}/{preset['id']} {preset['name']}"
+            try:
+                ok, elapsed, message = future.result()
             except Exception as e:
-                print(f"✗ ({e})")
+                ok, elapsed, message = False, 0.0, str(e)
+            if ok:
+                print(f"{label} ✓ ({elapsed:.1f}s)", flush=True)
+            else:
+                failures += 1
+                print(f"{label} ✗ ({message})", flush=True)
 
     print("\n" + "=" * 50)
-    print("完了！")
-    print(f"生成された画像: {OUTPUT_DIR}")
+    print(f"完了！ {len(tasks) - failures} 件成功 / {failures} 件失敗（{time.monotonic() - started:.1f}s）")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='プリセット髪型画像の生成')
+    parser.add_argument('--only', help='対象（mens / mens/wolf / wolf、カンマ区切り）')
+    parser.add_argument('--force', action='store_true', help='プロンプトが変わっていなくても生成し直す')
+    parser.add_argument('--workers', type=int, default=PRESET_WORKERS, help='同時に生成する数')
+    parser.add_argument('--rate', type=float, default=PRESET_RATE_PER_MINUTE, help='1分あたりの呼び出し数の上限（0 で無制限）')
+    parser.add_argument('--model', default=PRESET_IMAGE_MODEL)
+    parser.add_argument('--output', type=Path, help=f'出力先（省略時は {OUTPUT_DIR}、--dry-run では一時ディレクトリ）')
+    parser.add_argument('--dry-run', action='store_true', help='Gemini を呼ばずに偽モデルで動かす')
+    parser.add_argument('--skip-thumbnails', action='store_true', help='サムネイル（backend/preset_thumbnails.py）を作らない')
+    args = parser.parse_args()
+
+    selected, unknown = select_presets(args.only)
+    if unknown:
+        print(f"エラー: 不明なプリセット: {', '.join(unknown)}")
+        sys.exit(2)
+
+    # 生成済みかどうかは本来の出力先の manifest で判定する（--dry-run でも同じ対象を選ぶ）
+    catalog_dir = args.output or OUTPUT_DIR
+    manifest = Manifest(catalog_dir)
+    if args.dry_run:
+        output_dir = args.output or Path(tempfile.mkdtemp(prefix='presets-dry-run-'))
+        dry_manifest = Manifest(output_dir)
+        dry_manifest.entries = dict(manifest.entries)
+        manifest = dry_manifest
+    else:
+        output_dir = catalog_dir
+
+    print("=" * 50)
+    print("プリセット髪型画像生成スクリプト")
+    print("=" * 50)
+    if args.dry_run:
+        print("モード: dry-run（偽モデル）")
+    else:
+        print(f"Project: {configure_vertex()}")
+    print(f"モデル: {args.model}")
+    print(f"出力先: {output_dir}")
+
+    tasks = []
+    skipped = []
+    for gender, preset in selected:
+        key = f"{gender}/{preset['id']}"
+        digest = prompt_hash(gender, preset, args.model)
+        if not args.force and manifest.is_current(key, digest, catalog_dir):
+            skipped.append(key)
+        else:
+            tasks.append((gender, preset, digest))
+
+    print(f"生成: {len(tasks)} 件 / スキップ（プロンプト変更なし）: {len(skipped)} 件")
+    print()
+
+    failures = 0
+    if tasks:
+        model = FakeModel(args.model) if args.dry_run else GeminiModel(args.model)
+        failures = run_tasks(tasks, model, CallPacer(args.rate), output_dir, manifest, args.workers)
+        if not args.dry_run:
+            print(f"Gemini 呼び出し: {gemini_caller.stats()}")
+        print(f"生成された画像: {output_dir}")
+    else:
+        print("生成するプリセットはありません（--force で作り直し）")
+
+    if not args.skip_thumbnails:
+        # 元画像が変わったものだけ作り直すので、生成がなければ既存のサムネイルはそのまま
+        built, thumbnails_skipped = preset_thumbnails.build_all(output_dir)
+        print(f"サムネイル: {built} 件作成 / {thumbnails_skipped} 件スキップ")
+
+    if failures:
+        # 失敗したものは manifest に載らないので、再実行すればそこから続けられる
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,149 @@
+"""
+gunicorn 設定（gunicorn -c python:backend.gunicorn_conf）
+ワーカー数・ワーカークラス・スレッド数・タイムアウトを CPU 数と環境変数から決める
+preload ではマスターで重い import（PIL / stripe / supabase / genai）を1回だけ行い、
+ワーカーはコピーオンライトで共有する。接続は post_fork で作り直す
+ワーカーが複数のときは、ジョブ・レート制限・メトリクスの保存先の既定をワーカー間で共有できるものにする
+"""
+
+import gc
+import os
+import sys
+import glob
+import tempfile
+
+# --- gunicorn 設定 ---
+# gthread / gevent / uvicorn（uvicorn は backend.asgi:app を非同期ワーカーで動かす）
+GUNICORN_WORKER_CLASS = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# 0 なら CPU 数から決める
+GUNICORN_WORKERS = int(os.environ.get('GUNICORN_WORKERS', '0'))
+# 1ワーカーが画像を抱えて持てるメモリには限りがあるので、CPU が多くても上限で止める
+GUNICORN_MAX_WORKERS = int(os.environ.get('GUNICORN_MAX_WORKERS', '8'))
+# gthread のワーカーごとのスレッド数（Gemini の応答待ちが長いので CPU 数より多くする）
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', '8'))
+# GEMINI_CALL_DEADLINE（100秒）より長くして、生成中のワーカーを強制終了しない
+GUNICORN_TIMEOUT = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+GUNICORN_GRACEFUL_TIMEOUT = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+GUNICORN_KEEPALIVE = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+# gevent はモンキーパッチより前に import すると動かないので preload しない
+GUNICORN_PRELOAD = os.environ.get(
+    'GUNICORN_PRELOAD', 'false' if GUNICORN_WORKER_CLASS == 'gevent' else 'true',
+).lower() == 'true'
+# 0 なら再起動しない（メモリが増え続ける場合の保険）
+GUNICORN_MAX_REQUESTS = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+
+WORKER_CLASSES = {
+    'gthread': 'gthread',
+    'gevent': 'gevent',
+    'uvicorn': 'uvicorn.workers.UvicornWorker',
+}
+
+
+def default_workers(worker_class, cpu_count):
+    """CPU 数からのワーカー数
+
+    gthread はスレッドで待ちをさばくので CPU 数、イベントループのワーカーは CPU 数 + 1
+    （画像の正規化・エンコードは CPU を使うので、それ以上増やしても速くならない）
+    """
+    if worker_class == 'gthread':
+        return max(2, cpu_count)
+    return cpu_count + 1
+
+
+def _cpu_count():
+    # コンテナで CPU が制限されている場合は割り当て分だけ数える
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# ワーカー間で状態を共有する設定（(環境変数, 共有できない値)）
+SHARED_STATE_SETTINGS = (
+    ('JOB_BACKEND', 'memory'),
+    ('RATE_LIMIT_BACKEND', 'memory'),
+    ('PROFILE_CACHE_VERSION_BACKEND', 'local'),
+    ('METRICS_MULTIPROC_DIR', ''),
+)
+DEFAULT_METRICS_DIR = os.path.join(tempfile.gettempdir(), 'hairstyle-metrics')
+
+
+def use_shared_state_defaults(environ):
+    """未設定の保存先を、Redis があれば redis、なければ同一ノードの SQLite / ファイルにする
+
+    アプリの import（preload ではマスター、しないときはワーカー）より前に環境変数として入れる
+    """
+    backend = 'redis' if environ.get('REDIS_URL') else 'sqlite'
+    defaults = {'JOB_BACKEND': backend, 'RATE_LIMIT_BACKEND': backend, 'METRICS_MULTIPROC_DIR': DEFAULT_METRICS_DIR}
+    for name, value in defaults.items():
+        # 空文字（env.example をそのまま使った場合など）も未設定として扱う
+        if not environ.get(name):
+            environ[name] = value
+
+
+def per_process_settings(environ):
+    """ワーカー間で共有されない設定の一覧（use_shared_state_defaults の後で、明示的に memory / local を指定した場合など）"""
+    return [name for name, value in SHARED_STATE_SETTINGS if environ.get(name, '') == value]
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = WORKER_CLASSES[GUNICORN_WORKER_CLASS]
+wsgi_app = 'backend.asgi:app' if GUNICORN_WORKER_CLASS == 'uvicorn' else 'backend.server:app'
+workers = GUNICORN_WORKERS or min(GUNICORN_MAX_WORKERS, default_workers(GUNICORN_WORKER_CLASS, _cpu_count()))
+threads = GUNICORN_THREADS if GUNICORN_WORKER_CLASS == 'gthread' else 1
+timeout = GUNICORN_TIMEOUT
+graceful_timeout = GUNICORN_GRACEFUL_TIMEOUT
+keepalive = GUNICORN_KEEPALIVE
+preload_app = GUNICORN_PRELOAD
+max_requests = GUNICORN_MAX_REQUESTS
+max_requests_jitter = GUNICORN_MAX_REQUESTS // 10
+# ハートビートのファイルを tmpfs に置く（Docker の /tmp はディスクで、書き込みが詰まるとワーカーが止まったと判定される）
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+if workers > 1:
+    use_shared_state_defaults(os.environ)
+
+
+def _loaded_server():
+    """preload 済みなら backend.server（ワーカーで import し直さない）"""
+    return sys.modules.get('backend.server')
+
+
+def on_starting(arbiter):
+    # 前回起動時のワーカーのメトリクスを持ち越さない（既定のディレクトリのときだけ消す）
+    if os.environ.get('METRICS_MULTIPROC_DIR') == DEFAULT_METRICS_DIR:
+        for path in glob.glob(os.path.join(DEFAULT_METRICS_DIR, '*.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def when_ready(arbiter):
+    if workers > 1:
+        shared = per_process_settings(os.environ)
+        if shared:
+            # ジョブのポーリング・SSE が別ワーカーで 404、レート制限がワーカー数倍、などになる
+            arbiter.log.warning(
+                'ワーカーが %d 個ありますが、次の設定はワーカーごとの状態です: %s', workers, ', '.join(shared),
+            )
+
+    app_server = _loaded_server()
+    if app_server is None:
+        return
+    app_server.log_startup_config()
+    # 以降に確保するオブジェクトだけを GC の対象にし、共有ページへの書き込み（コピー）を減らす
+    gc.freeze()
+
+
+def post_fork(arbiter, worker):
+    app_server = _loaded_server()
+    if app_server is not None:
+        app_server.reinit_after_fork()
+
+
+def post_worker_init(worker):
+    # preload しない場合は最初のワーカーだけが設定状況を出す
+    app_server = _loaded_server()
+    if app_server is not None and not preload_app and worker.age == 1:
+        app_server.log_startup_config()
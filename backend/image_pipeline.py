@@ -0,0 +1,182 @@
+"""
+顔画像の正規化パイプライン
+EXIF 回転の反映 → 長辺の縮小 → メタデータ除去 → JPEG 再エンコード
+Gemini へ送るペイロードを小さくし、ワーカーのメモリ使用量も抑える
+"""
+
+import io
+import os
+import binascii
+import threading
+from collections import namedtuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# --- 正規化設定 ---
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '1024'))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+
+NormalizedImage = namedtuple(
+    'NormalizedImage',
+    ['data', 'mime_type', 'width', 'height', 'original_bytes', 'bytes_saved'],
+)
+
+
+class InvalidImageError(ValueError):
+    """画像として読み込めないデータ"""
+
+
+class ImageTooLargeError(ValueError):
+    """デコード後のサイズが上限を超える"""
+
+
+# 位置情報・撮影者などが入りうるメタデータ（これがある元画像はそのまま送らない）
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop', 'icc_profile')
+
+
+DATA_URL_MARKER = 'base64,'
+
+
+def estimate_decoded_size(encoded_length, padding=0):
+    """Base64 文字数からデコード後のバイト数を見積もる"""
+    return (encoded_length * 3) // 4 - padding
+
+
+def _payload_bounds(data):
+    """data URL のヘッダーを除いた Base64 部分の (開始, 終了) 位置"""
+    marker = data.find(DATA_URL_MARKER)
+    start = marker + len(DATA_URL_MARKER) if marker != -1 else 0
+    end = len(data)
+    while end > start and data[end - 1] in '\r\n ':
+        end -= 1
+    return start, end
+
+
+def encoded_image_size(data):
+    """data URL / Base64 文字列のデコード後サイズ（デコードせずに計算）"""
+    start, end = _payload_bounds(data)
+    padding = 0
+    if end > start and data[end - 1] == '=':
+        padding = 2 if end - 1 > start and data[end - 2] == '=' else 1
+    return estimate_decoded_size(end - start, padding)
+
+
+def decode_base64_image(data, max_bytes):
+    """data URL / Base64 文字列を1回だけデコードする
+
+    サイズは文字数から先に判定するので、上限超過のデータはデコードしない
+    a2b_base64 に ASCII の str をそのまま渡すので、bytes への変換コピーは作らない
+    （ヘッダー・末尾の改行がない Base64 はコピーなし、data URL は Base64 部分のスライス1回分）
+    """
+    if not isinstance(data, str) or not data:
+        raise InvalidImageError('画像データが文字列ではありません')
+
+    if encoded_image_size(data) > max_bytes:
+        raise ImageTooLargeError()
+
+    start, end = _payload_bounds(data)
+    try:
+        # 全体を指すスライスは同じオブジェクトが返る（コピーされない）
+        decoded = binascii.a2b_base64(data[start:end])
+    except ValueError as e:
+        # binascii.Error（不正な Base64）も ValueError（ASCII 以外の文字）も同じ扱い
+        raise InvalidImageError(str(e)) from e
+
+    # 改行入りなど見積もりがずれる場合のための最終確認
+    if len(decoded) > max_bytes:
+        raise ImageTooLargeError()
+    return decoded
+
+
+_stats_lock = threading.Lock()
+_stats = {'images': 0, 'original_bytes': 0, 'normalized_bytes': 0, 'bytes_saved': 0}
+
+
+def _to_rgb(image):
+    """透過を白背景で合成して RGB にする"""
+    if image.mode == 'RGB':
+        return image
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def normalize_image(raw, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY):
+    """アップロード画像を Gemini 送信用の JPEG に正規化
+
+    raw はデコード済みバイト列（BytesIO はコピーせずに同じバッファを参照する）
+    画素数が Image.MAX_IMAGE_PIXELS の2倍を超える画像（圧縮爆弾）は ImageTooLargeError
+    メタデータのない RGB の JPEG で、縮小せず再エンコードしても小さくならない場合は元のバイト列を使う
+    """
+    try:
+        image = Image.open(io.BytesIO(raw))
+        original_size = image.size
+        reusable = (
+            image.format == 'JPEG' and image.mode == 'RGB'
+            and not any(key in image.info for key in METADATA_KEYS)
+        )
+        if image.format == 'JPEG':
+            # JPEG は DCT スケーリングで縮小しながらデコード（フルサイズ展開を避ける）
+            image.draft('RGB', (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+
+        if max(image.size) > max_edge:
+            # reducing_gap で整数倍の reduce() を先に行い、リサンプルを軽くする
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=2.0)
+
+        image = _to_rgb(image)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        # 途中で切れたファイルは展開（thumbnail / convert）で OSError になる
+        raise InvalidImageError(str(e)) from e
+
+    # exif / icc を渡さずに保存するのでメタデータ（位置情報など）は除去される
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    data = buffer.getvalue()
+    if len(data) >= len(raw) and reusable and image.size == original_size:
+        # 圧縮済みの小さな JPEG は再エンコードすると大きくなることがある
+        data = bytes(raw)
+    # メタデータ除去のために元より大きくなった場合は「削減 0」として数える
+    bytes_saved = max(0, len(raw) - len(data))
+
+    with _stats_lock:
+        _stats['images'] += 1
+        _stats['original_bytes'] += len(raw)
+        _stats['normalized_bytes'] += len(data)
+        _stats['bytes_saved'] += bytes_saved
+
+    return NormalizedImage(
+        data=data,
+        mime_type='image/jpeg',
+        width=image.width,
+        height=image.height,
+        original_bytes=len(raw),
+        bytes_saved=bytes_saved,
+    )
+
+
+def convert_image(data, format_name, quality=90):
+    """生成画像を別フォーマット（WEBP など）に変換"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        buffer = io.BytesIO()
+        image.save(buffer, format=format_name, quality=quality)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except (UnidentifiedImageError, OSError) as e:
+        raise InvalidImageError(str(e)) from e
+    return buffer.getvalue()
+
+
+def pipeline_stats():
+    """正規化の累計（プロセス単位）"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['max_edge'] = IMAGE_MAX_EDGE
+    stats['jpeg_quality'] = IMAGE_JPEG_QUALITY
+    return stats
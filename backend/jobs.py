@@ -0,0 +1,344 @@
+"""
+髪型生成ジョブキュー
+POST はジョブIDだけ返し、Gemini 呼び出しは上限付きワーカープールで実行する
+結果はポーリングまたは Server-Sent Events で受け取る
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import app_logging, tracing
+
+logger = app_logging.get_logger('jobs')
+
+# --- ジョブキュー設定 ---
+# memory（プロセス内）/ sqlite（同一ノードの全ワーカーで共有）/ redis（複数ノードで共有）
+JOB_BACKEND = os.environ.get('JOB_BACKEND', 'memory')
+JOB_SQLITE_PATH = os.environ.get('JOB_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'hairstyle-jobs.sqlite3'))
+JOB_REDIS_URL = os.environ.get('JOB_REDIS_URL', os.environ.get('REDIS_URL') or 'redis://localhost:6379/0')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', '32'))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', '600'))
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED)
+
+
+class QueueFullError(Exception):
+    """待ちジョブ数が上限に達した"""
+
+
+def new_job_record(user_id, kind):
+    now = time.time()
+    return {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'kind': kind,
+        'status': STATUS_QUEUED,
+        'result': None,
+        'http_status': None,
+        'created_at': now,
+        'updated_at': now,
+    }
+
+
+class InMemoryJobStore:
+    """プロセス内のジョブ保存先"""
+
+    def __init__(self, ttl=JOB_RESULT_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._cond = threading.Condition()
+
+    def _purge(self, now):
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['status'] in FINISHED_STATUSES and now - job['updated_at'] > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def create(self, job):
+        with self._cond:
+            self._purge(time.time())
+            self._jobs[job['id']] = dict(job)
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **fields):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if not job:
+                return
+            job.update(fields, updated_at=time.time())
+            self._cond.notify_all()
+
+    def wait(self, job_id, since, timeout):
+        """updated_at が since より新しくなるまで待つ"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if not job or job['updated_at'] > since:
+                    return dict(job) if job else None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return dict(job)
+                self._cond.wait(remaining)
+
+
+class RedisJobStore:
+    """Redis 互換サーバーに保存（複数ワーカーから参照可能）"""
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, url=JOB_REDIS_URL, ttl=JOB_RESULT_TTL):
+        import redis
+
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(job_id):
+        return f'hairstyle:job:{job_id}'
+
+    def create(self, job):
+        self._redis.set(self._key(job['id']), json.dumps(job), ex=self.ttl)
+
+    def get(self, job_id):
+        raw = self._redis.get(self._key(job_id))
+        return json.loads(raw) if raw else None
+
+    def update(self, job_id, **fields):
+        job = self.get(job_id)
+        if not job:
+            return
+        job.update(fields, updated_at=time.time())
+        self._redis.set(self._key(job_id), json.dumps(job), ex=self.ttl)
+
+    def wait(self, job_id, since, timeout):
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if not job or job['updated_at'] > since or time.time() >= deadline:
+                return job
+            time.sleep(self.POLL_INTERVAL)
+
+
+class SqliteJobStore:
+    """SQLite ファイルに保存（同一ノードのどのワーカーからでもポーリング・SSE できる）"""
+
+    POLL_INTERVAL = 0.5
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path=JOB_SQLITE_PATH, ttl=JOB_RESULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'create table if not exists jobs (id text primary key, body text not null, updated_at real not null)'
+        )
+
+    def _connect(self):
+        # 接続はスレッド・プロセスごとに持つ（fork 後に親の接続を使わない）
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, job):
+        conn = self._connect()
+        now = time.time()
+        if now - self._last_purge > self.PURGE_INTERVAL:
+            self._last_purge = now
+            conn.execute('delete from jobs where updated_at < ?', (now - self.ttl,))
+        conn.execute(
+            'insert or replace into jobs (id, body, updated_at) values (?, ?, ?)',
+            (job['id'], json.dumps(job), job['updated_at']),
+        )
+
+    def get(self, job_id):
+        row = self._connect().execute('select body, updated_at from jobs where id = ?', (job_id,)).fetchone()
+        if not row or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def update(self, job_id, **fields):
+        conn = self._connect()
+        conn.execute('begin immediate')
+        try:
+            row = conn.execute('select body from jobs where id = ?', (job_id,)).fetchone()
+            if row:
+                job = json.loads(row[0])
+                job.update(fields, updated_at=time.time())
+                conn.execute(
+                    'update jobs set body = ?, updated_at = ? where id = ?',
+                    (json.dumps(job), job['updated_at'], job_id),
+                )
+            conn.execute('commit')
+        except Exception:
+            conn.execute('rollback')
+            raise
+
+    def wait(self, job_id, since, timeout):
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if not job or job['updated_at'] > since or time.time() >= deadline:
+                return job
+            time.sleep(self.POLL_INTERVAL)
+
+
+def create_job_store():
+    if JOB_BACKEND == 'sqlite':
+        try:
+            return SqliteJobStore()
+        except Exception as e:
+            logger.warning('SQLite ジョブストア初期化エラー（メモリにフォールバック）', extra={'error': str(e)})
+    elif JOB_BACKEND == 'redis':
+        try:
+            store = RedisJobStore()
+            logger.info('ジョブキュー: Redis', extra={'url': JOB_REDIS_URL})
+            return store
+        except Exception as e:
+            logger.warning('Redis ジョブストア初期化エラー（メモリにフォールバック）', extra={'error': str(e)})
+    return InMemoryJobStore()
+
+
+class JobQueue:
+    """上限付きワーカープールでジョブを実行"""
+
+    def __init__(self, store, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_MAX):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._executor_pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # fork 後の子プロセスでは親のスレッドが存在しないので作り直す
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='hairstyle-job',
+            )
+            self._executor_pid = pid
+            self._pending = 0
+        return self._executor
+
+    def submit(self, user_id, kind, fn, *args, **kwargs):
+        """ジョブを登録して即座にジョブレコードを返す
+
+        fn は (body, http_status) を返す関数
+        """
+        with self._lock:
+            executor = self._get_executor()
+            if self._pending >= self.max_pending:
+                raise QueueFullError()
+            self._pending += 1
+
+        job = new_job_record(user_id, kind)
+        self.store.create(job)
+        try:
+            # 投入したリクエストのトレースをワーカースレッドに引き継ぐ
+            executor.submit(tracing.wrap_context(self._run), job['id'], fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return job
+
+    def _run(self, job_id, fn, args, kwargs):
+        try:
+            self.store.update(job_id, status=STATUS_RUNNING)
+            try:
+                body, http_status = fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception('ジョブ実行エラー', extra={'job': job_id})
+                body, http_status = {'error': f'生成エラー: {str(e)}'}, 500
+
+            status = STATUS_SUCCEEDED if http_status < 400 else STATUS_FAILED
+            self.store.update(job_id, status=status, result=body, http_status=http_status)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': type(self.store).__name__,
+                'workers': self.max_workers,
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+            }
+
+
+def public_job_view(job):
+    """API レスポンス用のジョブ表現"""
+    view = {
+        'jobId': job['id'],
+        'status': job['status'],
+        'createdAt': job['created_at'],
+        'updatedAt': job['updated_at'],
+    }
+    if job['status'] in FINISHED_STATUSES:
+        view['httpStatus'] = job['http_status']
+        view['result'] = job['result']
+    return view
+
+
+def sse_event(event, data):
+    """Server-Sent Events の1イベントを整形"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_job_events(store, job_id, heartbeat=15, max_duration=300):
+    """ジョブ終了まで状態変化を SSE で流すジェネレータ"""
+    started = time.time()
+    job = store.get(job_id)
+    if not job:
+        yield sse_event('error', {'error': 'ジョブが見つかりません'})
+        return
+
+    last_status = None
+    while True:
+        if job['status'] != last_status:
+            last_status = job['status']
+            if job['status'] in FINISHED_STATUSES:
+                yield sse_event('result', public_job_view(job))
+                return
+            yield sse_event('status', public_job_view(job))
+
+        if time.time() - started > max_duration:
+            yield sse_event('timeout', {'jobId': job_id, 'status': job['status']})
+            return
+
+        next_job = store.wait(job_id, job['updated_at'], heartbeat)
+        if not next_job:
+            yield sse_event('error', {'error': 'ジョブが見つかりません'})
+            return
+        if next_job['updated_at'] == job['updated_at']:
+            # 接続維持用のコメント行
+            yield ": keep-alive\n\n"
+        job = next_job
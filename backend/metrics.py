@@ -0,0 +1,315 @@
+"""
+Prometheus 形式のメトリクス（/metrics）
+カウンター・ゲージ・ヒストグラムだけの小さなレジストリで、外部ライブラリに依存しない
+METRICS_MULTIPROC_DIR を設定すると各ワーカーが定期的に値を書き出し、
+/metrics は全ワーカーの合計を返す（未設定なら応答したワーカーの値のみ）
+終了したワーカーのファイルはカウンター・ヒストグラムを archived.json に足し込んでから消す
+"""
+
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from backend import app_logging
+
+logger = app_logging.get_logger('metrics')
+
+# --- メトリクス設定 ---
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+# 空でなければ Authorization: Bearer <token> を要求する（空なら localhost からのみ応答する）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+ARCHIVE_NAME = 'archived.json'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 33554432)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=(), fn=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # 値を持たず、出力時に fn() から読むメトリクス（戻り値は数値、またはラベル値タプル -> 数値）
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def collect(self):
+        """{ラベル値タプル: 値} を返す"""
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception as e:
+                logger.warning('メトリクス取得エラー', extra={'metric': self.name, 'error': str(e)})
+                return {}
+            return value if isinstance(value, dict) else {(): value}
+        with self._lock:
+            return {key: (list(v) if isinstance(v, list) else v) for key, v in self._values.items()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(registry, name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [各バケットの件数..., 合計, 件数]
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._flush_pid = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    # --- 複数ワーカーの集計 ---
+
+    def snapshot(self):
+        return {
+            metric.name: [[list(key), value] for key, value in metric.collect().items()]
+            for metric in self._metrics
+        }
+
+    def flush(self, directory=None):
+        """このプロセスの値を <dir>/<pid>.json に書き出す"""
+        directory = directory or METRICS_MULTIPROC_DIR
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, os.path.join(directory, f'{os.getpid()}.json'))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning('メトリクス書き出しエラー', extra={'error': str(e)})
+
+    def start_flusher(self):
+        """定期書き出しスレッドを開始（プロセスごとに1つ）"""
+        if not METRICS_MULTIPROC_DIR or self._flush_pid == os.getpid():
+            return
+        self._flush_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    @staticmethod
+    def _read_snapshot(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _add_snapshot(self, merged, snapshot, include_gauges=True):
+        for metric in self._metrics:
+            if metric.kind == 'gauge' and not include_gauges:
+                continue
+            values = merged.setdefault(metric.name, {})
+            for key, value in snapshot.get(metric.name, []):
+                key = tuple(key)
+                if isinstance(value, list):
+                    current = values.get(key)
+                    values[key] = [a + b for a, b in zip(current, value)] if current else value
+                else:
+                    values[key] = values.get(key, 0) + value
+
+    def _archive_dead(self, directory, dead_paths):
+        """終了したワーカーのカウンター・ヒストグラムを archived.json に移してファイルを消す"""
+        with open(os.path.join(directory, '.lock'), 'w') as lock:
+            # 他のワーカーが同時に集計しても二重に足し込まない
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(directory, ARCHIVE_NAME)
+            archived = {}
+            self._add_snapshot(archived, self._read_snapshot(archive_path) or {})
+            moved = []
+            for path in dead_paths:
+                snapshot = self._read_snapshot(path)
+                if snapshot is None:
+                    continue
+                self._add_snapshot(archived, snapshot, include_gauges=False)
+                moved.append(path)
+            if not moved:
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({name: [[list(key), value] for key, value in values.items()]
+                           for name, values in archived.items()}, f)
+            os.replace(tmp_path, archive_path)
+            for path in moved:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _merged(self):
+        """全ワーカーの値を合計（終了したワーカーのゲージは捨て、カウンターは archived.json に残す）"""
+        self.flush()
+        dead = [
+            entry.path for entry in os.scandir(METRICS_MULTIPROC_DIR)
+            if entry.name.endswith('.json') and entry.name[:-5].isdigit() and not _pid_alive(int(entry.name[:-5]))
+        ]
+        if dead:
+            try:
+                self._archive_dead(METRICS_MULTIPROC_DIR, dead)
+            except OSError as e:
+                logger.warning('終了したワーカーのメトリクス整理エラー', extra={'error': str(e)})
+
+        merged = {}
+        for entry in os.scandir(METRICS_MULTIPROC_DIR):
+            is_worker = entry.name.endswith('.json') and entry.name[:-5].isdigit()
+            if not is_worker and entry.name != ARCHIVE_NAME:
+                continue
+            snapshot = self._read_snapshot(entry.path)
+            if snapshot is None:
+                continue
+            # 整理に失敗して残った終了済みワーカーのゲージは数えない
+            alive = not is_worker or _pid_alive(int(entry.name[:-5]))
+            self._add_snapshot(merged, snapshot, include_gauges=is_worker and alive)
+        return merged
+
+    # --- 出力 ---
+
+    def render(self):
+        merged = self._merged() if METRICS_MULTIPROC_DIR else None
+        lines = []
+        for metric in self._metrics:
+            values = merged.get(metric.name, {}) if merged is not None else metric.collect()
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for key, value in sorted(values.items()):
+                if metric.kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets, value):
+                        cumulative += count
+                        labels = _format_labels(metric.labelnames, key, f'le="{_format_value(bound)}"')
+                        lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+                    labels = _format_labels(metric.labelnames, key, 'le="+Inf"')
+                    lines.append(f'{metric.name}_bucket{labels} {value[-1]}')
+                    labels = _format_labels(metric.labelnames, key)
+                    lines.append(f'{metric.name}_sum{labels} {_format_value(value[-2])}')
+                    lines.append(f'{metric.name}_count{labels} {value[-1]}')
+                else:
+                    lines.append(f'{metric.name}{_format_labels(metric.labelnames, key)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+REGISTRY = Registry()
+
+# --- アプリ共通のメトリクス ---
+
+STAGE_SECONDS = Histogram(
+    REGISTRY, 'hairstyle_stage_seconds',
+    '生成リクエストの段階ごとの所要時間（auth / decode / normalize / credit_check / gemini / encode / credit_write）',
+    ['stage'],
+)
+HTTP_REQUESTS = Counter(
+    REGISTRY, 'hairstyle_http_requests_total', 'エンドポイント・ステータス・エラー種別ごとのリクエスト数',
+    ['endpoint', 'method', 'status', 'error'],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    REGISTRY, 'hairstyle_http_request_seconds', 'エンドポイントごとの応答時間', ['endpoint'],
+)
+REQUEST_BYTES = Histogram(
+    REGISTRY, 'hairstyle_request_bytes', 'リクエストボディのサイズ', ['endpoint'], buckets=SIZE_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    REGISTRY, 'hairstyle_response_bytes', 'レスポンスボディのサイズ', ['endpoint'], buckets=SIZE_BUCKETS,
+)
+
+
+def stage_timer(stage):
+    """with metrics.stage_timer('gemini'): ... で段階の所要時間を記録"""
+    return STAGE_SECONDS.time(stage=stage)
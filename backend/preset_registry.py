@@ -0,0 +1,161 @@
+"""
+プリセット（髪型・髪色）の定義
+backend/presets.json を起動時に1回読み、サーバー・generate_presets.py・フロントエンド（/api/v1/presets）で共有する
+プリセット x 髪色ごとの生成プロンプトは読み込み時に組み立てておき、リクエストでは辞書を引くだけにする
+（同じプリセットなら常に同じプロンプトになるので、結果キャッシュと Gemini 側のキャッシュが効く）
+"""
+
+import os
+import json
+import hashlib
+
+PRESET_REGISTRY_PATH = os.environ.get(
+    'PRESET_REGISTRY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presets.json'),
+)
+
+HAIRSTYLE_PROMPT_TEMPLATE = """この人物の顔写真の髪型を変更してください。
+
+髪型スタイル: {name}
+詳細: {detail}
+ジェンダー: {gender_name}
+
+指示:
+- 顔の特徴（目、鼻、口、肌など）は完全に維持
+- 髪型のみを指定されたスタイルに変更
+- 自然で違和感のない仕上がりに
+- 画像を1枚生成してください"""
+
+PRESET_IMAGE_PATH = '/images/presets/{gender}/{id}.png'
+
+
+class UnknownPresetError(KeyError):
+    """登録されていないプリセット・髪色・ジェンダー"""
+
+
+def build_hairstyle_prompt(name, detail, gender_name):
+    """髪型変更プロンプト（登録外の自由入力でも同じ形にする）"""
+    return HAIRSTYLE_PROMPT_TEMPLATE.format(name=name, detail=detail, gender_name=gender_name)
+
+
+class CompiledPrompt:
+    """(gender, preset, color) ごとに組み立て済みのプロンプト"""
+
+    __slots__ = ('label', 'prompt')
+
+    def __init__(self, label, prompt):
+        self.label = label
+        self.prompt = prompt
+
+
+class PresetRegistry:
+    """presets.json の内容と、組み立て済みのプロンプト・公開用 JSON"""
+
+    def __init__(self, data):
+        self.genders = data['genders']
+        self.presets = data['presets']
+        self.colors = data['colors']
+        self.lengths = data.get('lengths', [])
+        self._presets = {
+            (gender, preset['id']): preset for gender, presets in self.presets.items() for preset in presets
+        }
+        self._colors = {color['id']: color for color in self.colors}
+        self._lengths = {length['id']: length for length in self.lengths}
+        # 旧クライアントが送る指示文（adjustments.length / color）→ id
+        self._legacy_adjust_ids = {
+            'length': {length['prompt']: length['id'] for length in self.lengths if length['prompt']},
+            'color': {color['prompt']: color['id'] for color in self.colors if color['prompt']},
+        }
+        self._prompts = self._compile()
+
+        # /api/v1/presets の本文と ETag（プロンプトはサーバー側だけで使うので出さない）
+        self.public_body = json.dumps(self._public_view(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.version = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.etag = f'"{hashlib.sha256(self.public_body).hexdigest()[:16]}"'
+
+    def _compile(self):
+        prompts = {}
+        for (gender, preset_id), preset in self._presets.items():
+            if not preset['prompt']:
+                continue
+            gender_name = self.genders[gender]['name']
+            for color_id, color in [(None, None), *self._colors.items()]:
+                detail, label = preset['prompt'], preset['name']
+                # 髪色「なし」はプリセットのままと同じ
+                if color and color['prompt']:
+                    detail = f"{preset['prompt']}, {color['prompt']}"
+                    label = f"{preset['name']} ({color['name']})"
+                prompts[(gender, preset_id, color_id)] = CompiledPrompt(
+                    label, build_hairstyle_prompt(label, detail, gender_name),
+                )
+        return prompts
+
+    def _public_view(self):
+        return {
+            'genders': [{'id': gender, 'name': info['name']} for gender, info in self.genders.items()],
+            'presets': {
+                gender: [
+                    {
+                        'id': preset['id'],
+                        'name': preset['name'],
+                        'image': PRESET_IMAGE_PATH.format(gender=gender, id=preset['id']) if preset['prompt'] else None,
+                    }
+                    for preset in presets
+                ]
+                for gender, presets in self.presets.items()
+            },
+            'colors': [{'id': color['id'], 'name': color['name'], 'swatch': color['swatch']} for color in self.colors],
+            'lengths': [{'id': length['id'], 'name': length['name']} for length in self.lengths],
+        }
+
+    def presets_for(self, gender):
+        """generate_presets.py 用（id / name / prompt）"""
+        return self.presets[gender]
+
+    def prompt_for(self, gender, preset_id, color_id=None):
+        """組み立て済みのプロンプト。登録外なら UnknownPresetError
+
+        JSON で配列・オブジェクトなどが来ても辞書引き（unhashable）で落ちないよう、文字列以外は登録外として扱う
+        """
+        if not isinstance(gender, str) or not isinstance(preset_id, str):
+            raise UnknownPresetError(f'{gender!r}/{preset_id!r}')
+        if color_id is not None and not isinstance(color_id, str):
+            raise UnknownPresetError(f'{gender}/{preset_id}/{color_id!r}')
+        if gender not in self.genders:
+            raise UnknownPresetError(gender)
+        if color_id in ('', 'none'):
+            color_id = None
+        compiled = self._prompts.get((gender, preset_id, color_id))
+        if compiled is None:
+            raise UnknownPresetError(f'{gender}/{preset_id}/{color_id}')
+        return compiled
+
+    def adjust_prompts(self, length_id=None, color_id=None):
+        """髪型調整で加える指示（長さ・髪色の id から）。登録外・文字列以外なら UnknownPresetError
+
+        None / '' / 'same' / 'none' は「そのまま」
+        """
+        parts = []
+        for kind, table, item_id in (('length', self._lengths, length_id), ('color', self._colors, color_id)):
+            if item_id in (None, '', 'same', 'none'):
+                continue
+            if not isinstance(item_id, str) or item_id not in table:
+                raise UnknownPresetError(f'{kind}/{item_id!r}')
+            if table[item_id]['prompt']:
+                parts.append(table[item_id]['prompt'])
+        return parts
+
+    def legacy_adjust_id(self, kind, text):
+        """旧クライアントの調整指示文（kind は length / color）を id にする。登録外なら UnknownPresetError"""
+        if text in (None, ''):
+            return None
+        if not isinstance(text, str) or text not in self._legacy_adjust_ids[kind]:
+            raise UnknownPresetError(f'{kind}/{text!r}')
+        return self._legacy_adjust_ids[kind][text]
+
+    def stats(self):
+        return {'version': self.version, 'presets': len(self._presets), 'prompts': len(self._prompts)}
+
+
+def load(path=PRESET_REGISTRY_PATH):
+    with open(path, encoding='utf-8') as f:
+        return PresetRegistry(json.load(f))
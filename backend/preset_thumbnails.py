@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+プリセット画像のサムネイル作成
+生成した元画像（frontend/images/presets/<gender>/<id>.png、1024px 前後）から
+表示サイズ 72px の 1x / 2x / 3x を AVIF / WebP / PNG で作り、thumbnails.json に一覧を書く
+フロントエンドは thumbnails.json から <picture> の srcset を組み立てる
+
+python -m backend.preset_thumbnails            # 元画像が変わったものだけ作り直す
+python -m backend.preset_thumbnails --force
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import hashlib
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageOps, features
+
+# --- サムネイル設定 ---
+# CSS 上の表示サイズ（.preset-thumb）
+THUMBNAIL_SIZE = int(os.environ.get('PRESET_THUMBNAIL_SIZE', '72'))
+THUMBNAIL_SCALES = (1, 2, 3)
+THUMBNAIL_WEBP_QUALITY = int(os.environ.get('PRESET_THUMBNAIL_WEBP_QUALITY', '80'))
+THUMBNAIL_AVIF_QUALITY = int(os.environ.get('PRESET_THUMBNAIL_AVIF_QUALITY', '55'))
+# PNG は減色してパレット化する（白背景のサムネイルなので 128 色で十分）
+THUMBNAIL_PNG_COLORS = int(os.environ.get('PRESET_THUMBNAIL_PNG_COLORS', '128'))
+
+MANIFEST_NAME = 'thumbnails.json'
+MANIFEST_VERSION = 1
+THUMBNAIL_DIR = 'thumbs'
+# srcset で優先する順（対応していないブラウザは次の形式、最後は PNG）
+FORMAT_ORDER = ('avif', 'webp', 'png')
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'png': 'image/png'}
+
+DEFAULT_PRESETS_DIR = Path(__file__).parent.parent / 'frontend' / 'images' / 'presets'
+
+
+def available_formats():
+    """この Pillow で書き出せる形式（AVIF は Pillow 11.2+ か pillow-avif-plugin が必要）"""
+    formats = ['png']
+    if features.check('webp'):
+        formats.append('webp')
+    try:
+        import pillow_avif  # noqa: F401  Image.SAVE に AVIF を登録する
+    except ImportError:
+        pass
+    Image.init()
+    if 'AVIF' in Image.SAVE:
+        formats.append('avif')
+    return [name for name in FORMAT_ORDER if name in formats]
+
+
+def _flatten(image):
+    """透過は白背景に合成して RGB にする"""
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, '#FFFFFF')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def encode(image, format_name):
+    buffer = io.BytesIO()
+    if format_name == 'webp':
+        image.save(buffer, 'WEBP', quality=THUMBNAIL_WEBP_QUALITY, method=6)
+    elif format_name == 'avif':
+        image.save(buffer, 'AVIF', quality=THUMBNAIL_AVIF_QUALITY, speed=4)
+    else:
+        palette = image.quantize(colors=THUMBNAIL_PNG_COLORS, method=Image.Quantize.MEDIANCUT)
+        palette.save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def render(source_bytes, formats):
+    """{(format, scale): bytes}"""
+    with Image.open(io.BytesIO(source_bytes)) as source:
+        image = _flatten(source)
+
+    rendered = {}
+    for scale in THUMBNAIL_SCALES:
+        edge = THUMBNAIL_SIZE * scale
+        # 正方形に中央で切り抜き、拡大はしない
+        edge = min(edge, image.width, image.height)
+        resized = ImageOps.fit(image, (edge, edge), Image.Resampling.LANCZOS)
+        for format_name in formats:
+            rendered[(format_name, scale)] = encode(resized, format_name)
+    return rendered
+
+
+def _write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.stem}-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(presets_dir):
+    try:
+        with open(Path(presets_dir) / MANIFEST_NAME) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data.get('presets', {}) if data.get('version') == MANIFEST_VERSION else {}
+
+
+def source_images(presets_dir):
+    """(key, 元画像のパス)（key は "<gender>/<id>"）"""
+    presets_dir = Path(presets_dir)
+    for path in sorted(presets_dir.glob('*/*.png')):
+        if path.parent.name == THUMBNAIL_DIR:
+            continue
+        yield f'{path.parent.name}/{path.stem}', path
+
+
+def _is_current(entry, digest, formats, presets_dir):
+    if not entry or entry.get('source_hash') != digest or set(entry.get('srcset', {})) != set(formats):
+        return False
+    return all(
+        (Path(presets_dir) / file).exists()
+        for files in entry['srcset'].values() for file in files.values()
+    )
+
+
+def build_all(presets_dir=DEFAULT_PRESETS_DIR, keys=None, force=False):
+    """元画像からサムネイルと thumbnails.json を作る。(作成した件数, スキップした件数)"""
+    presets_dir = Path(presets_dir)
+    formats = available_formats()
+    previous = load_manifest(presets_dir)
+    entries = {}
+    built = skipped = 0
+
+    for key, path in source_images(presets_dir):
+        source_bytes = path.read_bytes()
+        digest = hashlib.sha256(source_bytes).hexdigest()[:16]
+        entry = previous.get(key)
+        selected = keys is None or key in keys
+        if not selected or (not force and _is_current(entry, digest, formats, presets_dir)):
+            if entry:
+                entries[key] = entry
+            skipped += 1
+            continue
+
+        srcset = {name: {} for name in formats}
+        sizes = {name: 0 for name in formats}
+        for (format_name, scale), data in render(source_bytes, formats).items():
+            relative_path = f'{THUMBNAIL_DIR}/{key}@{scale}x.{format_name}'
+            _write_atomic(presets_dir / relative_path, data)
+            srcset[format_name][f'{scale}x'] = relative_path
+            sizes[format_name] += len(data)
+
+        entries[key] = {
+            'source_hash': digest,
+            'source_bytes': len(source_bytes),
+            # フロントエンドの ?v= に使う（ファイル名は固定なので内容が変わったらここが変わる）
+            'version': digest[:8],
+            'srcset': srcset,
+            'bytes': sizes,
+        }
+        built += 1
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'size': THUMBNAIL_SIZE,
+        'scales': [f'{scale}x' for scale in THUMBNAIL_SCALES],
+        'formats': [{'name': name, 'type': MIME_TYPES[name]} for name in formats],
+        'presets': entries,
+    }
+    _write_atomic(
+        presets_dir / MANIFEST_NAME,
+        json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8'),
+    )
+    return built, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='プリセット画像のサムネイル作成')
+    parser.add_argument('--presets-dir', type=Path, default=DEFAULT_PRESETS_DIR)
+    parser.add_argument('--only', help='対象（mens/wolf など、カンマ区切り）')
+    parser.add_argument('--force', action='store_true', help='元画像が変わっていなくても作り直す')
+    args = parser.parse_args()
+
+    keys = set(args.only.split(',')) if args.only else None
+    print(f"形式: {', '.join(available_formats())} / サイズ: {THUMBNAIL_SIZE}px x {THUMBNAIL_SCALES}")
+    built, skipped = build_all(args.presets_dir, keys=keys, force=args.force)
+    print(f"サムネイル作成: {built} 件 / スキップ: {skipped} 件")
+    print(f"一覧: {args.presets_dir / MANIFEST_NAME}")
+
+
+if __name__ == '__main__':
+    main()
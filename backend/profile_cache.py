@@ -0,0 +1,221 @@
+"""
+ユーザープロフィールキャッシュ
+get_profile_record の前段に置く短TTL・件数上限付きのキャッシュ
+書き込み（クレジット消費・付与）はキャッシュへ書き通し、バージョン番号を上げて他ワーカーの古いエントリを無効化する
+バージョン保存先: local（プロセス内のみ）/ sqlite（同一ノード共有）/ redis（複数ノード共有）
+"""
+
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from backend import app_logging
+
+logger = app_logging.get_logger('profile_cache')
+
+# --- プロフィールキャッシュ設定 ---
+PROFILE_CACHE_ENABLED = os.environ.get('PROFILE_CACHE_ENABLED', 'true').lower() == 'true'
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '30'))
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get('PROFILE_CACHE_MAX_ENTRIES', '10000'))
+# 既定はワーカー間で共有できるもの（Redis の URL があれば redis、なければ同一ノードの sqlite）
+PROFILE_CACHE_VERSION_BACKEND = os.environ.get(
+    'PROFILE_CACHE_VERSION_BACKEND',
+    'redis' if os.environ.get('PROFILE_CACHE_REDIS_URL') or os.environ.get('REDIS_URL') else 'sqlite',
+)
+PROFILE_CACHE_SQLITE_PATH = os.environ.get(
+    'PROFILE_CACHE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'hairstyle-profile-versions.sqlite3')
+)
+PROFILE_CACHE_REDIS_URL = os.environ.get('PROFILE_CACHE_REDIS_URL', os.environ.get('REDIS_URL') or 'redis://localhost:6379/0')
+
+
+class LocalVersions:
+    """プロセス内のみのバージョン（ワーカー1つ向け。PROFILE_CACHE_VERSION_BACKEND=local で明示したときだけ使う）"""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def bump(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            return self._versions[user_id]
+
+
+class SqliteVersions:
+    """SQLite ファイルで同一ノードのワーカー間にバージョンを共有"""
+
+    def __init__(self, path=PROFILE_CACHE_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'create table if not exists profile_versions (user_id text primary key, version integer not null)'
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, user_id):
+        row = self._connect().execute(
+            'select version from profile_versions where user_id = ?', (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, user_id):
+        conn = self._connect()
+        conn.execute('begin immediate')
+        try:
+            conn.execute(
+                'insert into profile_versions (user_id, version) values (?, 1) '
+                'on conflict(user_id) do update set version = version + 1',
+                (user_id,),
+            )
+            version = conn.execute(
+                'select version from profile_versions where user_id = ?', (user_id,)
+            ).fetchone()[0]
+            conn.execute('commit')
+        except Exception:
+            conn.execute('rollback')
+            raise
+        return version
+
+
+class RedisVersions:
+    """Redis 互換サーバーで複数ノード間にバージョンを共有"""
+
+    def __init__(self, url=PROFILE_CACHE_REDIS_URL):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(user_id):
+        return f'hairstyle:profile-version:{user_id}'
+
+    def get(self, user_id):
+        return int(self._redis.get(self._key(user_id)) or 0)
+
+    def bump(self, user_id):
+        return int(self._redis.incr(self._key(user_id)))
+
+
+def create_version_store():
+    if PROFILE_CACHE_VERSION_BACKEND == 'sqlite':
+        try:
+            return SqliteVersions()
+        except Exception as e:
+            logger.warning('SQLite プロフィールバージョン初期化エラー（プロセス内にフォールバック）', extra={'error': str(e)})
+    elif PROFILE_CACHE_VERSION_BACKEND == 'redis':
+        try:
+            return RedisVersions()
+        except Exception as e:
+            logger.warning('Redis プロフィールバージョン初期化エラー（プロセス内にフォールバック）', extra={'error': str(e)})
+    return LocalVersions()
+
+
+class ProfileCache:
+    """TTL + バージョン一致で有効なプロフィールの LRU"""
+
+    def __init__(self, versions=None, ttl=PROFILE_CACHE_TTL, max_entries=PROFILE_CACHE_MAX_ENTRIES):
+        self.versions = versions or LocalVersions()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # user_id -> (profile, version, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.writes = 0
+
+    def _current_version(self, user_id):
+        try:
+            return self.versions.get(user_id)
+        except Exception as e:
+            logger.warning('プロフィールバージョン取得エラー', extra={'error': str(e)})
+            return None
+
+    def begin_fill(self, user_id):
+        """DB から読む前のバージョン（読み込み中の書き込みを検出するため先に取る）"""
+        return self._current_version(user_id)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if not entry:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        profile, version, expires_at = entry
+        current = self._current_version(user_id)
+        with self._lock:
+            if expires_at <= time.time() or current is None or current != version:
+                self._entries.pop(user_id, None)
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+        return dict(profile)
+
+    def put(self, user_id, profile, version):
+        """begin_fill で得たバージョンと共に保存"""
+        if version is None:
+            return
+        with self._lock:
+            self._entries[user_id] = (dict(profile), version, time.time() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def write_through(self, user_id, fields=None, increments=None):
+        """書き込み後の値をキャッシュに反映し、他ワーカーのエントリを無効化"""
+        try:
+            version = self.versions.bump(user_id)
+        except Exception as e:
+            logger.warning('プロフィールバージョン更新エラー', extra={'error': str(e)})
+            version = None
+
+        with self._lock:
+            self.writes += 1
+            entry = self._entries.pop(user_id, None)
+            # 他のワーカーが間に書き込んでいたら、手元の値は古いので捨てて次の読み込みに任せる
+            if not entry or version is None or entry[1] != version - 1:
+                return
+            profile = dict(entry[0])
+            profile.update(fields or {})
+            for key, amount in (increments or {}).items():
+                profile[key] = (profile.get(key) or 0) + amount
+            self._entries[user_id] = (profile, version, time.time() + self.ttl)
+
+    def invalidate(self, user_id):
+        self.write_through(user_id)
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.versions).__name__,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'writes': self.writes,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
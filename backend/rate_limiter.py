@@ -0,0 +1,282 @@
+"""
+レート制限
+スライディングウィンドウカウンター（直前ウィンドウの件数を経過率で按分）で O(1) 判定する
+同時実行数の枠（acquire_slot / release_slot。期限付きなので解放されなかった枠も残らない）も同じバックエンドで持つ
+バックエンド: memory（プロセス内）/ sqlite（同一ノードの全ワーカーで共有）/ redis（複数ノードで共有）
+"""
+
+import os
+import math
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from backend import app_logging
+
+logger = app_logging.get_logger('rate_limiter')
+
+# --- レート制限バックエンド設定 ---
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_SQLITE_PATH = os.environ.get(
+    'RATE_LIMIT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'hairstyle-ratelimit.sqlite3')
+)
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', os.environ.get('REDIS_URL') or 'redis://localhost:6379/0')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+
+
+def sliding_window_count(previous, current, elapsed, window):
+    """直前ウィンドウの件数を残り割合で按分した推定リクエスト数"""
+    weight = max(0.0, 1.0 - elapsed / window)
+    return previous * weight + current
+
+
+def retry_after_seconds(previous, current, elapsed, window, limit, cost=1):
+    """次に cost 件分が通るまでの待ち秒数（概算）"""
+    if current + cost - 1 >= limit or previous <= 0:
+        return math.ceil(window - elapsed)
+    # previous * (1 - t / window) + current + cost - 1 < limit となる t
+    needed = window * (1 - (limit - current - cost + 1) / previous)
+    return max(1, math.ceil(needed - elapsed))
+
+
+class MemoryRateLimiter:
+    """プロセス内スライディングウィンドウカウンター（アイドルキーは自動削除）"""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        # key -> [window_start, previous, current]（最後に使われた順）
+        self._counters = OrderedDict()
+        # key -> {token: 期限}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now, window):
+        # 先頭ほど古いので、2ウィンドウ以上使われていないキーを先頭から消す
+        while self._counters:
+            key, counter = next(iter(self._counters.items()))
+            if now - counter[0] < 2 * window and len(self._counters) <= self.max_keys:
+                break
+            del self._counters[key]
+        # 解放されずに期限が切れた枠（落ちたリクエストなど）だけが残るキーを消す
+        expired = [key for key, slots in self._slots.items() if all(expires <= now for expires in slots.values())]
+        for key in expired:
+            del self._slots[key]
+
+    def hit(self, key, limit, window, cost=1):
+        """cost 件分（通常は1リクエスト）を数える。(許可するか, 再試行までの秒数) を返す"""
+        now = time.time()
+        window_start = now - (now % window)
+
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = [window_start, 0, 0]
+                self._counters[key] = counter
+            elif counter[0] != window_start:
+                # 1ウィンドウ進んだら current を previous へ、2つ以上なら両方リセット
+                counter[1] = counter[2] if window_start - counter[0] == window else 0
+                counter[2] = 0
+                counter[0] = window_start
+            self._counters.move_to_end(key)
+
+            elapsed = now - window_start
+            if sliding_window_count(counter[1], counter[2], elapsed, window) + cost - 1 >= limit:
+                return False, retry_after_seconds(counter[1], counter[2], elapsed, window, limit, cost)
+
+            counter[2] += cost
+            self._evict(now, window)
+            return True, 0
+
+    def acquire_slot(self, key, limit, ttl):
+        """同時実行の枠を1つ取る。取れたら解放用のトークン、上限なら None"""
+        now = time.time()
+        with self._lock:
+            slots = {token: expires for token, expires in self._slots.get(key, {}).items() if expires > now}
+            if len(slots) >= limit:
+                if slots:
+                    self._slots[key] = slots
+                else:
+                    self._slots.pop(key, None)
+                return None
+            token = uuid.uuid4().hex
+            slots[token] = now + ttl
+            self._slots[key] = slots
+            return token
+
+    def release_slot(self, key, token):
+        with self._lock:
+            slots = self._slots.get(key)
+            if slots is not None:
+                slots.pop(token, None)
+                if not slots:
+                    del self._slots[key]
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'keys': len(self._counters), 'slot_keys': len(self._slots)}
+
+
+class SqliteRateLimiter:
+    """SQLite ファイルで同一ノードのワーカー間にカウンターを共有"""
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path=RATE_LIMIT_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'create table if not exists rate_limits ('
+                ' key text primary key, window_start real not null,'
+                ' previous integer not null, current integer not null)'
+            )
+            conn.execute(
+                'create table if not exists rate_limit_slots ('
+                ' key text not null, token text primary key, expires_at real not null)'
+            )
+            conn.execute('create index if not exists rate_limit_slots_key on rate_limit_slots (key)')
+
+    def _connect(self):
+        # 接続はスレッド・プロセスごとに持つ（fork 後に親の接続を使わない）
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def hit(self, key, limit, window, cost=1):
+        now = time.time()
+        window_start = now - (now % window)
+        conn = self._connect()
+
+        conn.execute('begin immediate')
+        try:
+            row = conn.execute(
+                'select window_start, previous, current from rate_limits where key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                previous, current = 0, 0
+            elif row[0] != window_start:
+                previous = row[2] if window_start - row[0] == window else 0
+                current = 0
+            else:
+                previous, current = row[1], row[2]
+
+            elapsed = now - window_start
+            allowed = sliding_window_count(previous, current, elapsed, window) + cost - 1 < limit
+            if allowed:
+                current += cost
+            conn.execute(
+                'insert or replace into rate_limits (key, window_start, previous, current) values (?, ?, ?, ?)',
+                (key, window_start, previous, current),
+            )
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                self._last_purge = now
+                conn.execute('delete from rate_limits where window_start < ?', (now - 2 * window,))
+            conn.execute('commit')
+        except Exception:
+            conn.execute('rollback')
+            raise
+
+        if allowed:
+            return True, 0
+        return False, retry_after_seconds(previous, current, elapsed, window, limit, cost)
+
+    def acquire_slot(self, key, limit, ttl):
+        now = time.time()
+        conn = self._connect()
+
+        conn.execute('begin immediate')
+        try:
+            conn.execute('delete from rate_limit_slots where key = ? and expires_at <= ?', (key, now))
+            row = conn.execute('select count(*) from rate_limit_slots where key = ?', (key,)).fetchone()
+            token = None
+            if row[0] < limit:
+                token = uuid.uuid4().hex
+                conn.execute(
+                    'insert into rate_limit_slots (key, token, expires_at) values (?, ?, ?)', (key, token, now + ttl),
+                )
+            conn.execute('commit')
+        except Exception:
+            conn.execute('rollback')
+            raise
+        return token
+
+    def release_slot(self, key, token):
+        self._connect().execute('delete from rate_limit_slots where token = ?', (token,))
+
+    def stats(self):
+        row = self._connect().execute('select count(*) from rate_limits').fetchone()
+        return {'backend': 'sqlite', 'keys': row[0], 'path': self.path}
+
+
+class RedisRateLimiter:
+    """Redis 互換サーバーで複数ノード間にカウンターを共有"""
+
+    def __init__(self, url=RATE_LIMIT_REDIS_URL):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+
+    def hit(self, key, limit, window, cost=1):
+        now = time.time()
+        index = int(now // window)
+        elapsed = now - index * window
+        current_key = f'hairstyle:rl:{key}:{index}'
+        previous_key = f'hairstyle:rl:{key}:{index - 1}'
+
+        pipe = self._redis.pipeline()
+        pipe.incrby(current_key, cost)
+        pipe.expire(current_key, int(2 * window))
+        pipe.get(previous_key)
+        current, _, previous = pipe.execute()
+        previous = int(previous or 0)
+
+        # incrby 済みなので、判定は自分を除いた件数で行う
+        if sliding_window_count(previous, current - cost, elapsed, window) + cost - 1 >= limit:
+            self._redis.decrby(current_key, cost)
+            return False, retry_after_seconds(previous, current - cost, elapsed, window, limit, cost)
+        return True, 0
+
+    def acquire_slot(self, key, limit, ttl):
+        # 期限をスコアにした sorted set。先に追加して順位で判定し、上限を超えていたら取り消す
+        now = time.time()
+        slots_key = f'hairstyle:slots:{key}'
+        token = uuid.uuid4().hex
+        pipe = self._redis.pipeline()
+        pipe.zremrangebyscore(slots_key, '-inf', now)
+        pipe.zadd(slots_key, {token: now + ttl})
+        pipe.expire(slots_key, int(ttl) + 1)
+        pipe.zrank(slots_key, token)
+        rank = pipe.execute()[-1]
+        if rank is not None and rank >= limit:
+            self._redis.zrem(slots_key, token)
+            return None
+        return token
+
+    def release_slot(self, key, token):
+        self._redis.zrem(f'hairstyle:slots:{key}', token)
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+def create_rate_limiter():
+    if RATE_LIMIT_BACKEND == 'sqlite':
+        try:
+            return SqliteRateLimiter()
+        except Exception as e:
+            logger.warning('SQLite レート制限初期化エラー（メモリにフォールバック）', extra={'error': str(e)})
+    elif RATE_LIMIT_BACKEND == 'redis':
+        try:
+            return RedisRateLimiter()
+        except Exception as e:
+            logger.warning('Redis レート制限初期化エラー（メモリにフォールバック）', extra={'error': str(e)})
+    return MemoryRateLimiter()
@@ -0,0 +1,271 @@
+"""
+髪型生成結果キャッシュ
+同じ顔写真 + 同じプリセットの再生成をメモリ(LRU)とディスクから返す
+ディスク層は容量上限を持ち、期限切れと古いもの（最終アクセス順）を定期的に掃除する
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+
+from backend import app_logging
+
+logger = app_logging.get_logger('result_cache')
+
+# --- 結果キャッシュ設定 ---
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', '3600'))
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '')
+# ディスク層の容量上限（超えたら最終アクセスの古いものから消す）
+RESULT_CACHE_DISK_MAX_BYTES = int(os.environ.get('RESULT_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+# ディスク層の掃除間隔（秒）
+RESULT_CACHE_SWEEP_INTERVAL = int(os.environ.get('RESULT_CACHE_SWEEP_INTERVAL', '300'))
+# キャッシュヒット時のクレジット: free = 消費しない / charge = 通常どおり1消費
+RESULT_CACHE_CREDIT_POLICY = os.environ.get('RESULT_CACHE_CREDIT_POLICY', 'free')
+
+
+class ResultCache:
+    """メモリ LRU（バイト数上限）+ 任意のディスク層"""
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL, disk_dir=RESULT_CACHE_DIR,
+                 disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES, sweep_interval=RESULT_CACHE_SWEEP_INTERVAL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # ディスク層の使用量（掃除で数え直すまでは書き込み分を足していく。None は未計測）
+        self._disk_bytes = None
+        self._last_sweep = 0.0
+        self._sweeping = False
+        self.disk_evictions = 0
+        self.disk_expired = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    # --- メモリ層 ---
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry['size']
+
+    def _store_memory(self, key, entry):
+        if entry['size'] > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry['size']
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    # --- ディスク層 ---
+
+    def _disk_paths(self, key):
+        directory = os.path.join(self.disk_dir, key[:2])
+        return os.path.join(directory, f'{key}.bin'), os.path.join(directory, f'{key}.json')
+
+    def _load_disk(self, key, now):
+        data_path, meta_path = self._disk_paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['expires_at'] <= now:
+                for path in (data_path, meta_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                return None
+            with open(data_path, 'rb') as f:
+                image = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        # 最終アクセスを mtime に残す（容量超過時はこれが古いものから消す）
+        try:
+            os.utime(data_path)
+        except OSError:
+            pass
+        return {'image': image, 'text': meta.get('text', ''), 'expires_at': meta['expires_at'], 'size': len(image)}
+
+    @staticmethod
+    def _atomic_write(path, data):
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _store_disk(self, key, entry):
+        data_path, meta_path = self._disk_paths(key)
+        try:
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            self._atomic_write(data_path, entry['image'])
+            meta = json.dumps({'text': entry['text'], 'expires_at': entry['expires_at']}, ensure_ascii=False).encode('utf-8')
+            self._atomic_write(meta_path, meta)
+        except Exception as e:
+            logger.warning('結果キャッシュ書き込みエラー', extra={'error': str(e)})
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += entry['size'] + len(meta)
+        self._maybe_sweep()
+
+    @staticmethod
+    def _remove_files(*paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _maybe_sweep(self):
+        """掃除間隔が過ぎたか容量を超えたら、バックグラウンドで掃除する"""
+        now = time.time()
+        with self._lock:
+            over_budget = self._disk_bytes is not None and self._disk_bytes > self.disk_max_bytes
+            if self._sweeping or (not over_budget and now - self._last_sweep < self.sweep_interval):
+                return
+            self._sweeping = True
+            self._last_sweep = now
+        threading.Thread(target=self._sweep_in_background, name='result-cache-sweeper', daemon=True).start()
+
+    def _sweep_in_background(self):
+        try:
+            self.sweep_disk()
+        except Exception as e:
+            logger.warning('結果キャッシュの掃除エラー', extra={'error': str(e)})
+        finally:
+            with self._lock:
+                self._sweeping = False
+
+    def sweep_disk(self, now=None):
+        """期限切れを消し、容量上限を超えた分を最終アクセスの古い順に消す。(期限切れ, 容量超過) の件数を返す"""
+        now = now or time.time()
+        live = []
+        expired = evicted = 0
+        for shard in os.scandir(self.disk_dir):
+            if not shard.is_dir():
+                continue
+            for item in os.scandir(shard.path):
+                name = item.name
+                if name.startswith('.tmp-') or (name.endswith('.bin') and not os.path.exists(item.path[:-4] + '.json')):
+                    # 書き込み途中で落ちた一時ファイル・メタデータのない画像
+                    try:
+                        if now - item.stat().st_mtime > self.ttl:
+                            self._remove_files(item.path)
+                    except OSError:
+                        pass
+                    continue
+                if not name.endswith('.json'):
+                    continue
+                data_path = item.path[:-len('.json')] + '.bin'
+                try:
+                    with open(item.path, 'r', encoding='utf-8') as f:
+                        expires_at = json.load(f)['expires_at']
+                    data_stat = os.stat(data_path)
+                    meta_size = item.stat().st_size
+                except (OSError, ValueError, KeyError, TypeError):
+                    expires_at = 0
+                if expires_at <= now:
+                    self._remove_files(data_path, item.path)
+                    expired += 1
+                    continue
+                live.append((data_stat.st_mtime, data_stat.st_size + meta_size, data_path, item.path))
+
+        total = sum(size for _, size, _, _ in live)
+        live.sort()
+        for _, size, data_path, meta_path in live:
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_files(data_path, meta_path)
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_bytes = total
+            self.disk_expired += expired
+            self.disk_evictions += evicted
+        if expired or evicted:
+            logger.info('結果キャッシュのディスク層を掃除', extra={'expired': expired, 'evicted': evicted, 'bytes': total})
+        return expired, evicted
+
+    # --- 公開API ---
+
+    def get(self, key):
+        """(画像バイト列, テキスト) を返す。なければ None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry['expires_at'] <= now:
+                self._remove(key)
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry['image'], entry['text']
+
+        if self.disk_dir:
+            entry = self._load_disk(key, now)
+            if entry:
+                self._store_memory(key, entry)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return entry['image'], entry['text']
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, image, text=''):
+        entry = {
+            'image': image,
+            'text': text or '',
+            'expires_at': time.time() + self.ttl,
+            'size': len(image),
+        }
+        self._store_memory(key, entry)
+        if self.disk_dir:
+            self._store_disk(key, entry)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'disk_enabled': bool(self.disk_dir),
+                'disk_bytes': self._disk_bytes,
+                'disk_max_bytes': self.disk_max_bytes,
+                'disk_expired': self.disk_expired,
+                'disk_evictions': self.disk_evictions,
+            }
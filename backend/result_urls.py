@@ -0,0 +1,73 @@
+"""
+生成画像の短期URL
+画像をトークン名のファイルとして一時保存し、有効期限内だけ GET で返す
+同一ノードのワーカー間で共有できるようにディスクに置く
+"""
+
+import os
+import re
+import time
+import secrets
+import tempfile
+import threading
+
+# --- 短期URL設定 ---
+RESULT_URL_TTL = int(os.environ.get('RESULT_URL_TTL', '300'))
+RESULT_URL_DIR = os.environ.get('RESULT_URL_DIR', os.path.join(tempfile.gettempdir(), 'hairstyle-results'))
+
+EXTENSIONS = {'image/png': 'png', 'image/webp': 'webp', 'image/jpeg': 'jpg'}
+MIME_TYPES = {ext: mime for mime, ext in EXTENSIONS.items()}
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{20,64}\.(png|webp|jpg)$')
+
+
+class ResultUrlStore:
+    """トークン → 画像ファイルの短期ストア"""
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, directory=RESULT_URL_DIR, ttl=RESULT_URL_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_sweep = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def put(self, data, mime_type='image/png'):
+        """画像を保存してトークン（ファイル名）を返す"""
+        self._maybe_sweep()
+        name = f"{secrets.token_urlsafe(24)}.{EXTENSIONS.get(mime_type, 'png')}"
+        path = os.path.join(self.directory, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return name
+
+    def get(self, name):
+        """(画像バイト列, MIMEタイプ) を返す。期限切れ・不正なトークンは None"""
+        if not TOKEN_PATTERN.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        return data, MIME_TYPES[name.rsplit('.', 1)[1]]
+
+    def _maybe_sweep(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep < self.SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
@@ -4,27 +4,45 @@ AI髪型シミュレーター - バックエンドサーバー
 Google AI Studio (Gemini) + Supabase認証 + Stripe課金 + クレジット制
 """
 
-from flask import Flask, request, jsonify, send_from_directory, redirect
+from flask import Flask, Response, abort, g, request, jsonify, redirect, send_file, stream_with_context
 from flask_cors import CORS
+from werkzeug.datastructures import FileStorage
 import os
+import sys
 import json
 import base64
 import re
 import time
-import io
+import hmac
 import hashlib
+import contextvars
 import stripe
 import jwt
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from functools import wraps
-from collections import defaultdict
-from PIL import Image
+from urllib.parse import quote
 
 # Get the base directory (where Dockerfile copies files)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FRONTEND_DIR = os.path.join(BASE_DIR, 'frontend')
 
-app = Flask(__name__, static_folder=FRONTEND_DIR)
+# python backend/server.py での直接起動でも backend パッケージを読めるように
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from backend import (
+    app_logging, auth_tokens, credit_holds, gemini_pool, gemini_resilience, image_pipeline, jobs, profile_cache,
+    rate_limiter,
+    metrics, preset_registry, result_cache, result_urls, static_assets, tracing, upstream_governor,
+)
+
+logger = app_logging.get_logger('server')
+access_logger = app_logging.get_logger('access')
+
+# frontend/ は static_assets で配信する（Flask 標準の /static は許可リストを通らないので使わない）
+app = Flask(__name__, static_folder=None)
 
 # CORS設定
 ALLOWED_ORIGINS = os.environ.get('ALLOWED_ORIGINS', '*').split(',')
@@ -32,11 +50,23 @@ CORS(app, origins=ALLOWED_ORIGINS)
 
 # 画像アップロード制限 (10MB)
 MAX_IMAGE_SIZE_BYTES = 10 * 1024 * 1024
+# リクエスト全体の上限（Base64 の顔写真 + 現在画像 + フィールド分の余裕）
+app.config['MAX_CONTENT_LENGTH'] = 3 * MAX_IMAGE_SIZE_BYTES
 
-# レート制限設定
-RATE_LIMIT_WINDOW = 60
+# レート制限設定（IP単位 / ログインユーザー単位）
+RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', '60'))
 RATE_LIMIT_MAX_REQUESTS = int(os.environ.get('RATE_LIMIT_MAX', '30'))
-rate_limit_store = defaultdict(list)
+RATE_LIMIT_USER_MAX_REQUESTS = int(os.environ.get('RATE_LIMIT_USER_MAX', str(RATE_LIMIT_MAX_REQUESTS)))
+# 前段の信頼できるプロキシ（Coolify の Traefik など）の段数。X-Forwarded-For の右からこの段数目をクライアントIPとみなす
+# 0 なら X-Forwarded-For を使わず接続元アドレスを使う
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '1'))
+
+# 一括生成（1枚の顔写真 x 複数プリセット）
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '8'))
+# ユーザーごとに一括生成で同時に Gemini を呼ぶ数（同じユーザーの全一括生成の合計。枠はレート制限のバックエンドで共有）
+BATCH_USER_CONCURRENCY = int(os.environ.get('BATCH_USER_CONCURRENCY', '3'))
+# 枠が空くのを待つ間の確認間隔（秒）
+BATCH_SLOT_POLL_INTERVAL = 0.2
 
 # --- Supabase設定 ---
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
@@ -64,35 +94,104 @@ CREDIT_PLANS = {
 supabase_auth_client = None
 supabase_client = None
 
-if SUPABASE_URL and (SUPABASE_ANON_KEY or SUPABASE_SERVICE_KEY):
+
+def init_supabase_clients():
+    """Supabase クライアントを作成（gunicorn の preload では fork 後に作り直す）"""
+    global supabase_auth_client, supabase_client
+
+    if not (SUPABASE_URL and (SUPABASE_ANON_KEY or SUPABASE_SERVICE_KEY)):
+        return
+
     from supabase import create_client
 
     if SUPABASE_ANON_KEY:
-        supabase_auth_client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
-        print(f"Supabase Auth接続完了: {SUPABASE_URL}")
-
+        supabase_auth_client = tracing.TracedSupabase(create_client(SUPABASE_URL, SUPABASE_ANON_KEY))
     if SUPABASE_SERVICE_KEY:
-        supabase_client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-        print(f"Supabase管理接続完了: {SUPABASE_URL}")
+        supabase_client = tracing.TracedSupabase(create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY))
+
+
+init_supabase_clients()
+
+
+_startup_config_logged = False
+
+
+def log_startup_config():
+    """設定状況をログに出す（gunicorn ではワーカーごとではなくマスターで1回）"""
+    global _startup_config_logged
+
+    # preload 時は fork したワーカーにもこのフラグが引き継がれる
+    if _startup_config_logged:
+        return
+    _startup_config_logged = True
+
+    if supabase_auth_client:
+        logger.info('Supabase Auth接続完了', extra={'url': SUPABASE_URL})
+    if supabase_client:
+        logger.info('Supabase管理接続完了', extra={'url': SUPABASE_URL})
 
-if SUPABASE_JWT_SECRET and not (supabase_auth_client or supabase_client):
-    print("Supabase JWT Secretで認証検証を有効化")
+    if SUPABASE_JWT_SECRET and not (supabase_auth_client or supabase_client):
+        logger.info('Supabase JWT Secretで認証検証を有効化')
 
-if not (supabase_auth_client or supabase_client or SUPABASE_JWT_SECRET):
-    print("警告: 認証検証手段が未設定（SUPABASE_ANON_KEY, SUPABASE_SERVICE_KEY, SUPABASE_JWT_SECRET）")
+    if not (supabase_auth_client or supabase_client or SUPABASE_JWT_SECRET):
+        logger.warning('認証検証手段が未設定（SUPABASE_ANON_KEY, SUPABASE_SERVICE_KEY, SUPABASE_JWT_SECRET）')
 
-if not supabase_client:
-    print("警告: Supabase管理クライアント未設定（SUPABASE_URL, SUPABASE_SERVICE_KEY）")
+    if not supabase_client:
+        logger.warning('Supabase管理クライアント未設定（SUPABASE_URL, SUPABASE_SERVICE_KEY）')
+
+    if GEMINI_API_KEY:
+        logger.info('Google AI Studio API設定完了')
+    else:
+        logger.warning('GEMINI_API_KEY未設定')
+
+    if STRIPE_SECRET_KEY:
+        logger.info('Stripe設定完了')
+    else:
+        logger.warning('Stripe未設定')
+
+# JWT 検証（JWKS / HS256 でローカル検証、Supabase API はフォールバック）
+token_verifier = auth_tokens.TokenVerifier(
+    jwks_url=auth_tokens.jwks_url_for(SUPABASE_URL) if SUPABASE_URL else None,
+    jwt_secret=SUPABASE_JWT_SECRET,
+    remote_clients=(supabase_auth_client, supabase_client),
+)
+
+# プロフィールキャッシュ（get_profile_record の前段）
+profiles_cache = (
+    profile_cache.ProfileCache(profile_cache.create_version_store())
+    if profile_cache.PROFILE_CACHE_ENABLED else None
+)
+
+# レート制限
+request_limiter = rate_limiter.create_rate_limiter()
+
+# 非同期生成ジョブ
+job_queue = jobs.JobQueue(jobs.create_job_store())
 
-if GEMINI_API_KEY:
-    print("Google AI Studio API設定完了")
-else:
-    print("警告: GEMINI_API_KEY未設定")
+# 生成結果キャッシュ
+generation_cache = result_cache.ResultCache() if result_cache.RESULT_CACHE_ENABLED else None
 
-if STRIPE_SECRET_KEY:
-    print("Stripe設定完了")
-else:
-    print("警告: Stripe未設定")
+# 生成画像の短期URL
+result_url_store = result_urls.ResultUrlStore()
+
+# プリセット定義と組み立て済みのプロンプト（backend/presets.json）
+preset_catalog = preset_registry.load()
+
+# 静的ファイルのマニフェスト（preload ではマスターで1回だけ作る）
+static_files = static_assets.StaticAssets(FRONTEND_DIR).build()
+
+# Gemini の同時実行数（AIMD で調整、混雑時は画像処理・予約の前に 503）
+upstream = upstream_governor.UpstreamGovernor()
+
+
+def reinit_after_fork():
+    """fork したワーカーで、親プロセスと共有してはいけない接続を作り直す（gunicorn の post_fork 用）
+
+    スレッド・SQLite 接続・Redis 接続プールは各モジュールがプロセスIDを見て作り直す
+    """
+    init_supabase_clients()
+    token_verifier.remote_clients = [client for client in (supabase_auth_client, supabase_client) if client]
+    gemini_pool.reset_client()
 
 
 # --- 認証ミドルウェア ---
@@ -103,34 +202,12 @@ def is_auth_validation_configured():
 
 
 def get_user_from_token(token):
-    """JWTトークンからユーザー情報を取得"""
-    # 方式1: Supabase APIで検証（新形式ECC対応）
-    for client in (supabase_auth_client, supabase_client):
-        if not client:
-            continue
-        try:
-            result = client.auth.get_user(token)
-            if result and result.user:
-                return result.user.id
-        except Exception:
-            pass
+    """JWTトークンからユーザー情報を取得
 
-    # 方式2: HS256シークレットで検証（Legacy）
-    if SUPABASE_JWT_SECRET:
-        try:
-            payload = jwt.decode(
-                token,
-                SUPABASE_JWT_SECRET,
-                algorithms=['HS256'],
-                audience='authenticated'
-            )
-            return payload.get('sub')
-        except jwt.ExpiredSignatureError:
-            return None
-        except jwt.InvalidTokenError:
-            pass
-
-    return None
+    検証済みトークンのキャッシュ → JWKS(ES256/RS256) / HS256 のローカル検証 →
+    鍵が見つからない場合のみ Supabase API の順で確認する
+    """
+    return token_verifier.verify(token)
 
 
 def require_auth(f):
@@ -145,45 +222,248 @@ def require_auth(f):
             return jsonify({'error': '認証サーバー設定が不足しています'}), 503
 
         token = auth_header.split('Bearer ')[1]
-        user_id = get_user_from_token(token)
+        with metrics.stage_timer('auth'):
+            user_id = get_user_from_token(token)
 
         if not user_id:
             return jsonify({'error': 'セッションが切れました。再ログインしてください'}), 401
 
         request.user_id = user_id
+        # リクエスト終了時に end_request_log_context で戻る
+        app_logging.bind(user=app_logging.user_hash(user_id))
         return f(*args, **kwargs)
     return decorated_function
 
 
-def rate_limit(f):
-    """レート制限デコレータ"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-        now = time.time()
-        rate_limit_store[client_ip] = [
-            t for t in rate_limit_store[client_ip]
-            if now - t < RATE_LIMIT_WINDOW
+def get_client_ip():
+    """クライアントIP
+
+    X-Forwarded-For の左側はクライアントが自由に書けるので、信頼できるプロキシが追加した
+    右から TRUSTED_PROXY_COUNT 番目だけを使う（werkzeug の ProxyFix(x_for=N) と同じ選び方。
+    ASGI の生成系API は wsgi_app を通らないので、ミドルウェアではなくここで判定する）
+    """
+    if TRUSTED_PROXY_COUNT > 0:
+        forwarded = [
+            address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',') if address.strip()
         ]
-        if len(rate_limit_store[client_ip]) >= RATE_LIMIT_MAX_REQUESTS:
+        if len(forwarded) >= TRUSTED_PROXY_COUNT:
+            return forwarded[-TRUSTED_PROXY_COUNT]
+    return request.remote_addr or 'unknown'
+
+
+def check_rate_limits(cost=1):
+    """IP 単位（ログイン中はユーザー単位も）の制限に cost 件分を数える。超過なら 429 のレスポンス"""
+    limits = [(f'ip:{get_client_ip()}', RATE_LIMIT_MAX_REQUESTS)]
+    user_id = getattr(request, 'user_id', None)
+    if user_id:
+        limits.append((f'user:{user_id}', RATE_LIMIT_USER_MAX_REQUESTS))
+
+    for key, max_requests in limits:
+        try:
+            allowed, retry_after = request_limiter.hit(key, max_requests, RATE_LIMIT_WINDOW, cost=cost)
+        except Exception as e:
+            # 共有バックエンド障害時はリクエストを止めない
+            logger.warning('レート制限エラー', extra={'error': str(e)})
+            continue
+        if not allowed:
             return jsonify({
                 'error': 'レート制限超過',
-                'message': f'{RATE_LIMIT_WINDOW}秒間に{RATE_LIMIT_MAX_REQUESTS}回までリクエストできます'
-            }), 429
-        rate_limit_store[client_ip].append(now)
+                'message': f'{RATE_LIMIT_WINDOW}秒間に{max_requests}回までリクエストできます'
+            }), 429, {'Retry-After': str(retry_after)}
+    return None
+
+
+def rate_limit(f):
+    """レート制限デコレータ（require_auth の内側ならユーザー単位の制限も適用）
+
+    ASGI サーバーが受け付け前の確認（ADMISSION_CHECKED まで）で数え済みなら数えない
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not g.pop('rate_limit_counted', False):
+            limited = check_rate_limits()
+            if limited:
+                return limited
         return f(*args, **kwargs)
     return decorated_function
 
 
-def validate_image_size(image_data: str) -> bool:
-    """Base64画像データのサイズを検証"""
-    if 'base64,' in image_data:
-        image_data = image_data.split('base64,')[1]
-    try:
-        decoded = base64.b64decode(image_data)
-        return len(decoded) <= MAX_IMAGE_SIZE_BYTES
-    except Exception:
-        return False
+def request_fields():
+    """JSON または multipart/form-data のリクエストを dict で返す
+
+    multipart の画像パートは FileStorage のまま入る（decode_upload で読む）
+    """
+    if request.mimetype == 'multipart/form-data':
+        data = request.form.to_dict()
+        if isinstance(data.get('adjustments'), str):
+            try:
+                data['adjustments'] = json.loads(data['adjustments'])
+            except ValueError:
+                data['adjustments'] = {}
+        for name, file in request.files.items():
+            data[name] = file
+        return data
+    return request.get_json(silent=True)
+
+
+def decode_upload(image_data):
+    """data URL / Base64 の画像、または multipart の画像パートをバイト列にする"""
+    with metrics.stage_timer('decode'):
+        if isinstance(image_data, FileStorage):
+            # 上限+1バイトだけ読めば超過を判定できる
+            raw = image_data.stream.read(MAX_IMAGE_SIZE_BYTES + 1)
+            if len(raw) > MAX_IMAGE_SIZE_BYTES:
+                raise image_pipeline.ImageTooLargeError()
+            return raw
+        return image_pipeline.decode_base64_image(image_data, MAX_IMAGE_SIZE_BYTES)
+
+
+def normalize_upload(raw):
+    """アップロード画像を正規化し、削減バイト数をリクエストに記録"""
+    with metrics.stage_timer('normalize'):
+        normalized = image_pipeline.normalize_image(raw)
+        g.image_bytes_saved = g.get('image_bytes_saved', 0) + normalized.bytes_saved
+        return normalized
+
+
+# --- メトリクス ---
+
+# 生成中（Gemini の実行枠を持っている）リクエスト数
+metrics.Gauge(
+    metrics.REGISTRY, 'hairstyle_generations_in_flight', 'Gemini を呼び出し中の生成数',
+    fn=lambda: upstream.stats()['in_flight'],
+)
+metrics.Gauge(
+    metrics.REGISTRY, 'hairstyle_gemini_concurrency_limit', 'Gemini 同時実行数の現在の上限（AIMD）',
+    fn=lambda: upstream.stats()['limit'],
+)
+metrics.Counter(
+    metrics.REGISTRY, 'hairstyle_gemini_calls_total', 'Gemini 呼び出しの試行・再試行・ヘッジ回数', ['kind'],
+    fn=lambda: {
+        (kind,): value for kind, value in gemini_pool.resilience_stats().items()
+        if kind in ('calls', 'attempts', 'retries', 'hedges', 'hedge_wins', 'timeouts', 'failures')
+    },
+)
+
+
+def metrics_endpoint_label():
+    """メトリクスのラベルにはURLではなくルールを使う（トークンやパスで系列が増えないように）"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.before_request
+def start_request_timer():
+    # ASGI サーバーでは受信時刻が入っている
+    request.environ.setdefault('hairstyle.started_at', time.perf_counter())
+    metrics.REGISTRY.start_flusher()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = metrics_endpoint_label()
+    if endpoint == '/metrics':
+        return response
+
+    started_at = request.environ.get('hairstyle.started_at')
+    if started_at is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started_at, endpoint=endpoint)
+    metrics.HTTP_REQUESTS.inc(
+        endpoint=endpoint, method=request.method, status=response.status_code, error=g.get('error_class', ''),
+    )
+    if request.content_length:
+        metrics.REQUEST_BYTES.observe(request.content_length, endpoint=endpoint)
+    if response.content_length is not None:
+        metrics.RESPONSE_BYTES.observe(response.content_length, endpoint=endpoint)
+    return response
+
+
+# --- トレース ---
+
+@app.before_request
+def start_request_trace():
+    """リクエストのルートスパンを開始（ASGI サーバーが開始済みならそれを使う）"""
+    if tracing.current_span() is not None:
+        return
+    span = tracing.start_span(
+        f'{request.method} {metrics_endpoint_label()}', kind='SERVER',
+        attributes={'http.method': request.method, 'http.route': metrics_endpoint_label()},
+        traceparent=request.headers.get('traceparent'),
+    )
+    g.request_span = span
+    g.request_span_token = tracing.activate(span)
+
+
+@app.after_request
+def add_trace_headers(response):
+    span = tracing.current_span()
+    if span is not None:
+        response.headers['traceparent'] = span.traceparent()
+        response.headers['X-Trace-Id'] = span.trace_id
+    if 'request_span' in g:
+        g.request_span.set_attribute('http.status_code', response.status_code)
+        if response.status_code >= 500:
+            g.request_span.status = 'ERROR'
+    return response
+
+
+@app.teardown_request
+def end_request_trace(error=None):
+    span = g.pop('request_span', None)
+    if span is None:
+        return
+    if error is not None:
+        span.record_error(error)
+    tracing.deactivate(g.pop('request_span_token'))
+    span.end()
+
+
+# --- ログ ---
+
+@app.before_request
+def start_request_log_context():
+    g.log_context_token = app_logging.bind(endpoint=metrics_endpoint_label(), method=request.method)
+
+
+@app.after_request
+def log_access(response):
+    """アクセスログ（成功は LOG_ACCESS_SAMPLE_RATE で間引き、5xx は常に出す）"""
+    endpoint = metrics_endpoint_label()
+    if endpoint == '/metrics':
+        return response
+
+    started_at = request.environ.get('hairstyle.started_at')
+    fields = {
+        'endpoint': endpoint,
+        'method': request.method,
+        'status': response.status_code,
+        'sample_rate': 1.0 if response.status_code >= 500 else app_logging.LOG_ACCESS_SAMPLE_RATE,
+    }
+    if started_at is not None:
+        fields['latency_ms'] = round((time.perf_counter() - started_at) * 1000, 1)
+    if 'error_class' in g:
+        fields['error'] = g.error_class
+    level = 'error' if response.status_code >= 500 else 'info'
+    getattr(access_logger, level)('request', extra=fields)
+    return response
+
+
+@app.teardown_request
+def end_request_log_context(error=None):
+    token = g.pop('log_context_token', None)
+    if token is not None:
+        app_logging.unbind(token)
+
+
+@app.after_request
+def add_image_stats_header(response):
+    """画像正規化で削減したバイト数をヘッダーで返す"""
+    if 'image_bytes_saved' in g:
+        response.headers['X-Image-Bytes-Saved'] = str(g.image_bytes_saved)
+    return response
+
+
+INVALID_IMAGE_ERROR = '画像を読み込めませんでした。JPEG または PNG の写真を選択してください'
+IMAGE_TOO_LARGE_ERROR = f'画像サイズは{MAX_IMAGE_SIZE_BYTES // (1024*1024)}MB以下にしてください'
 
 
 # --- クレジット管理 ---
@@ -228,20 +508,28 @@ def classify_profile_error(error):
     }
 
 
-def get_profile_record(user_id, create_if_missing=False, return_meta=False):
+def get_profile_record(user_id, create_if_missing=False, return_meta=False, use_cache=True):
     """profiles から1件取得。必要なら最小レコードを自動作成"""
     errors = []
 
     if not supabase_client:
         return (None, errors) if return_meta else None
 
+    if profiles_cache and use_cache:
+        cached = profiles_cache.get(user_id)
+        if cached:
+            return (cached, errors) if return_meta else cached
+        cache_version = profiles_cache.begin_fill(user_id)
+
     try:
         result = supabase_client.table('profiles').select('*').eq('id', user_id).limit(1).execute()
         rows = result.data or []
         if rows:
+            if profiles_cache and use_cache:
+                profiles_cache.put(user_id, rows[0], cache_version)
             return (rows[0], errors) if return_meta else rows[0]
     except Exception as e:
-        print(f"プロフィール取得エラー: user={user_id}, error={e}")
+        logger.warning('プロフィール取得エラー', extra={'user': app_logging.user_hash(user_id), 'error': str(e)})
         errors.append({
             'stage': 'select',
             **classify_profile_error(e),
@@ -257,10 +545,12 @@ def get_profile_record(user_id, create_if_missing=False, return_meta=False):
         }).execute()
         rows = created.data or []
         if rows:
-            print(f"プロフィール自動作成: user={user_id}")
+            logger.info('プロフィール自動作成', extra={'user': app_logging.user_hash(user_id)})
+            if profiles_cache and use_cache:
+                profiles_cache.put(user_id, rows[0], cache_version)
             return (rows[0], errors) if return_meta else rows[0]
     except Exception as e:
-        print(f"プロフィール自動作成エラー: user={user_id}, error={e}")
+        logger.warning('プロフィール自動作成エラー', extra={'user': app_logging.user_hash(user_id), 'error': str(e)})
         errors.append({
             'stage': 'insert',
             **classify_profile_error(e),
@@ -285,25 +575,59 @@ def get_user_credits(user_id):
     return 0
 
 
-def use_credit(user_id):
-    """クレジットを1消費"""
+def record_credit_change(user_id, remaining, generations=0):
+    """クレジット変更をプロフィールキャッシュへ書き通す（他ワーカーの分は無効化）"""
+    if not profiles_cache:
+        return
+    fields = {'credits': remaining} if remaining is not None and remaining != -1 else {}
+    increments = {'total_generations': generations} if generations else None
+    profiles_cache.write_through(user_id, fields, increments)
+
+
+def use_credit(user_id, reason='髪型生成'):
+    """クレジットを1消費して残高を返す
+
+    チェック・減算・履歴追加・残高取得を consume_credit 関数で1往復・原子的に行う
+    戻り値: 残高（プレミアムは -1）、残高不足なら None
+    """
     if not supabase_client:
-        return True
+        return 999
 
-    profile = get_profile_record(user_id, create_if_missing=True)
+    try:
+        result = supabase_client.rpc('consume_credit', {
+            'p_user_id': user_id,
+            'p_reason': reason,
+        }).execute()
+    except Exception as e:
+        if not credit_holds.is_missing_function_error(e, 'consume_credit'):
+            raise
+        logger.warning('consume_credit 関数が未作成です。supabase_schema.sql を適用してください')
+        remaining = use_credit_legacy(user_id, reason)
+    else:
+        rows = result.data or []
+        remaining = rows[0].get('remaining', 0) if rows and rows[0].get('ok') else None
+
+    if remaining is not None:
+        record_credit_change(user_id, remaining, generations=1)
+    return remaining
+
+
+def use_credit_legacy(user_id, reason):
+    """consume_credit 関数が無い環境向けの従来処理（原子的ではない）"""
+    profile = get_profile_record(user_id, create_if_missing=True, use_cache=False)
     if not profile:
-        return False
+        return None
 
     if profile.get('is_premium'):
         expires = profile.get('premium_expires_at')
         if expires and datetime.fromisoformat(expires.replace('Z', '+00:00')) > datetime.now(tz=__import__('datetime').timezone.utc):
             # 使用回数だけカウント
             supabase_client.rpc('increment_generations', {'user_id_input': user_id}).execute()
-            return True
+            return -1
 
     credits = profile.get('credits', 0)
     if credits <= 0:
-        return False
+        return None
 
     # クレジット減算 & 使用回数加算
     supabase_client.table('profiles').update({
@@ -316,18 +640,31 @@ def use_credit(user_id):
     supabase_client.table('credit_history').insert({
         'user_id': user_id,
         'amount': -1,
-        'reason': '髪型生成'
+        'reason': reason
     }).execute()
 
-    return True
+    return credits - 1
 
 
 def add_credits(user_id, amount, reason):
-    """クレジットを追加"""
+    """クレジットを追加して残高を返す"""
     if not supabase_client:
-        return
+        return None
 
-    profile = get_profile_record(user_id, create_if_missing=True)
+    try:
+        result = supabase_client.rpc('grant_credits', {
+            'p_user_id': user_id,
+            'p_amount': amount,
+            'p_reason': reason,
+        }).execute()
+        record_credit_change(user_id, result.data)
+        return result.data
+    except Exception as e:
+        if not credit_holds.is_missing_function_error(e, 'grant_credits'):
+            raise
+        logger.warning('grant_credits 関数が未作成です。supabase_schema.sql を適用してください')
+
+    profile = get_profile_record(user_id, create_if_missing=True, use_cache=False)
     current = profile.get('credits', 0) if profile else 0
 
     supabase_client.table('profiles').update({
@@ -341,17 +678,71 @@ def add_credits(user_id, amount, reason):
         'reason': reason
     }).execute()
 
+    record_credit_change(user_id, current + amount)
+    return current + amount
+
+
+# Gemini 呼び出し前のクレジット予約
+credit_reservations = credit_holds.CreditReservations(
+    client_getter=lambda: supabase_client,
+    legacy_consume=use_credit,
+    legacy_credits=get_user_credits,
+    on_commit=record_credit_change,
+)
+
+
+def reservation_error_response(error):
+    """予約失敗を API レスポンスにする"""
+    if error.reason == 'too_many_inflight':
+        return jsonify({
+            'error': '同時に実行できる生成数の上限に達しました',
+            'message': '実行中の生成が終わってから再度お試しください',
+        }), 429, {'Retry-After': '5'}
+
+    return jsonify({
+        'error': 'クレジット不足',
+        'message': 'クレジットを購入してください',
+        'credits': max(error.available or 0, 0),
+        'needCredits': True
+    }), 402
+
 
 # --- ルート ---
 
+def static_response(path):
+    """マニフェストから静的ファイルを返す（ETag が一致すれば 304）"""
+    found = static_files.lookup(path)
+    if not found:
+        abort(404)
+
+    asset, fingerprinted = found
+    encoding, body = asset.select(request.headers.get('Accept-Encoding'))
+    headers = {'ETag': asset.etag(encoding), 'Cache-Control': static_files.cache_control(fingerprinted)}
+    if asset.variants:
+        headers['Vary'] = 'Accept-Encoding'
+
+    if static_assets.etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+        static_files.record(not_modified=True)
+        return Response(status=304, headers=headers)
+
+    static_files.record(encoding=encoding, from_disk=body is None)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if body is None:
+        response = send_file(asset.file_path, mimetype=asset.content_type, conditional=False, etag=False)
+        response.headers.update(headers)
+        return response
+    return Response(body, content_type=asset.content_type, headers=headers)
+
+
 @app.route('/')
 def index():
-    return send_from_directory(FRONTEND_DIR, 'hairstyle.html')
+    return static_response('hairstyle.html')
 
 
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory(FRONTEND_DIR, path)
+    return static_response(path)
 
 
 @app.route('/api/v1/config', methods=['GET'])
@@ -365,6 +756,15 @@ def get_config():
     }), 200
 
 
+@app.route('/api/v1/presets', methods=['GET'])
+def get_presets():
+    """髪型・髪色のプリセット一覧（presets.json が変わらない限り ETag で 304）"""
+    headers = {'ETag': preset_catalog.etag, 'Cache-Control': 'public, max-age=300'}
+    if static_assets.etag_matches(request.headers.get('If-None-Match'), preset_catalog.etag):
+        return Response(status=304, headers=headers)
+    return Response(preset_catalog.public_body, mimetype='application/json', headers=headers)
+
+
 @app.route('/api/v1/user/profile', methods=['GET'])
 @require_auth
 def get_profile():
@@ -399,245 +799,763 @@ def get_profile():
 
 # --- 髪型生成API ---
 
-@app.route('/api/v1/vision/hairstyle/generate/guest', methods=['POST'])
-@rate_limit
-def generate_hairstyle_guest():
-    """ゲスト用（認証不要）髪型生成 - 1回無料体験用"""
-    try:
-        data = request.get_json()
-        if not data or 'face' not in data:
-            return jsonify({'error': '顔写真が必要です'}), 400
+def resolve_hairstyle_prompt(data):
+    """リクエストの髪型指定から生成プロンプトを決める（未指定なら None）
+
+    presetId（+ colorId）は presets.json から組み立て済みのプロンプトを引く
+    旧クライアントの preset / presetName（自由入力）はその場で組み立てる
+    登録されていない presetId / colorId は preset_registry.UnknownPresetError
+    """
+    gender = data.get('gender', 'mens')
+    if data.get('presetId'):
+        return preset_catalog.prompt_for(gender, data['presetId'], data.get('colorId'))
+
+    preset = data.get('preset')
+    if not preset:
+        return None
+    preset_name = data.get('presetName')
+    gender_name = 'メンズ' if gender == 'mens' else 'レディース'
+    return preset_registry.CompiledPrompt(
+        preset_name, preset_registry.build_hairstyle_prompt(preset_name, preset, gender_name),
+    )
+
+
+def unknown_preset_response():
+    return jsonify({'error': '指定された髪型が見つかりません'}), 400
+
+
+def generation_cache_key(face_bytes, prompt, model=None):
+    """顔画像 + プロンプト + モデルから結果キャッシュのキーを作る"""
+    digest = hashlib.sha256()
+    digest.update(face_bytes)
+    for value in (prompt, model or gemini_pool.GEMINI_IMAGE_MODEL):
+        # 区切りを入れて "ab"+"c" と "a"+"bc" を区別する
+        digest.update(b'\x00')
+        digest.update(str(value or '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def lookup_cached_generation(cache_key):
+    """キャッシュ済みの (画像, テキスト) を返す"""
+    if not generation_cache:
+        return None
+    return generation_cache.get(cache_key)
+
+
+def cached_generation_result(user_id, cached):
+    """キャッシュヒット時の結果を作る（クレジットはポリシーに従う）"""
+    image_data, response_text = cached
+
+    if result_cache.RESULT_CACHE_CREDIT_POLICY == 'charge':
+        remaining_credits = use_credit(user_id)
+        if remaining_credits is None:
+            return {'error': 'クレジット不足', 'needCredits': True, 'credits': 0}, 402
+    else:
+        remaining_credits = get_user_credits(user_id)
 
-        face_data = data['face']
-        preset = data.get('preset')
-        preset_name = data.get('presetName')
-        gender = data.get('gender', 'mens')
+    return {
+        'image': image_data,
+        'message': response_text,
+        'credits': remaining_credits,
+        'cached': True,
+    }, 200
 
-        if not validate_image_size(face_data):
-            return jsonify({'error': f'画像サイズは{MAX_IMAGE_SIZE_BYTES // (1024*1024)}MB以下にしてください'}), 413
 
-        if not preset:
-            return jsonify({'error': '髪型を選択してください'}), 400
+def settle_generation(hold, image_data, response_text, cache_key=None):
+    """Gemini の結果でクレジット予約を確定・解放し、(結果, HTTPステータス) を返す
 
-        if not GEMINI_API_KEY:
-            return jsonify({'error': 'API未設定'}), 500
+    hold が None（ゲスト）のときはクレジットを扱わない
+    """
+    if not image_data:
+        if hold:
+            credit_reservations.release(hold)
+        return {
+            'error': '画像生成に失敗しました',
+            'message': response_text or '画像が生成されませんでした'
+        }, 500
 
-        from google import genai
-        from google.genai.types import GenerateContentConfig, Modality
+    if generation_cache and cache_key:
+        generation_cache.put(cache_key, image_data, response_text)
 
-        client = genai.Client(api_key=GEMINI_API_KEY)
+    if hold is None:
+        return {'image': image_data}, 200
 
-        if 'base64,' in face_data:
-            face_data = face_data.split('base64,')[1]
+    # 予約を確定（生成が完了した時点で初めて減算、残高も同時に返る）
+    with metrics.stage_timer('credit_write'):
+        remaining_credits = credit_reservations.commit(hold)
+    if remaining_credits is None:
+        return {'error': 'クレジット不足'}, 402
 
-        face_bytes = base64.b64decode(face_data)
-        face_image = Image.open(io.BytesIO(face_bytes))
+    return {
+        'image': image_data,
+        'message': response_text,
+        'credits': remaining_credits
+    }, 200
 
-        gender_ja = 'メンズ' if gender == 'mens' else 'レディース'
-        prompt = f"""この人物の顔写真の髪型を変更してください。
 
-髪型スタイル: {preset_name}
-詳細: {preset}
-ジェンダー: {gender_ja}
+def run_hairstyle_generation(user_id, face_jpeg, prompt, label, hold, cache_key=None):
+    """髪型生成の本体（ジョブワーカー用）
 
-指示:
-- 顔の特徴（目、鼻、口、肌など）は完全に維持
-- 髪型のみを指定されたスタイルに変更
-- 自然で違和感のない仕上がりに
-- 画像を1枚生成してください"""
+    face_jpeg は normalize_upload 済みの JPEG バイト列、hold は予約済みのクレジット
+    リクエストコンテキストに依存しないので、ワーカースレッドからも呼べる
+    (結果, HTTPステータス) を返す。成功時の結果は生の画像バイト列を 'image' に持つ
+    """
+    logger.info('髪型合成開始', extra=app_logging.sampled(preset=label or '画像参照', mode='job'))
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-preview-05-20",
-            contents=[face_image, prompt],
-            config=GenerateContentConfig(
-                response_modalities=[Modality.TEXT, Modality.IMAGE]
-            ),
-        )
+    # ジョブは既に待ち行列を通っているので、枠が空くまで待つ
+    permit = upstream.acquire(shed=False)
+    permit.start()
+    try:
+        response = gemini_pool.generate_image_content([gemini_pool.image_part(face_jpeg), prompt])
+        image_data, response_text = gemini_pool.extract_image_and_text(response)
+    except Exception as e:
+        permit.finish(e)
+        credit_reservations.release(hold)
+        raise
+    permit.finish()
 
-        generated_image_base64 = None
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'inline_data') and part.inline_data:
-                generated_image_base64 = base64.b64encode(part.inline_data.data).decode('utf-8')
+    try:
+        result, status = settle_generation(hold, image_data, response_text, cache_key)
+    except Exception:
+        # 確定前に失敗した予約を期限切れまで残さない（確定済みなら解放は何もしない）
+        if hold:
+            credit_reservations.release(hold)
+        raise
+    if status == 200:
+        logger.info('髪型合成完了', extra=app_logging.sampled(mode='job'))
+    return result, status
+
+
+class GenerationPlan:
+    """Gemini 呼び出しの直前まで進んだ生成リクエスト
+
+    同期サーバーは run_generation_plan、ASGI サーバー（backend.asgi）は非同期クライアントで
+    Gemini を呼び、どちらも finish_generation_plan で仕上げる
+    """
+
+    def __init__(self, name, error_label, contents, data, hold=None, cache_key=None):
+        self.name = name
+        self.error_label = error_label
+        self.contents = contents
+        self.data = data
+        self.hold = hold
+        self.cache_key = cache_key
+        # upstream_admission で確保した Gemini の実行枠
+        self.permit = None
+        # 後半は別のリクエストコンテキストで動くことがあるので持ち越す
+        self.bytes_saved = g.get('image_bytes_saved', 0)
+
+
+def generation_error_response(name, error_label, error):
+    g.error_class = type(error).__name__
+    logger.error(f'{name}エラー', exc_info=error)
+    return jsonify({'error': f'{error_label}エラー: {str(error)}'}), 500
+
+
+def upstream_overloaded_response(retry_after):
+    g.error_class = 'UpstreamOverloaded'
+    return jsonify({
+        'error': '混み合っています。しばらくしてから再度お試しください'
+    }), 503, {'Retry-After': str(retry_after)}
 
-        if not generated_image_base64:
-            return jsonify({'error': '画像生成に失敗しました'}), 500
 
-        return jsonify({
-            'generatedImage': f'data:image/png;base64,{generated_image_base64}',
-        }), 200
+# 認証・レート制限を通り、Gemini の実行枠を確保する直前まで来た（ASGI サーバーの受け付け前確認用）
+ADMISSION_CHECKED = object()
+
+
+def upstream_admission(f):
+    """Gemini の実行枠を確保してから前半を実行（混雑時は画像デコード・予約の前に 503）
 
+    外側の require_auth / rate_limit を通ったリクエストだけが枠を取る
+    ASGI サーバーは g.admission_check_only で枠の手前まで確認してから非同期に枠を確保し、
+    確保済みの枠を g.upstream_permit で渡す
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.pop('admission_check_only', False):
+            return ADMISSION_CHECKED
+        permit = g.pop('upstream_permit', None)
+        if permit is None:
+            try:
+                permit = upstream.acquire()
+            except upstream_governor.UpstreamOverloaded as e:
+                return upstream_overloaded_response(e.retry_after)
+
+        try:
+            outcome = f(*args, **kwargs)
+        except BaseException:
+            permit.cancel()
+            raise
+
+        if isinstance(outcome, GenerationPlan):
+            outcome.permit = permit
+        else:
+            permit.cancel()
+        return outcome
+    return decorated_function
+
+
+def generation_errors(name, error_label):
+    """生成系APIの共通エラー処理デコレータ"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            try:
+                return f(*args, **kwargs)
+            except image_pipeline.ImageTooLargeError:
+                g.error_class = 'ImageTooLargeError'
+                return jsonify({'error': IMAGE_TOO_LARGE_ERROR}), 413
+            except image_pipeline.InvalidImageError:
+                g.error_class = 'InvalidImageError'
+                return jsonify({'error': INVALID_IMAGE_ERROR}), 400
+            except Exception as e:
+                return generation_error_response(name, error_label, e)
+        return decorated_function
+    return decorator
+
+
+def finish_generation_plan(plan, response=None, error=None):
+    """Gemini の応答（または例外）から予約の確定・キャッシュ保存・レスポンス作成を行う"""
+    g.image_bytes_saved = plan.bytes_saved
+    if plan.hold:
+        # ASGI では前半と別のコンテキストで動くので付け直す
+        app_logging.bind(user=app_logging.user_hash(plan.hold['user_id']))
+    if plan.permit:
+        plan.permit.finish(error)
+
+    try:
+        if error is not None:
+            raise error
+        image_data, response_text = gemini_pool.extract_image_and_text(response)
     except Exception as e:
-        print(f"ゲスト髪型生成エラー: {e}")
-        return jsonify({'error': f'生成エラー: {str(e)}'}), 500
+        if plan.hold:
+            credit_reservations.release(plan.hold)
+        if upstream_governor.is_overload_error(e):
+            logger.warning(f'{plan.name}: Gemini が混雑しています', extra={'error': str(e)})
+            return upstream_overloaded_response(upstream.retry_after())
+        return generation_error_response(plan.name, plan.error_label, e)
 
+    try:
+        result, status = settle_generation(plan.hold, image_data, response_text, plan.cache_key)
+        if status == 200:
+            logger.info(f'{plan.name}完了', extra=app_logging.sampled())
+        return render_generation_result(result, status, plan.data)
+    except Exception as e:
+        if plan.hold:
+            credit_reservations.release(plan.hold)
+        return generation_error_response(plan.name, plan.error_label, e)
 
-@app.route('/api/v1/vision/hairstyle/generate', methods=['POST'])
-@require_auth
-@rate_limit
-def generate_hairstyle():
-    """顔写真とプリセットから髪型変更画像を生成"""
+
+def run_generation_plan(outcome):
+    """begin_* の戻り値を同期的に完了させる（レスポンスならそのまま返す）"""
+    if not isinstance(outcome, GenerationPlan):
+        return outcome
+
+    if outcome.permit:
+        outcome.permit.start()
     try:
-        data = request.get_json()
-        if not data or 'face' not in data:
-            return jsonify({'error': '顔写真が必要です'}), 400
+        response = gemini_pool.generate_image_content(outcome.contents)
+    except Exception as e:
+        return finish_generation_plan(outcome, error=e)
+    return finish_generation_plan(outcome, response)
 
-        face_data = data['face']
-        preset = data.get('preset')
-        preset_name = data.get('presetName')
-        gender = data.get('gender', 'mens')
 
-        if not validate_image_size(face_data):
-            return jsonify({'error': f'画像サイズは{MAX_IMAGE_SIZE_BYTES // (1024*1024)}MB以下にしてください'}), 413
+def run_hairstyle_generation_job(*args, **kwargs):
+    """ジョブワーカー用: 結果を JSON で保存できる形にして返す"""
+    result, status = run_hairstyle_generation(*args, **kwargs)
+    return json_generation_body(result), status
 
-        if not preset:
-            return jsonify({'error': '髪型を選択してください'}), 400
 
-        # クレジットチェック
-        credits = get_user_credits(request.user_id)
-        if credits == 0:
-            return jsonify({
-                'error': 'クレジット不足',
-                'message': 'クレジットを購入してください',
-                'credits': 0,
-                'needCredits': True
-            }), 402
+def wants_async_job(data):
+    """ジョブ投入モードか（body の async または Prefer: respond-async）"""
+    if str(data.get('async', '')).lower() in ('1', 'true'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
 
-        if not GEMINI_API_KEY:
-            return jsonify({'error': 'API未設定', 'message': 'GEMINI_API_KEYが設定されていません'}), 500
 
-        print(f"Gemini (AI Studio) で髪型合成中... (プリセット: {preset_name or '画像参照'})")
+# --- 生成結果のレスポンス形式 ---
 
-        from google import genai
-        from google.genai.types import GenerateContentConfig, Modality
+RESULT_MIME_TYPES = ['application/json', 'image/png', 'image/webp']
 
-        client = genai.Client(api_key=GEMINI_API_KEY)
 
-        if 'base64,' in face_data:
-            face_data = face_data.split('base64,')[1]
+def json_generation_body(result):
+    """生成結果を従来の JSON 形式（data URL）にする"""
+    body = dict(result)
+    image_data = body.pop('image', None)
+    if image_data is not None:
+        generated_image_base64 = base64.b64encode(image_data).decode('utf-8')
+        body['generatedImage'] = f'data:image/png;base64,{generated_image_base64}'
+    return body
 
-        face_bytes = base64.b64decode(face_data)
-        face_image = Image.open(io.BytesIO(face_bytes))
 
-        contents = [face_image]
+def requested_result_format(data):
+    """レスポンス形式を決める: ('json' | 'binary' | 'url', MIMEタイプ)
 
-        gender_ja = 'メンズ' if gender == 'mens' else 'レディース'
-        prompt = f"""この人物の顔写真の髪型を変更してください。
+    responseFormat フィールド / クエリで明示、なければ Accept ヘッダーで判定
+    """
+    explicit = request.args.get('responseFormat') or (data or {}).get('responseFormat')
+    best = request.accept_mimetypes.best_match(RESULT_MIME_TYPES, default='application/json')
 
-髪型スタイル: {preset_name}
-詳細: {preset}
-ジェンダー: {gender_ja}
+    if explicit == 'url':
+        return 'url', best if best != 'application/json' else 'image/png'
+    if explicit == 'binary' or best != 'application/json':
+        return 'binary', best if best != 'application/json' else 'image/png'
+    return 'json', 'application/json'
 
-指示:
-- 顔の特徴（目、鼻、口、肌など）は完全に維持
-- 髪型のみを指定されたスタイルに変更
-- 自然で違和感のない仕上がりに
-- 画像を1枚生成してください"""
 
-        contents.append(prompt)
+def render_generation_result(result, status, data=None):
+    """生成結果をコンテンツネゴシエーションに従って返す"""
+    with metrics.stage_timer('encode'):
+        if status != 200 or 'image' not in result:
+            return jsonify(result), status
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-preview-05-20",
-            contents=contents,
-            config=GenerateContentConfig(
-                response_modalities=[Modality.TEXT, Modality.IMAGE]
-            ),
-        )
+        result_format, mime_type = requested_result_format(data)
+        if result_format == 'json':
+            return jsonify(json_generation_body(result)), status
 
-        generated_image_base64 = None
-        response_text = ""
+        image_data = result['image']
+        if mime_type == 'image/webp':
+            image_data = image_pipeline.convert_image(image_data, 'WEBP')
 
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'text') and part.text:
-                response_text = part.text
-            elif hasattr(part, 'inline_data') and part.inline_data:
-                image_data = part.inline_data.data
-                generated_image_base64 = base64.b64encode(image_data).decode('utf-8')
+        if result_format == 'url':
+            token = result_url_store.put(image_data, mime_type)
+            body = {key: value for key, value in result.items() if key != 'image'}
+            body['generatedImageUrl'] = f'/api/v1/results/{token}'
+            body['expiresIn'] = result_url_store.ttl
+            return jsonify(body), status
 
-        if not generated_image_base64:
-            return jsonify({
-                'error': '画像生成に失敗しました',
-                'message': response_text or '画像が生成されませんでした'
-            }), 500
+        headers = {'Cache-Control': 'no-store'}
+        if result.get('credits') is not None:
+            headers['X-Credits-Remaining'] = str(result['credits'])
+        if result.get('message'):
+            headers['X-Generation-Message'] = quote(result['message'])
+        if result.get('cached'):
+            headers['X-Result-Cached'] = 'true'
+        return Response(image_data, status=status, mimetype=mime_type, headers=headers)
 
-        # クレジット消費
-        if not use_credit(request.user_id):
-            return jsonify({'error': 'クレジット不足'}), 402
 
-        remaining_credits = get_user_credits(request.user_id)
-        print("髪型合成完了！")
+@app.route('/api/v1/results/<token>', methods=['GET'])
+def get_generated_result(token):
+    """短期URLで生成画像を返す"""
+    stored = result_url_store.get(token)
+    if not stored:
+        return jsonify({'error': '画像の有効期限が切れました'}), 404
 
-        return jsonify({
-            'generatedImage': f'data:image/png;base64,{generated_image_base64}',
-            'message': response_text,
-            'credits': remaining_credits
-        }), 200
+    image_data, mime_type = stored
+    return Response(image_data, mimetype=mime_type, headers={
+        'Cache-Control': f'private, max-age={result_url_store.ttl}',
+    })
 
-    except Exception as e:
-        print(f"髪型生成エラー: {e}")
-        return jsonify({'error': f'生成エラー: {str(e)}'}), 500
+
+@app.route('/api/v1/vision/hairstyle/generate/guest', methods=['POST'])
+def generate_hairstyle_guest():
+    """ゲスト用（認証不要）髪型生成 - 1回無料体験用"""
+    return run_generation_plan(begin_generate_hairstyle_guest())
+
+
+@rate_limit
+@upstream_admission
+@generation_errors('ゲスト髪型生成', '生成')
+def begin_generate_hairstyle_guest():
+    """ゲスト生成の前半（入力検証・画像正規化・キャッシュ確認）"""
+    data = request_fields()
+    if not data or 'face' not in data:
+        return jsonify({'error': '顔写真が必要です'}), 400
+
+    face_data = data['face']
+    try:
+        hairstyle = resolve_hairstyle_prompt(data)
+    except preset_registry.UnknownPresetError:
+        return unknown_preset_response()
+
+    if not hairstyle:
+        return jsonify({'error': '髪型を選択してください'}), 400
+
+    if not GEMINI_API_KEY:
+        return jsonify({'error': 'API未設定'}), 500
+
+    face = normalize_upload(decode_upload(face_data))
+
+    cache_key = generation_cache_key(face.data, hairstyle.prompt)
+    cached = lookup_cached_generation(cache_key)
+    if cached:
+        return render_generation_result({'image': cached[0]}, 200, data)
+
+    return GenerationPlan(
+        'ゲスト髪型生成', '生成', [gemini_pool.image_part(face.data), hairstyle.prompt], data, cache_key=cache_key,
+    )
+
+
+@app.route('/api/v1/vision/hairstyle/generate', methods=['POST'])
+def generate_hairstyle():
+    """顔写真とプリセットから髪型変更画像を生成"""
+    return run_generation_plan(begin_generate_hairstyle())
 
 
-@app.route('/api/v1/vision/hairstyle/adjust', methods=['POST'])
 @require_auth
 @rate_limit
-def adjust_hairstyle():
-    """生成済み画像の髪型を調整"""
+@upstream_admission
+@generation_errors('髪型生成', '生成')
+def begin_generate_hairstyle():
+    """髪型生成の前半（入力検証・画像正規化・キャッシュ確認・クレジット予約）"""
+    data = request_fields()
+    if not data or 'face' not in data:
+        return jsonify({'error': '顔写真が必要です'}), 400
+
+    face_data = data['face']
     try:
-        data = request.get_json()
-        if not data or 'face' not in data:
-            return jsonify({'error': '顔写真が必要です'}), 400
+        hairstyle = resolve_hairstyle_prompt(data)
+    except preset_registry.UnknownPresetError:
+        return unknown_preset_response()
 
-        face_data = data['face']
-        current_image_data = data.get('currentImage')
-        adjustments = data.get('adjustments', {})
+    if not hairstyle:
+        return jsonify({'error': '髪型を選択してください'}), 400
 
-        if not validate_image_size(face_data):
-            return jsonify({'error': f'画像サイズは{MAX_IMAGE_SIZE_BYTES // (1024*1024)}MB以下にしてください'}), 413
+    face = normalize_upload(decode_upload(face_data))
 
-        # クレジットチェック
-        credits = get_user_credits(request.user_id)
-        if credits == 0:
-            return jsonify({
-                'error': 'クレジット不足',
-                'message': 'クレジットを購入してください',
-                'credits': 0,
-                'needCredits': True
-            }), 402
+    # 同じ写真 + 同じプリセットの再実行は Gemini を呼ばずに返す
+    cache_key = generation_cache_key(face.data, hairstyle.prompt)
+    cached = lookup_cached_generation(cache_key)
+    if cached:
+        result, status = cached_generation_result(request.user_id, cached)
+        return render_generation_result(result, status, data)
+
+    if not GEMINI_API_KEY:
+        return jsonify({'error': 'API未設定', 'message': 'GEMINI_API_KEYが設定されていません'}), 500
+
+    # Gemini を呼ぶ前にクレジットを予約（成功で確定、失敗で解放）
+    try:
+        with metrics.stage_timer('credit_check'):
+            hold = credit_reservations.reserve(request.user_id)
+    except credit_holds.ReservationError as e:
+        return reservation_error_response(e)
+
+    if wants_async_job(data):
+        try:
+            job = job_queue.submit(
+                request.user_id, 'generate', run_hairstyle_generation_job,
+                request.user_id, face.data, hairstyle.prompt, hairstyle.label, hold,
+                cache_key=cache_key,
+            )
+        except jobs.QueueFullError:
+            credit_reservations.release(hold)
+            return jsonify({'error': '混み合っています。しばらくしてから再度お試しください'}), 503, {'Retry-After': '10'}
+
+        return jsonify({
+            **jobs.public_job_view(job),
+            'statusUrl': f'/api/v1/jobs/{job["id"]}',
+            'eventsUrl': f'/api/v1/jobs/{job["id"]}/events',
+        }), 202, {'Location': f'/api/v1/jobs/{job["id"]}'}
+
+    logger.info('髪型合成開始', extra=app_logging.sampled(preset=hairstyle.label or '画像参照'))
+
+    return GenerationPlan(
+        '髪型生成', '生成', [gemini_pool.image_part(face.data), hairstyle.prompt], data,
+        hold=hold, cache_key=cache_key,
+    )
+
+
+# --- 一括生成API ---
+
+def batch_items(data):
+    """presets（presetId の文字列、または {presetId, colorId}）から生成する一覧を作る
+
+    入力の誤りは ValueError、登録外のプリセットは preset_registry.UnknownPresetError
+    同じ組み合わせは1回だけ生成・課金する
+    """
+    entries = data.get('presets')
+    if isinstance(entries, str):
+        # multipart では JSON 文字列かカンマ区切り
+        try:
+            entries = json.loads(entries)
+        except ValueError:
+            entries = [entry.strip() for entry in entries.split(',') if entry.strip()]
+
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('髪型を選択してください')
+    if len(entries) > BATCH_MAX_ITEMS:
+        raise ValueError(f'一度に生成できる髪型は{BATCH_MAX_ITEMS}件までです')
+
+    gender = data.get('gender', 'mens')
+    items = []
+    seen = set()
+    for index, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {'presetId': entry}
+        if not isinstance(entry, dict) or not entry.get('presetId'):
+            raise ValueError('presetId が必要です')
+        if not isinstance(entry['presetId'], str):
+            raise ValueError('presetId は文字列で指定してください')
+
+        hairstyle = preset_catalog.prompt_for(gender, entry['presetId'], entry.get('colorId'))
+        if hairstyle.prompt in seen:
+            continue
+        seen.add(hairstyle.prompt)
+        items.append({
+            'index': index,
+            'presetId': entry['presetId'],
+            'colorId': entry.get('colorId'),
+            'hairstyle': hairstyle,
+        })
+    return items
+
+
+def batch_hold_ttl(count):
+    """一括生成の予約の有効秒数（全件が Gemini の期限いっぱいかかり、他の一括生成の枠待ちがあっても切れないように）"""
+    rounds = -(-count // max(1, BATCH_USER_CONCURRENCY)) + 1
+    return max(credit_reservations.ttl, int(rounds * gemini_resilience.GEMINI_CALL_DEADLINE) + 30)
+
+
+@contextmanager
+def batch_user_slot(user_id):
+    """ユーザーごとの一括生成の同時実行枠（同じユーザーの全一括生成・全ワーカーで BATCH_USER_CONCURRENCY まで）
+
+    枠は Gemini 呼び出しの期限内に空くので、それまで待つ。期限を過ぎても空かなければ UpstreamOverloaded
+    枠の記録はレート制限と同じバックエンドに置く（障害時は枠なしで続ける）
+    """
+    key = f'batch:{user_id}'
+    ttl = gemini_resilience.GEMINI_CALL_DEADLINE + 30
+    deadline = time.monotonic() + gemini_resilience.GEMINI_CALL_DEADLINE
+    token = None
+    while True:
+        try:
+            token = request_limiter.acquire_slot(key, BATCH_USER_CONCURRENCY, ttl)
+        except Exception as e:
+            logger.warning('一括生成の同時実行枠エラー', extra={'error': str(e)})
+            break
+        if token:
+            break
+        if time.monotonic() >= deadline:
+            raise upstream_governor.UpstreamOverloaded(1)
+        time.sleep(BATCH_SLOT_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        if token:
+            try:
+                request_limiter.release_slot(key, token)
+            except Exception as e:
+                logger.warning('一括生成の同時実行枠エラー', extra={'error': str(e)})
+
+
+def generate_batch_item(user_id, face_jpeg, item):
+    """一括生成の1件（ワーカースレッドで実行）。(画像, テキスト) を返す
+
+    ユーザーごとの同時実行枠を取ってから、Gemini の実行枠を1件ずつ確保する
+    （混雑時は UpstreamOverloaded で、その1件だけ失敗する）
+    """
+    with batch_user_slot(user_id):
+        permit = upstream.acquire()
+        permit.start()
+        try:
+            response = gemini_pool.generate_image_content(
+                [gemini_pool.image_part(face_jpeg), item['hairstyle'].prompt],
+            )
+            image_data, response_text = gemini_pool.extract_image_and_text(response)
+        except Exception as e:
+            permit.finish(e)
+            raise
+        permit.finish()
+
+    # 届けられなかった結果（途中切断）も、次のリクエストでキャッシュから返せるように先に保存する
+    if image_data and generation_cache:
+        generation_cache.put(item['cache_key'], image_data, response_text)
+    return image_data, response_text
+
+
+def batch_item_line(item, result, status):
+    """NDJSON の1行（生成結果は JSON 形式と同じ data URL）"""
+    body = {'index': item['index'], 'presetId': item['presetId'], 'colorId': item['colorId'], 'status': status}
+    body.update(json_generation_body(result))
+    return json.dumps(body, ensure_ascii=False) + '\n'
+
+
+def batch_failure(error):
+    """1件分の例外を (結果, HTTPステータス) にする"""
+    if isinstance(error, upstream_governor.UpstreamOverloaded) or upstream_governor.is_overload_error(error):
+        return {'error': '混み合っています。しばらくしてから再度お試しください'}, 503
+    logger.error('一括髪型生成エラー', exc_info=error)
+    return {'error': f'生成エラー: {str(error)}'}, 500
+
+
+def stream_batch_generation(user_id, face_jpeg, cached_items, pending_items, hold):
+    """キャッシュ済み → 生成できた順に1行ずつ返し、最後に成功数で予約を確定する"""
+    succeeded = 0
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, min(BATCH_USER_CONCURRENCY, len(pending_items))), thread_name_prefix='batch',
+    )
+    futures = {}
+    try:
+        for item, cached in cached_items:
+            result, status = cached_generation_result(user_id, cached)
+            if status == 200:
+                succeeded += 1
+            yield batch_item_line(item, result, status)
+
+        for item in pending_items:
+            # ログ・トレースの文脈をワーカースレッドに引き継ぐ
+            context = contextvars.copy_context()
+            futures[executor.submit(context.run, generate_batch_item, user_id, face_jpeg, item)] = item
+
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                image_data, response_text = future.result()
+            except Exception as e:
+                result, status = batch_failure(e)
+            else:
+                if image_data:
+                    result, status = {'image': image_data, 'message': response_text}, 200
+                else:
+                    result, status = {
+                        'error': '画像生成に失敗しました',
+                        'message': response_text or '画像が生成されませんでした',
+                    }, 500
+            if status == 200:
+                succeeded += 1
+            yield batch_item_line(item, result, status)
+    finally:
+        # 途中で切断されても、生成済みの分は確定し、まだ始まっていない分は取り消す
+        executor.shutdown(wait=True, cancel_futures=True)
+        used = sum(
+            1 for future in futures
+            if future.done() and not future.cancelled() and future.exception() is None and future.result()[0]
+        )
+        remaining = None
+        if hold and used:
+            with metrics.stage_timer('credit_write'):
+                remaining = credit_reservations.commit(hold, used=used, reason='一括髪型生成')
+        elif hold:
+            credit_reservations.release(hold)
+
+    logger.info('一括髪型生成完了', extra=app_logging.sampled(items=len(cached_items) + len(pending_items), used=used))
+    yield json.dumps({
+        'done': True,
+        'succeeded': succeeded,
+        'failed': len(cached_items) + len(pending_items) - succeeded,
+        'credits': remaining if remaining is not None else get_user_credits(user_id),
+    }, ensure_ascii=False) + '\n'
+
+
+@app.route('/api/v1/vision/hairstyle/generate/batch', methods=['POST'])
+@require_auth
+@rate_limit
+@generation_errors('一括髪型生成', '生成')
+def generate_hairstyle_batch():
+    """1枚の顔写真から複数プリセットを生成し、できた順に NDJSON で返す
+
+    顔写真のデコード・正規化と認証は1回だけ、キャッシュにない件数分のクレジットをまとめて予約し、
+    成功した件数だけ確定する
+    """
+    data = request_fields()
+    if not data or 'face' not in data:
+        return jsonify({'error': '顔写真が必要です'}), 400
+
+    try:
+        items = batch_items(data)
+    except preset_registry.UnknownPresetError:
+        return unknown_preset_response()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    face = normalize_upload(decode_upload(data['face']))
+
+    cached_items = []
+    pending_items = []
+    for item in items:
+        item['cache_key'] = generation_cache_key(face.data, item['hairstyle'].prompt)
+        cached = lookup_cached_generation(item['cache_key'])
+        if cached:
+            cached_items.append((item, cached))
+        else:
+            pending_items.append(item)
 
+    hold = None
+    if pending_items:
         if not GEMINI_API_KEY:
-            return jsonify({'error': 'GEMINI_API_KEYが設定されていません'}), 500
+            return jsonify({'error': 'API未設定', 'message': 'GEMINI_API_KEYが設定されていません'}), 500
 
-        print("髪型調整中...")
+        # レート制限は Gemini を呼ぶ件数分数える（1件分はデコレータで数え済み）
+        if len(pending_items) > 1:
+            limited = check_rate_limits(cost=len(pending_items) - 1)
+            if limited:
+                return limited
 
-        from google import genai
-        from google.genai.types import GenerateContentConfig, Modality
+        # 全件分を1回で予約する（足りなければ1件も始めない）
+        try:
+            with metrics.stage_timer('credit_check'):
+                hold = credit_reservations.reserve(
+                    request.user_id, amount=len(pending_items), ttl=batch_hold_ttl(len(pending_items)),
+                )
+        except credit_holds.ReservationError as e:
+            return reservation_error_response(e)
 
-        client = genai.Client(api_key=GEMINI_API_KEY)
+    logger.info('一括髪型生成開始', extra=app_logging.sampled(items=len(items), cached=len(cached_items)))
+    return Response(
+        stream_with_context(stream_batch_generation(request.user_id, face.data, cached_items, pending_items, hold)),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
-        if 'base64,' in face_data:
-            face_data = face_data.split('base64,')[1]
-        face_bytes = base64.b64decode(face_data)
-        face_image = Image.open(io.BytesIO(face_bytes))
 
-        contents = [face_image]
-        if current_image_data:
-            if 'base64,' in current_image_data:
-                current_image_data = current_image_data.split('base64,')[1]
-            current_bytes = base64.b64decode(current_image_data)
-            current_image = Image.open(io.BytesIO(current_bytes))
-            contents.append(current_image)
+# --- 生成ジョブAPI ---
 
-        adj_parts = []
-        if adjustments.get('length'):
-            adj_parts.append(adjustments['length'])
-        if adjustments.get('color'):
-            adj_parts.append(adjustments['color'])
-        if adjustments.get('style'):
-            adj_parts.append(adjustments['style'])
+def get_own_job(job_id):
+    """ログインユーザー自身のジョブを取得（他人のジョブは見せない）"""
+    job = job_queue.store.get(job_id)
+    if not job or job['user_id'] != request.user_id:
+        return None
+    return job
 
-        adjustment_text = ', '.join(adj_parts) if adj_parts else ''
 
-        prompt = f"""1枚目は人物の顔写真、2枚目は現在の髪型画像です。
+@app.route('/api/v1/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_job(job_id):
+    """ジョブの状態と結果を取得（ポーリング用）"""
+    job = get_own_job(job_id)
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(jobs.public_job_view(job)), 200
+
+
+@app.route('/api/v1/jobs/<job_id>/events', methods=['GET'])
+@require_auth
+def get_job_events(job_id):
+    """ジョブの状態変化を Server-Sent Events で配信"""
+    job = get_own_job(job_id)
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+
+    return Response(
+        stream_with_context(jobs.stream_job_events(job_queue.store, job_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+def build_adjust_prompt(adjustments):
+    """調整内容から髪型調整プロンプトを組み立てる
+
+    長さ（lengthId）と髪色（colorId）は presets.json の id から指示を引く
+    旧クライアントの length / color（指示文そのもの）は登録済みの指示文なら id に読み替える
+    登録外・文字列以外の id / 指示文は preset_registry.UnknownPresetError、調整が何もなければ ValueError
+    """
+    length_id = adjustments.get('lengthId')
+    if length_id is None:
+        length_id = preset_catalog.legacy_adjust_id('length', adjustments.get('length'))
+    color_id = adjustments.get('colorId')
+    if color_id is None:
+        color_id = preset_catalog.legacy_adjust_id('color', adjustments.get('color'))
+
+    adj_parts = preset_catalog.adjust_prompts(length_id, color_id)
+    if isinstance(adjustments.get('style'), str) and adjustments['style']:
+        adj_parts.append(adjustments['style'])
+    if not adj_parts:
+        raise ValueError('調整項目を選択してください')
+
+    adjustment_text = ', '.join(adj_parts)
+
+    return f"""1枚目は人物の顔写真、2枚目は現在の髪型画像です。
 
 現在の髪型をベースに、以下の調整を加えた画像を生成してください:
 {adjustment_text}
@@ -648,48 +1566,56 @@ def adjust_hairstyle():
 - 自然で違和感のない仕上がりに
 - 画像を1枚生成してください"""
 
-        contents.append(prompt)
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-preview-05-20",
-            contents=contents,
-            config=GenerateContentConfig(
-                response_modalities=[Modality.TEXT, Modality.IMAGE]
-            ),
-        )
+@app.route('/api/v1/vision/hairstyle/adjust', methods=['POST'])
+def adjust_hairstyle():
+    """生成済み画像の髪型を調整"""
+    return run_generation_plan(begin_adjust_hairstyle())
 
-        generated_image_base64 = None
-        response_text = ""
 
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'text') and part.text:
-                response_text = part.text
-            elif hasattr(part, 'inline_data') and part.inline_data:
-                image_data = part.inline_data.data
-                generated_image_base64 = base64.b64encode(image_data).decode('utf-8')
+@require_auth
+@rate_limit
+@upstream_admission
+@generation_errors('髪型調整', '調整')
+def begin_adjust_hairstyle():
+    """髪型調整の前半（入力検証・画像正規化・クレジット予約）"""
+    data = request_fields()
+    if not data or 'face' not in data:
+        return jsonify({'error': '顔写真が必要です'}), 400
+
+    face_data = data['face']
+    current_image_data = data.get('currentImage')
+    adjustments = data.get('adjustments') or {}
+    if not isinstance(adjustments, dict):
+        return jsonify({'error': 'adjustments が不正です'}), 400
+    try:
+        adjust_prompt = build_adjust_prompt(adjustments)
+    except preset_registry.UnknownPresetError:
+        return unknown_preset_response()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        if not generated_image_base64:
-            return jsonify({
-                'error': '画像生成に失敗しました',
-                'message': response_text or '画像が生成されませんでした'
-            }), 500
+    face = normalize_upload(decode_upload(face_data))
+    current = normalize_upload(decode_upload(current_image_data)) if current_image_data else None
 
-        # クレジット消費
-        if not use_credit(request.user_id):
-            return jsonify({'error': 'クレジット不足'}), 402
+    if not GEMINI_API_KEY:
+        return jsonify({'error': 'GEMINI_API_KEYが設定されていません'}), 500
 
-        remaining_credits = get_user_credits(request.user_id)
-        print("髪型調整完了！")
+    # Gemini を呼ぶ前にクレジットを予約（成功で確定、失敗で解放）
+    try:
+        with metrics.stage_timer('credit_check'):
+            hold = credit_reservations.reserve(request.user_id)
+    except credit_holds.ReservationError as e:
+        return reservation_error_response(e)
 
-        return jsonify({
-            'generatedImage': f'data:image/png;base64,{generated_image_base64}',
-            'message': response_text,
-            'credits': remaining_credits
-        }), 200
+    logger.info('髪型調整開始', extra=app_logging.sampled())
 
-    except Exception as e:
-        print(f"髪型調整エラー: {e}")
-        return jsonify({'error': f'調整エラー: {str(e)}'}), 500
+    contents = [gemini_pool.image_part(face.data)]
+    if current:
+        contents.append(gemini_pool.image_part(current.data))
+    contents.append(adjust_prompt)
+
+    return GenerationPlan('髪型調整', '調整', contents, data, hold=hold)
 
 
 # --- Stripe課金API ---
@@ -708,33 +1634,34 @@ def create_checkout():
         plan = CREDIT_PLANS[plan_id]
         app_url = request.host_url.rstrip('/')
 
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'jpy',
-                    'product_data': {
-                        'name': f'Hair Style Simulator - {plan["name"]}',
-                        'description': f'{plan["credits"]}クレジット',
+        with tracing.span('stripe checkout.Session.create', kind='CLIENT', **{'stripe.plan': plan_id}):
+            session = stripe.checkout.Session.create(
+                payment_method_types=['card'],
+                line_items=[{
+                    'price_data': {
+                        'currency': 'jpy',
+                        'product_data': {
+                            'name': f'Hair Style Simulator - {plan["name"]}',
+                            'description': f'{plan["credits"]}クレジット',
+                        },
+                        'unit_amount': plan['price'],
                     },
-                    'unit_amount': plan['price'],
+                    'quantity': 1,
+                }],
+                mode='payment',
+                success_url=f'{app_url}/?payment=success&credits={plan["credits"]}',
+                cancel_url=f'{app_url}/?payment=cancel',
+                metadata={
+                    'user_id': request.user_id,
+                    'plan_id': plan_id,
+                    'credits': str(plan['credits']),
                 },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=f'{app_url}/?payment=success&credits={plan["credits"]}',
-            cancel_url=f'{app_url}/?payment=cancel',
-            metadata={
-                'user_id': request.user_id,
-                'plan_id': plan_id,
-                'credits': str(plan['credits']),
-            },
-        )
+            )
 
         return jsonify({'url': session.url}), 200
 
     except Exception as e:
-        print(f"Checkoutエラー: {e}")
+        logger.exception('Checkoutエラー')
         return jsonify({'error': str(e)}), 500
 
 
@@ -772,15 +1699,35 @@ def stripe_webhook():
                         'status': 'completed',
                     }).execute()
 
-                print(f"クレジット付与完了: user={user_id}, credits={credits}")
+                logger.info('クレジット付与完了', extra={'user': app_logging.user_hash(user_id), 'credits': credits})
 
         return jsonify({'received': True}), 200
 
     except Exception as e:
-        print(f"Webhookエラー: {e}")
+        logger.exception('Webhookエラー')
         return jsonify({'error': str(e)}), 400
 
 
+# --- メトリクス ---
+
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_export():
+    """Prometheus 形式のメトリクス"""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({'error': 'Not Found'}), 404
+    if metrics.METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {metrics.METRICS_TOKEN}'.encode('utf-8')):
+            return jsonify({'error': 'Unauthorized'}), 401
+    elif request.remote_addr not in LOOPBACK_ADDRESSES or request.headers.get('X-Forwarded-For'):
+        # トークン未設定なら同じホストからの直接のスクレイプだけ受け付ける（プロキシ経由の外部公開はしない）
+        return jsonify({'error': 'Unauthorized', 'message': 'METRICS_TOKEN を設定してください'}), 401
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 # --- ヘルスチェック ---
 
 @app.route('/health', methods=['GET'])
@@ -796,6 +1743,20 @@ def health_check():
             SUPABASE_ANON_KEY and SUPABASE_SERVICE_KEY and SUPABASE_ANON_KEY != SUPABASE_SERVICE_KEY
         ),
         'stripe_configured': bool(STRIPE_SECRET_KEY),
+        'gemini_pool': gemini_pool.pool_stats(),
+        'jobs': job_queue.stats(),
+        'result_cache': generation_cache.stats() if generation_cache else None,
+        'image_pipeline': image_pipeline.pipeline_stats(),
+        'rate_limiter': request_limiter.stats(),
+        'auth': token_verifier.stats(),
+        'credit_holds': credit_reservations.stats(),
+        'profile_cache': profiles_cache.stats() if profiles_cache else None,
+        'upstream': upstream.stats(),
+        'gemini_calls': gemini_pool.resilience_stats(),
+        'tracing': tracing.exporter.stats(),
+        'logging': app_logging.stats(),
+        'static_assets': static_files.stats(),
+        'presets': preset_catalog.stats(),
     }), 200
 
 
@@ -831,41 +1792,23 @@ def debug_auth():
     else:
         results['jwt'] = 'no_secret'
 
-    return jsonify(results), 200
-
+    try:
+        verified = token_verifier.verify_locally(token)
+        if verified is token_verifier.UNDECIDED:
+            results['local'] = 'undecided'
+        elif verified:
+            results['local'] = f'ok: {verified[0]}'
+        else:
+            results['local'] = 'invalid'
+    except Exception as e:
+        results['local'] = f'error: {str(e)}'
 
-# --- プリセット定義 ---
-
-HAIRSTYLE_PRESETS = {
-    'mens': [
-        {'id': 'none', 'name': 'なし', 'prompt': None},
-        {'id': 'short', 'name': 'ショート', 'prompt': '清潔感のある短髪、サイドすっきり、トップに軽い動き'},
-        {'id': 'twoblock', 'name': 'ツーブロック', 'prompt': 'サイドを刈り上げたツーブロック、トップは長めで流す'},
-        {'id': 'mash', 'name': 'マッシュ', 'prompt': '丸みのあるマッシュヘア、前髪重め、柔らかい印象'},
-        {'id': 'center', 'name': 'センターパート', 'prompt': 'センター分け、顔周りをフレーミング、韓国風'},
-        {'id': 'wolf', 'name': 'ウルフ', 'prompt': 'ウルフカット、襟足長め、レイヤー多め、動きのあるスタイル'},
-        {'id': 'perm', 'name': 'パーマ', 'prompt': 'ゆるめのパーマ、ナチュラルなウェーブ、こなれ感'},
-        {'id': 'long', 'name': 'ロング', 'prompt': '肩につく長さ、ナチュラルなストレート、清潔感'},
-    ],
-    'ladies': [
-        {'id': 'none', 'name': 'なし', 'prompt': None},
-        {'id': 'short', 'name': 'ショート', 'prompt': '耳が出るショートヘア、すっきりシルエット、女性らしい'},
-        {'id': 'bob', 'name': 'ボブ', 'prompt': 'あご下ラインのボブ、内巻き、清楚な印象'},
-        {'id': 'lob', 'name': 'ロブ', 'prompt': '肩につくロングボブ、外ハネ、こなれ感'},
-        {'id': 'medium', 'name': 'ミディアム', 'prompt': '鎖骨ラインのミディアム、レイヤー入り、ナチュラル'},
-        {'id': 'layer', 'name': 'レイヤー', 'prompt': 'たっぷりレイヤーの動きのあるスタイル、顔周りに軽さ'},
-        {'id': 'long', 'name': 'ロング', 'prompt': '胸下までのロングヘア、つやつやストレート、清楚'},
-        {'id': 'wave', 'name': 'ウェーブ', 'prompt': 'ゆるふわウェーブ、巻き髪、華やかな印象'},
-    ]
-}
+    return jsonify(results), 200
 
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     debug = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
+    log_startup_config()
     print(f"サーバーを起動しています: http://localhost:{port}")
-    print(f"Gemini API: {'設定済み' if GEMINI_API_KEY else '未設定'}")
-    print(f"Supabase Auth: {'設定済み' if is_auth_validation_configured() else '未設定'}")
-    print(f"Supabase DB: {'設定済み' if supabase_client else '未設定'}")
-    print(f"Stripe: {'設定済み' if STRIPE_SECRET_KEY else '未設定'}")
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,328 @@
+"""
+フロントエンドの静的ファイル配信
+起動時に frontend/ を走査してマニフェスト（内容ハッシュ・ETag・gzip / brotli の圧縮済みデータ）を作り、
+リクエストごとの処理はメモリ上の辞書引きと 304 判定だけにする
+- 許可した拡張子のファイルだけを配信する（.backup や隠しファイルは出さない）
+- HTML の src / href はハッシュ付きURL（style.<hash>.css）に書き換え、そのURLは1年キャッシュさせる
+- ハッシュなしURLは毎回ファイルの mtime / サイズを確認し、変わっていれば作り直す
+  （起動中に generate_presets.py などで書き換えられたプリセット画像・thumbnails.json を古いまま返さない）
+"""
+
+import os
+import re
+import gzip
+import hashlib
+import posixpath
+import threading
+
+from backend import app_logging
+
+logger = app_logging.get_logger('static_assets')
+
+# --- 静的ファイル設定 ---
+# これより小さいファイルは圧縮しない（ヘッダーの方が大きくなる）
+STATIC_COMPRESS_MIN_BYTES = int(os.environ.get('STATIC_COMPRESS_MIN_BYTES', '1024'))
+# これより大きいファイルはメモリに載せずディスクから返す
+STATIC_MEMORY_MAX_BYTES = int(os.environ.get('STATIC_MEMORY_MAX_BYTES', str(2 * 1024 * 1024)))
+# ハッシュなしURLのキャッシュ秒数（0 なら毎回 ETag で再検証させる）
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '0'))
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DIGEST_LENGTH = 10
+
+# 配信を許可する拡張子 → Content-Type
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.json': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+    '.ico': 'image/x-icon',
+    '.woff2': 'font/woff2',
+}
+# 圧縮が効く（画像・フォントは圧縮済み）
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.css', '.json', '.svg'}
+
+FINGERPRINT_PATTERN = re.compile(r'^(?P<stem>.+)\.(?P<digest>[0-9a-f]{%d})(?P<ext>\.[A-Za-z0-9]+)$' % DIGEST_LENGTH)
+# HTML 内のローカル参照（http: / data: / // / # で始まるものは対象外）
+REFERENCE_PATTERN = re.compile(r'''(?P<attr>\b(?:src|href))=(?P<quote>["'])(?P<url>(?![a-zA-Z][a-zA-Z0-9+.-]*:|//|#)[^"'?#]+)(?P=quote)''')
+
+
+def _brotli():
+    """brotli パッケージ（任意の依存。なければ gzip のみ）"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def is_allowed(path):
+    """配信してよいパスか（許可した拡張子のみ、隠しファイル・上位ディレクトリは不可）"""
+    parts = path.split('/')
+    if any(not part or part.startswith('.') or part == '..' for part in parts):
+        return False
+    return os.path.splitext(path)[1].lower() in CONTENT_TYPES
+
+
+def accepted_encodings(header):
+    """Accept-Encoding から q=0 以外のエンコーディングを取り出す"""
+    encodings = set()
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def etag_matches(header, etag):
+    """If-None-Match が etag を含むか（弱い比較）"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(candidate.strip().removeprefix('W/') == etag for candidate in header.split(','))
+
+
+class StaticAsset:
+    """1ファイル分のマニフェスト項目"""
+
+    __slots__ = (
+        'path', 'file_path', 'content_type', 'digest', 'size', 'body', 'variants', 'fingerprinted_path',
+        'source_stat', 'generation',
+    )
+
+    def __init__(self, path, file_path, content_type, data, source_stat=None, generation=0):
+        self.path = path
+        self.file_path = file_path
+        # 読み込んだときの (mtime_ns, サイズ)。変わったら作り直す
+        self.source_stat = source_stat
+        # HTML は作ったときのマニフェストの世代（参照先が作り直されたら書き換え直す）
+        self.generation = generation
+        self.content_type = content_type
+        self.digest = hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+        self.size = len(data)
+        # 大きいファイルはディスクから返す
+        self.body = data if len(data) <= STATIC_MEMORY_MAX_BYTES else None
+        # エンコーディング → 圧縮済みデータ（元より小さくなったものだけ）
+        self.variants = {}
+        stem, ext = posixpath.splitext(path)
+        self.fingerprinted_path = f'{stem}.{self.digest}{ext}'
+
+    def etag(self, encoding=None):
+        """表現ごとに異なる強い ETag"""
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+    def select(self, accept_encoding):
+        """(encoding, body) を返す。body が None ならディスクの file_path を返す"""
+        if self.variants:
+            accepted = accepted_encodings(accept_encoding)
+            for encoding in ('br', 'gzip'):
+                if encoding in accepted and encoding in self.variants:
+                    return encoding, self.variants[encoding]
+        return None, self.body
+
+
+class StaticAssets:
+    """frontend/ のマニフェスト（起動時に1回作り、preload ではワーカー間で共有する）"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._assets = {}
+        self._fingerprinted = {}
+        self._lock = threading.Lock()
+        # 起動後にファイルを作り直すたびに増える（HTML の書き換え直しの判定に使う）
+        self._generation = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'served': 0, 'not_modified': 0, 'compressed': 0, 'from_disk': 0, 'late_loaded': 0, 'reloaded': 0,
+        }
+
+    def build(self):
+        """ディレクトリを走査してマニフェストを作る（HTML は他のファイルのハッシュが出てから）"""
+        pages = []
+        for path in self._walk():
+            if path.endswith('.html'):
+                pages.append(path)
+            else:
+                self._add(path)
+        for path in pages:
+            self._add(path)
+
+        logger.info('静的ファイルのマニフェストを作成', extra=self.stats())
+        return self
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+            relative_root = os.path.relpath(root, self.directory).replace(os.sep, '/')
+            for name in sorted(files):
+                path = name if relative_root == '.' else f'{relative_root}/{name}'
+                if is_allowed(path):
+                    yield path
+
+    @staticmethod
+    def _stat(file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _add(self, path):
+        file_path = os.path.join(self.directory, *path.split('/'))
+        try:
+            with open(file_path, 'rb') as f:
+                source_stat = os.fstat(f.fileno())
+                data = f.read()
+        except OSError:
+            return None
+
+        ext = os.path.splitext(path)[1].lower()
+        generation = self._generation
+        if ext == '.html':
+            data = self._rewrite_references(path, data.decode('utf-8')).encode('utf-8')
+
+        asset = StaticAsset(
+            path, file_path, CONTENT_TYPES[ext], data,
+            source_stat=(source_stat.st_mtime_ns, source_stat.st_size), generation=generation,
+        )
+        if ext in COMPRESSIBLE_EXTENSIONS and len(data) >= STATIC_COMPRESS_MIN_BYTES and asset.body is not None:
+            self._compress(asset, data)
+
+        with self._lock:
+            previous = self._assets.get(path)
+            if previous is not None and previous.fingerprinted_path != asset.fingerprinted_path:
+                # 古いハッシュ付きURLは lookup の FINGERPRINT_PATTERN 経由で今の内容（短期キャッシュ）になる
+                self._fingerprinted.pop(previous.fingerprinted_path, None)
+                if ext != '.html':
+                    self._generation += 1
+            self._assets[path] = asset
+            self._fingerprinted[asset.fingerprinted_path] = asset
+        return asset
+
+    def _current(self, asset):
+        """ファイルが変わっていれば作り直した asset、消えていれば None"""
+        source_stat = self._stat(asset.file_path)
+        if source_stat is None:
+            with self._lock:
+                if self._assets.get(asset.path) is asset:
+                    del self._assets[asset.path]
+                    self._fingerprinted.pop(asset.fingerprinted_path, None)
+            return None
+        if source_stat == asset.source_stat and (
+            not asset.path.endswith('.html') or asset.generation == self._generation
+        ):
+            return asset
+
+        rebuilt = self._add(asset.path)
+        if rebuilt is not None:
+            self._count('reloaded')
+        return rebuilt
+
+    @staticmethod
+    def _compress(asset, data):
+        # mtime=0 で出力を固定する（ワーカー・再起動で同じバイト列になる）
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            asset.variants['gzip'] = compressed
+
+        brotli = _brotli()
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                asset.variants['br'] = compressed
+
+    def _rewrite_references(self, page_path, html):
+        """src / href のローカル参照をハッシュ付きURLに置き換える"""
+        page_dir = posixpath.dirname(page_path)
+
+        def replace(match):
+            url = match.group('url')
+            target = url.lstrip('/') if url.startswith('/') else posixpath.normpath(posixpath.join(page_dir, url))
+            asset = self._assets.get(target)
+            # ページ間のリンクはブックマークされるのでハッシュを付けない
+            if asset is None or target.endswith('.html'):
+                return match.group(0)
+            return f"{match.group('attr')}={match.group('quote')}/{asset.fingerprinted_path}{match.group('quote')}"
+
+        return REFERENCE_PATTERN.sub(replace, html)
+
+    def lookup(self, path):
+        """(asset, ハッシュ付きURLか) を返す。配信対象外は None"""
+        asset = self._fingerprinted.get(path)
+        if asset is not None:
+            return asset, True
+
+        asset = self._assets.get(path)
+        if asset is not None:
+            asset = self._current(asset)
+            return (asset, False) if asset is not None else None
+
+        # ハッシュが古い（デプロイ直後の HTML キャッシュなど）場合は今の内容を短期キャッシュで返す
+        match = FINGERPRINT_PATTERN.match(path)
+        if match:
+            asset = self._assets.get(match.group('stem') + match.group('ext'))
+            if asset is not None:
+                asset = self._current(asset)
+                return (asset, False) if asset is not None else None
+
+        # 起動後に追加されたファイル（プリセット画像の生成など）
+        if not is_allowed(path):
+            return None
+        asset = self._add(path)
+        if asset is None:
+            return None
+        self._count('late_loaded')
+        return asset, False
+
+    def cache_control(self, fingerprinted):
+        if fingerprinted:
+            return IMMUTABLE_CACHE_CONTROL
+        return f'public, max-age={STATIC_MAX_AGE}' if STATIC_MAX_AGE else 'no-cache'
+
+    def record(self, not_modified=False, encoding=None, from_disk=False):
+        with self._stats_lock:
+            self._stats['served'] += 1
+            if not_modified:
+                self._stats['not_modified'] += 1
+            if encoding:
+                self._stats['compressed'] += 1
+            if from_disk:
+                self._stats['from_disk'] += 1
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def url_for(self, path):
+        """ハッシュ付きURL（マニフェストにない場合はそのまま）"""
+        asset = self._assets.get(path.lstrip('/'))
+        return f'/{asset.fingerprinted_path}' if asset else path
+
+    def stats(self):
+        with self._lock:
+            assets = list(self._assets.values())
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            'assets': len(assets),
+            'memory_bytes': sum(
+                (asset.size if asset.body is not None else 0) + sum(len(v) for v in asset.variants.values())
+                for asset in assets
+            ),
+            'brotli': _brotli() is not None,
+        })
+        return stats
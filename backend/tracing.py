@@ -0,0 +1,288 @@
+"""
+リクエストトレース（OpenTelemetry 互換のスパンモデル）
+- W3C traceparent ヘッダーでトレースIDを受け取り、レスポンスにも traceparent / X-Trace-Id を返す
+- Supabase（table / rpc / auth）・Gemini・Stripe などの外部呼び出しは子スパンにする
+- スパンはバックグラウンドスレッドで JSONL ファイルまたは標準出力に書き出す（コレクター不要）
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import secrets
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from backend import app_logging
+
+logger = app_logging.get_logger('tracing')
+
+# --- トレース設定 ---
+# none / stdout / jsonl
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'none')
+TRACE_JSONL_PATH = os.environ.get('TRACE_JSONL_PATH', 'traces.jsonl')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'hairstyle-backend')
+TRACE_QUEUE_MAX = int(os.environ.get('TRACE_QUEUE_MAX', '10000'))
+
+_current_span = contextvars.ContextVar('hairstyle_current_span', default=None)
+
+
+def parse_traceparent(header):
+    """traceparent（00-<trace_id>-<span_id>-<flags>）を (trace_id, span_id, sampled) にする"""
+    if not header:
+        return None
+    parts = header.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Span:
+    """1つの処理区間（OpenTelemetry の Span と同じ項目を持つ）"""
+
+    def __init__(self, name, kind='INTERNAL', trace_id=None, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.status = 'UNSET'
+        self.status_message = ''
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.status = 'ERROR'
+        self.status_message = str(error)
+        self.attributes['exception.type'] = type(error).__name__
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if self.sampled:
+            exporter.export(self)
+
+    def to_dict(self):
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'durationMs': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'status': {'code': self.status, 'message': self.status_message},
+            'resource': {'service.name': TRACE_SERVICE_NAME, 'process.pid': os.getpid()},
+        }
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def start_span(name, kind='INTERNAL', attributes=None, traceparent=None):
+    """現在のスパン（なければ traceparent、どちらもなければ新しいトレース）の子としてスパンを作る"""
+    parent = _current_span.get()
+    if parent is not None:
+        return Span(name, kind, parent.trace_id, parent.span_id, parent.sampled, attributes)
+
+    remote = parse_traceparent(traceparent)
+    if remote:
+        trace_id, parent_id, sampled = remote
+        return Span(name, kind, trace_id, parent_id, sampled, attributes)
+    return Span(name, kind, sampled=random.random() < TRACE_SAMPLE_RATE, attributes=attributes)
+
+
+def activate(span):
+    """span を現在のスパンにする（戻り値のトークンを deactivate に渡して戻す）"""
+    return _current_span.set(span)
+
+
+def deactivate(token):
+    _current_span.reset(token)
+
+
+@contextmanager
+def span(name, kind='INTERNAL', **attributes):
+    """with tracing.span('gemini generate_content', kind='CLIENT'): ..."""
+    current = start_span(name, kind, attributes)
+    token = activate(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        deactivate(token)
+        current.end()
+
+
+def wrap_context(fn):
+    """別スレッドで実行する関数に現在のトレースを引き継ぐ"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(fn, *args, **kwargs)
+    return run
+
+
+# --- 書き出し ---
+
+class SpanExporter:
+    """終了したスパンをキューに積み、バックグラウンドスレッドでまとめて書き出す"""
+
+    BATCH_SIZE = 256
+
+    def __init__(self, kind=TRACE_EXPORTER, path=TRACE_JSONL_PATH, max_queue=TRACE_QUEUE_MAX):
+        self.kind = kind
+        self.path = path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer_pid = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, span):
+        if self.kind == 'none':
+            return
+        self._start_writer()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # リクエストを待たせないよう、溢れた分は捨てる
+            self.dropped += 1
+
+    def _start_writer(self):
+        pid = os.getpid()
+        if self._writer_pid == pid:
+            return
+        with self._lock:
+            if self._writer_pid == pid:
+                return
+            self._writer_pid = pid
+            threading.Thread(target=self._write_loop, name='trace-exporter', daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = ''.join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n' for span in batch)
+            try:
+                if self.kind == 'jsonl':
+                    with open(self.path, 'a', encoding='utf-8') as f:
+                        f.write(lines)
+                else:
+                    print(lines, end='', flush=True)
+                self.exported += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.warning('トレース書き出しエラー', extra={'error': str(e)})
+
+    def stats(self):
+        return {
+            'exporter': self.kind,
+            'sample_rate': TRACE_SAMPLE_RATE,
+            'queued': self._queue.qsize(),
+            'exported': self.exported,
+            'dropped': self.dropped,
+        }
+
+
+exporter = SpanExporter()
+
+
+# --- Supabase クライアントの計装 ---
+
+SUPABASE_OPERATIONS = ('select', 'insert', 'update', 'upsert', 'delete')
+
+
+class _TracedQuery:
+    """postgrest のクエリビルダーを包み、execute() を子スパンにする"""
+
+    def __init__(self, target, name, attributes):
+        self._target = target
+        self._name = name
+        self._attributes = attributes
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        if attr == 'execute':
+            def execute(*args, **kwargs):
+                with span(self._name, kind='CLIENT', **self._attributes):
+                    return value(*args, **kwargs)
+            return execute
+
+        def chain(*args, **kwargs):
+            result = value(*args, **kwargs)
+            attributes = self._attributes
+            if attr in SUPABASE_OPERATIONS:
+                attributes = {**attributes, 'db.operation': attr}
+            return _TracedQuery(result, self._name, attributes)
+        return chain
+
+
+class _TracedAuth:
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with span(f'supabase auth.{attr}', kind='CLIENT', **{'db.system': 'supabase'}):
+                return value(*args, **kwargs)
+        return call
+
+
+class TracedSupabase:
+    """Supabase クライアントの table / rpc / auth を子スパン付きにするラッパー"""
+
+    def __init__(self, client):
+        self._client = client
+        self.auth = _TracedAuth(client.auth)
+
+    def table(self, name):
+        attributes = {'db.system': 'supabase', 'db.sql.table': name}
+        return _TracedQuery(self._client.table(name), f'supabase table {name}', attributes)
+
+    def rpc(self, fn, params=None, *args, **kwargs):
+        attributes = {'db.system': 'supabase', 'db.operation': 'rpc', 'db.function': fn}
+        return _TracedQuery(self._client.rpc(fn, params or {}, *args, **kwargs), f'supabase rpc {fn}', attributes)
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
@@ -0,0 +1,254 @@
+"""
+Gemini 呼び出しの同時実行数ガバナー
+上限は AIMD（成功で少しずつ増やし、429/503 や遅延で半減に近く減らす）で調整する
+枠が空くまでの待ち行列は長さと待ち時間に上限があり、間に合わない見込みなら即座に断る
+"""
+
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+
+# --- 同時実行ガバナー設定（ワーカープロセスごと） ---
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '16'))
+GEMINI_MIN_CONCURRENCY = int(os.environ.get('GEMINI_MIN_CONCURRENCY', '2'))
+GEMINI_QUEUE_MAX = int(os.environ.get('GEMINI_QUEUE_MAX', '32'))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get('GEMINI_QUEUE_TIMEOUT', '10'))
+# この秒数を超える応答は混雑の兆候として扱う
+GEMINI_LATENCY_THRESHOLD = float(os.environ.get('GEMINI_LATENCY_THRESHOLD', '45'))
+
+OVERLOAD_STATUS_CODES = (429, 503)
+OVERLOAD_STATUS_NAMES = ('RESOURCE_EXHAUSTED', 'UNAVAILABLE')
+
+
+class UpstreamOverloaded(Exception):
+    """混雑のため受け付けなかった（retry_after 秒後に再試行してほしい）"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'upstream overloaded (retry after {retry_after}s)')
+        self.retry_after = retry_after
+
+
+def is_overload_error(error):
+    """Gemini の 429 / 503（レート制限・過負荷）か"""
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if code in OVERLOAD_STATUS_CODES:
+        return True
+    message = str(error)
+    return any(name in message for name in OVERLOAD_STATUS_NAMES)
+
+
+class _Waiter:
+    __slots__ = ('wake', 'granted')
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class UpstreamPermit:
+    """確保した実行枠。Gemini 呼び出しの前に start、終わったら finish（使わなければ cancel）"""
+
+    def __init__(self, governor):
+        self.governor = governor
+        self.started_at = None
+        self._done = False
+
+    def start(self):
+        self.started_at = time.monotonic()
+
+    def finish(self, error=None):
+        if self._done:
+            return
+        self._done = True
+        latency = time.monotonic() - self.started_at if self.started_at is not None else None
+        self.governor._on_finish(latency, error)
+
+    def cancel(self):
+        if self._done:
+            return
+        self._done = True
+        self.governor._on_finish(None, None)
+
+
+class UpstreamGovernor:
+    """AIMD で上限が変わるセマフォ + 期限付き FIFO 待ち行列"""
+
+    INCREASE_STEP = 1.0
+    DECREASE_FACTOR = 0.7
+    # 1回の混雑で連続して減らしすぎないための間隔
+    DECREASE_COOLDOWN = 5.0
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, max_limit=GEMINI_MAX_CONCURRENCY, min_limit=GEMINI_MIN_CONCURRENCY,
+                 max_queue=GEMINI_QUEUE_MAX, queue_timeout=GEMINI_QUEUE_TIMEOUT,
+                 latency_threshold=GEMINI_LATENCY_THRESHOLD):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_threshold = latency_threshold
+        self.limit = float(self.max_limit)
+        self._in_flight = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._last_decrease = 0.0
+        self._avg_latency = None
+        self.counters = {'admitted': 0, 'queued': 0, 'shed': 0, 'timeouts': 0, 'overloaded': 0, 'slow': 0}
+
+    # --- 枠の確保 ---
+
+    def _capacity(self):
+        return max(1, int(self.limit))
+
+    def _expected_wait(self, position):
+        """待ち行列の position 番目が枠を得るまでの見込み秒数"""
+        latency = self._avg_latency or self.latency_threshold / 2
+        return latency * position / self._capacity()
+
+    def retry_after(self):
+        with self._lock:
+            return max(1, math.ceil(self._expected_wait(len(self._waiters) + 1)))
+
+    def _try_admit(self, shed, timeout):
+        """すぐ入れれば permit、待つなら _Waiter を作る準備として None、断るなら例外"""
+        if self._in_flight < self._capacity() and not self._waiters:
+            self._in_flight += 1
+            self.counters['admitted'] += 1
+            return UpstreamPermit(self)
+
+        if shed:
+            position = len(self._waiters) + 1
+            expected = self._expected_wait(position)
+            if len(self._waiters) >= self.max_queue or (timeout is not None and expected > timeout):
+                self.counters['shed'] += 1
+                raise UpstreamOverloaded(max(1, math.ceil(expected)))
+        return None
+
+    def _abandon(self, waiter):
+        """待ちを諦める。直前に枠を渡されていたら permit を返す"""
+        with self._lock:
+            if waiter.granted:
+                return UpstreamPermit(self)
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            self.counters['timeouts'] += 1
+            retry_after = max(1, math.ceil(self._expected_wait(len(self._waiters) + 1)))
+        raise UpstreamOverloaded(retry_after)
+
+    def _withdraw(self, waiter):
+        """キャンセルされた待ちを取り消す。直前に枠を渡されていたらその枠を返す"""
+        with self._lock:
+            granted = waiter.granted
+            if not granted:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        if granted:
+            self._on_finish(None, None)
+
+    def acquire(self, timeout=None, shed=True):
+        """枠を確保して permit を返す（混雑時は UpstreamOverloaded）
+
+        shed=False は既に別の待ち行列を通ってきた処理（ジョブワーカー）用で、枠が空くまで待つ
+        """
+        if timeout is None and shed:
+            timeout = self.queue_timeout
+
+        event = threading.Event()
+        with self._lock:
+            permit = self._try_admit(shed, timeout)
+            if permit:
+                return permit
+            waiter = _Waiter(event.set)
+            self._waiters.append(waiter)
+            self.counters['queued'] += 1
+
+        if event.wait(timeout if shed else None):
+            return UpstreamPermit(self)
+        return self._abandon(waiter)
+
+    async def acquire_async(self, timeout=None):
+        """acquire の asyncio 版（待っている間もイベントループを止めない）"""
+        if timeout is None:
+            timeout = self.queue_timeout
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            permit = self._try_admit(True, timeout)
+            if permit:
+                return permit
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+            self.counters['queued'] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return self._abandon(waiter)
+        except asyncio.CancelledError:
+            # 切断・シャットダウンで待ちごと取り消された（待ち行列に残すと枠が戻らなくなる）
+            self._withdraw(waiter)
+            raise
+        return UpstreamPermit(self)
+
+    # --- 結果のフィードバック ---
+
+    def _on_finish(self, latency, error):
+        now = time.monotonic()
+        with self._lock:
+            self._in_flight -= 1
+
+            if error is not None and is_overload_error(error):
+                self.counters['overloaded'] += 1
+                self._decrease(now)
+            elif error is None and latency is not None:
+                if self._avg_latency is None:
+                    self._avg_latency = latency
+                else:
+                    self._avg_latency += self.LATENCY_SMOOTHING * (latency - self._avg_latency)
+
+                if latency > self.latency_threshold:
+                    self.counters['slow'] += 1
+                    self._decrease(now)
+                else:
+                    # 上限1つ分の呼び出しが成功するごとに +1（加算的増加）
+                    self.limit = min(float(self.max_limit), self.limit + self.INCREASE_STEP / self.limit)
+
+            to_wake = []
+            while self._waiters and self._in_flight < self._capacity():
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self._in_flight += 1
+                self.counters['admitted'] += 1
+                to_wake.append(waiter)
+
+        for waiter in to_wake:
+            waiter.wake()
+
+    def _decrease(self, now):
+        if now - self._last_decrease < self.DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * self.DECREASE_FACTOR)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': round(self.limit, 2),
+                'max_limit': self.max_limit,
+                'in_flight': self._in_flight,
+                'waiting': len(self._waiters),
+                'avg_latency': round(self._avg_latency, 3) if self._avg_latency is not None else None,
+                **self.counters,
+            }
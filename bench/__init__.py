@@ -0,0 +1 @@
+"""負荷試験・マイクロベンチマーク（本番のイメージには含めない）"""
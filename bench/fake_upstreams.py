@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用の偽 Gemini / Supabase サーバー
+- Gemini: generateContent（REST の応答形式そのまま、画像は inlineData の PNG）
+- Supabase: profiles / credit_history / purchases のテーブル、クレジット系 RPC、auth/v1/user と JWKS
+遅延とエラー率を指定できる。標準ライブラリのみで動く
+
+python -m bench.fake_upstreams --gemini-port 9001 --supabase-port 9002 --gemini-latency 8
+"""
+
+import json
+import time
+import uuid
+import zlib
+import base64
+import random
+import struct
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 予約・確定で減らしても尽きない残高
+FAKE_CREDITS = 10 ** 9
+
+
+def make_png(size, seed=0):
+    """size x size のノイズ画像（圧縮が効かず、実際の生成画像に近いバイト数になる）"""
+    rng = random.Random(seed)
+    row_bytes = size * 3
+    raw = b''.join(b'\x00' + rng.randbytes(row_bytes) for _ in range(size))
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b'')
+
+
+class Behavior:
+    """応答の遅延とエラー（平均 latency 秒、±jitter の割合でばらつかせる）"""
+
+    def __init__(self, latency=0.0, jitter=0.2, error_rate=0.0, error_status=503):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def delay(self):
+        if self.latency <= 0:
+            return
+        spread = self.latency * self.jitter
+        time.sleep(max(0.0, random.uniform(self.latency - spread, self.latency + spread)))
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeUpstream/1.0'
+
+    def log_message(self, format, *args):
+        # 負荷試験中の大量のアクセスログは出さない
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def count(self, name):
+        with self.server.stats_lock:
+            self.server.stats[name] = self.server.stats.get(name, 0) + 1
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            with self.server.stats_lock:
+                return self.send_json(200, dict(self.server.stats))
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def handle_request(self, method):
+        self.send_json(404, {'error': 'not found'})
+
+
+# --- Gemini ---
+
+class FakeGeminiHandler(FakeHandler):
+    """POST /{version}/models/{model}:generateContent"""
+
+    def handle_request(self, method):
+        path = urlparse(self.path).path
+        if method != 'POST' or not path.endswith(':generateContent'):
+            return self.send_json(404, {'error': {'code': 404, 'message': 'not found', 'status': 'NOT_FOUND'}})
+
+        self.read_json()
+        self.count('requests')
+        behavior = self.server.behavior
+        behavior.delay()
+
+        if behavior.should_fail():
+            self.count('errors')
+            status = behavior.error_status
+            name = 'RESOURCE_EXHAUSTED' if status == 429 else 'UNAVAILABLE'
+            return self.send_json(status, {'error': {'code': status, 'message': 'fake overload', 'status': name}})
+
+        model = path.rsplit('/', 1)[-1].split(':', 1)[0]
+        self.send_json(200, {
+            'candidates': [{
+                'content': {
+                    'role': 'model',
+                    'parts': [
+                        {'text': '髪型を変更しました（ベンチマーク用の応答）'},
+                        {'inlineData': {'mimeType': 'image/png', 'data': self.server.image_b64}},
+                    ],
+                },
+                'finishReason': 'STOP',
+                'index': 0,
+            }],
+            'usageMetadata': {'promptTokenCount': 1290, 'candidatesTokenCount': 1290, 'totalTokenCount': 2580},
+            'modelVersion': model,
+        })
+
+
+# --- Supabase ---
+
+class FakeSupabaseState:
+    """profiles / credit_holds をメモリに持つ"""
+
+    def __init__(self):
+        self.profiles = {}
+        self.holds = {}
+        self.lock = threading.Lock()
+
+    def profile(self, user_id):
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            profile = self.profiles[user_id] = {
+                'id': user_id, 'email': f'{user_id[:8]}@bench.local', 'display_name': 'bench',
+                'avatar_url': '', 'credits': FAKE_CREDITS, 'total_generations': 0,
+                'stripe_customer_id': None, 'is_premium': False, 'premium_expires_at': None,
+            }
+        return profile
+
+    def rpc(self, name, params):
+        with self.lock:
+            if name == 'reserve_credits':
+                hold_id = str(uuid.uuid4())
+                self.holds[hold_id] = (params['p_user_id'], params.get('p_amount', 1))
+                credits = self.profile(params['p_user_id'])['credits']
+                return [{'ok': True, 'hold_id': hold_id, 'available': credits, 'premium': False, 'reason': None}]
+            if name == 'commit_credit_hold':
+                hold = self.holds.pop(params['p_hold_id'], None)
+                if hold is None:
+                    return [{'ok': False, 'remaining': None}]
+                user_id, amount = hold
+                used = params.get('p_used')
+                profile = self.profile(user_id)
+                profile['credits'] -= amount if used is None else min(used, amount)
+                profile['total_generations'] += amount if used is None else used
+                return [{'ok': True, 'remaining': profile['credits']}]
+            if name == 'release_credit_hold':
+                return self.holds.pop(params['p_hold_id'], None) is not None
+            if name == 'expire_credit_holds':
+                return 0
+            if name == 'consume_credit':
+                profile = self.profile(params['p_user_id'])
+                profile['credits'] -= 1
+                profile['total_generations'] += 1
+                return [{'ok': True, 'remaining': profile['credits'], 'premium': False}]
+            if name == 'grant_credits':
+                profile = self.profile(params['p_user_id'])
+                profile['credits'] += params['p_amount']
+                return profile['credits']
+            if name == 'increment_generations':
+                return None
+        raise KeyError(name)
+
+
+def _filter_value(query, column):
+    """postgrest の ?id=eq.<value> から値を取り出す"""
+    values = query.get(column)
+    if values and values[0].startswith('eq.'):
+        return values[0][3:]
+    return None
+
+
+def _token_subject(token):
+    """署名は検証せずに JWT の sub を読む"""
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))).get('sub')
+    except (IndexError, ValueError):
+        return None
+
+
+class FakeSupabaseHandler(FakeHandler):
+    """/rest/v1/<table>、/rest/v1/rpc/<fn>、/auth/v1/user、/auth/v1/.well-known/jwks.json"""
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.read_json() if method != 'GET' else None
+        behavior = self.server.behavior
+        state = self.server.state
+
+        if url.path == '/auth/v1/.well-known/jwks.json':
+            return self.send_json(200, {'keys': []})
+
+        self.count('requests')
+        behavior.delay()
+        if behavior.should_fail():
+            self.count('errors')
+            return self.send_json(behavior.error_status, {'message': 'fake outage', 'code': 'PGRST000'})
+
+        if url.path == '/auth/v1/user':
+            user_id = _token_subject(self.headers.get('Authorization', '').replace('Bearer ', ''))
+            if not user_id:
+                return self.send_json(401, {'msg': 'invalid JWT'})
+            return self.send_json(200, {'id': user_id, 'aud': 'authenticated', 'role': 'authenticated'})
+
+        if url.path.startswith('/rest/v1/rpc/'):
+            name = url.path.rsplit('/', 1)[-1]
+            try:
+                return self.send_json(200, state.rpc(name, body or {}))
+            except KeyError:
+                return self.send_json(404, {'message': f'Could not find the function public.{name}', 'code': 'PGRST202'})
+
+        if url.path.startswith('/rest/v1/'):
+            table = url.path.rsplit('/', 1)[-1]
+            rows = body if isinstance(body, list) else [body] if body else []
+            if table != 'profiles':
+                return self.send_json(201, rows)
+            user_id = _filter_value(query, 'id')
+            with state.lock:
+                if method == 'GET':
+                    return self.send_json(200, [dict(state.profile(user_id))] if user_id else [])
+                if method == 'PATCH' and user_id:
+                    state.profile(user_id).update(body or {})
+                    return self.send_json(200, [dict(state.profile(user_id))])
+                created = []
+                for row in rows:
+                    profile = state.profile(row['id'])
+                    profile.update(row)
+                    created.append(dict(profile))
+                return self.send_json(201, created)
+
+        self.send_json(404, {'message': 'not found'})
+
+
+# --- 起動 ---
+
+def start_server(handler, port, behavior, host='127.0.0.1', **attributes):
+    """バックグラウンドスレッドでサーバーを起動して (server, base_url) を返す"""
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.behavior = behavior
+    server.stats = {}
+    server.stats_lock = threading.Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, name=f'{handler.__name__}', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def start_fake_gemini(port=0, latency=0.0, jitter=0.2, error_rate=0.0, error_status=503, image_size=1024):
+    image = make_png(image_size)
+    return start_server(
+        FakeGeminiHandler, port, Behavior(latency, jitter, error_rate, error_status),
+        image_b64=base64.b64encode(image).decode('ascii'),
+    )
+
+
+def start_fake_supabase(port=0, latency=0.0, jitter=0.2, error_rate=0.0):
+    return start_server(FakeSupabaseHandler, port, Behavior(latency, jitter, error_rate, 503), state=FakeSupabaseState())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用の偽 Gemini / Supabase サーバー')
+    parser.add_argument('--gemini-port', type=int, default=9001)
+    parser.add_argument('--supabase-port', type=int, default=9002)
+    parser.add_argument('--gemini-latency', type=float, default=8.0, help='generateContent の平均応答秒数')
+    parser.add_argument('--gemini-jitter', type=float, default=0.2)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-error-status', type=int, default=503, choices=(429, 500, 503))
+    parser.add_argument('--image-size', type=int, default=1024, help='返す PNG の一辺のピクセル数')
+    parser.add_argument('--supabase-latency', type=float, default=0.03)
+    parser.add_argument('--supabase-error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    _, gemini_url = start_fake_gemini(
+        args.gemini_port, args.gemini_latency, args.gemini_jitter, args.gemini_error_rate,
+        args.gemini_error_status, args.image_size,
+    )
+    _, supabase_url = start_fake_supabase(args.supabase_port, args.supabase_latency, 0.2, args.supabase_error_rate)
+    print(f"GEMINI_BASE_URL={gemini_url}")
+    print(f"SUPABASE_URL={supabase_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
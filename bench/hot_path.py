@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+リクエストのホットパス（Gemini 呼び出し以外の CPU 処理）のマイクロベンチマーク
+- アップロード: サイズ判定 → Base64 デコード → 正規化（EXIF 回転・縮小・JPEG 再エンコード）
+- 生成結果: data URL の JSON 化、WEBP 変換
+0.5MB〜10MB の JPEG / PNG / HEIC から変換した JPEG（iPhone の 4:3・EXIF 回転付き）で測り、
+所要時間と Python ヒープのピーク（tracemalloc）、RSS のピーク（Linux のみ）を JSON に保存する
+RSS は段階ごとに新しいプロセスで1回だけ実行して測る（ウォームアップ後は Pillow のブロックキャッシュや
+malloc のアリーナが確保済みで、増分が 0 になるため）
+
+python -m bench.hot_path --sizes 0.5,2,5,10 --formats jpeg,png,heic
+python -m bench.hot_path --compare bench/results/hot_path-<前回>.json
+"""
+
+import gc
+import io
+import os
+import sys
+import json
+import time
+import base64
+import ctypes
+import argparse
+import subprocess
+import statistics
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from PIL import Image
+
+from backend import image_pipeline
+from bench import report as bench_report
+
+# server.MAX_IMAGE_SIZE_BYTES と同じ
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+MEGABYTE = 1000 * 1000
+# EXIF の Orientation（6: 時計回りに90度回転して表示）
+EXIF_ORIENTATION = 0x0112
+
+FORMATS = {
+    'jpeg': {'format': 'JPEG', 'mime_type': 'image/jpeg', 'aspect': 1.0, 'save': {'quality': 90}},
+    'png': {'format': 'PNG', 'mime_type': 'image/png', 'aspect': 1.0, 'save': {'compress_level': 6}},
+    # HEIC を端末側で JPEG に変換したもの（4:3、高画質、回転は EXIF で指定）
+    'heic': {'format': 'JPEG', 'mime_type': 'image/jpeg', 'aspect': 4 / 3, 'save': {'quality': 95}, 'rotate': 6},
+}
+
+
+# --- テスト画像 ---
+
+def photo_like(width, height, seed=0):
+    """写真に近い圧縮率になる、グラデーションにノイズを重ねた画像"""
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed)
+    channels = [Image.blend(gradient, noise, alpha) for alpha in (0.25, 0.35, 0.45)]
+    return Image.merge('RGB', channels)
+
+
+def encode(image, spec):
+    buffer = io.BytesIO()
+    options = dict(spec['save'])
+    if spec.get('rotate'):
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION] = spec['rotate']
+        options['exif'] = exif
+    image.save(buffer, spec['format'], **options)
+    return buffer.getvalue()
+
+
+def make_upload(format_name, target_bytes):
+    """target_bytes 前後のサイズになるよう辺の長さを調整した画像を作る"""
+    spec = FORMATS[format_name]
+    height = 1024
+    data = b''
+    for _ in range(4):
+        width = int(height * spec['aspect'])
+        data = encode(photo_like(width, height), spec)
+        if abs(len(data) - target_bytes) / target_bytes < 0.1:
+            break
+        height = max(64, int(height * (target_bytes / len(data)) ** 0.5))
+    return data, (width, height)
+
+
+def make_generated_png(size):
+    """Gemini が返す生成画像の代わり"""
+    buffer = io.BytesIO()
+    photo_like(size, size, seed=3).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+# --- 計測 ---
+
+def peak_rss_reset():
+    """RSS のピーク値（VmHWM）を現在値に戻す。Linux 以外では False"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_bytes(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes():
+    return _proc_status_bytes('VmHWM')
+
+
+def current_rss_bytes():
+    return _proc_status_bytes('VmRSS')
+
+
+def _release_free_memory():
+    """解放済みのヒープを OS に返す（glibc のみ。測定前の RSS を下げる）"""
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def cold_run(case):
+    """子プロセス側: case（kind:arg:stage）を1回だけ実行し、RSS の増分ピークを出力する"""
+    kind, arg, stage = case.split(':')
+    # 画素バッファを使い回させない（親プロセスで温まったキャッシュと同じ状態を避ける）
+    Image.core.set_blocks_max(0)
+    if kind == 'upload':
+        format_name, size_mb = arg.split('@')
+        _, stages = upload_cases(format_name, float(size_mb))
+    else:
+        _, stages = result_cases(int(arg))
+    fn = stages[stage]
+
+    gc.collect()
+    _release_free_memory()
+    rss_before = current_rss_bytes() if peak_rss_reset() else None
+    fn()
+    rss_peak = peak_rss_bytes() if rss_before is not None else None
+    print(json.dumps({'rss_growth_bytes': rss_peak - rss_before if rss_peak is not None else None}))
+
+
+def cold_rss_growth(case):
+    """新しいプロセスで case を1回実行したときの RSS の増分ピーク（測れなければ None）"""
+    completed = subprocess.run(
+        [sys.executable, '-m', 'bench.hot_path', '--cold-run', case],
+        cwd=BASE_DIR, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        print(f'{case}: RSS 計測エラー\n{completed.stderr}', file=sys.stderr)
+        return None
+    return json.loads(completed.stdout.strip().splitlines()[-1])['rss_growth_bytes']
+
+
+def measure(fn, repeat, cold_case=None):
+    """repeat 回の所要時間と、1回分のメモリピーク
+
+    Python ヒープのピークはこのプロセスで、RSS のピークは cold_case を新しいプロセスで実行して測る
+    """
+    fn()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'min_ms': round(timings[0], 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'heap_peak_bytes': heap_peak,
+        # PIL の画素バッファは tracemalloc に載らないので RSS でも見る（新しいプロセスでの1回目）
+        'rss_growth_bytes': cold_rss_growth(cold_case) if cold_case else None,
+    }
+
+
+def upload_cases(format_name, size_mb):
+    raw, dimensions = make_upload(format_name, int(size_mb * MEGABYTE))
+    payload = f"data:{FORMATS[format_name]['mime_type']};base64,{base64.b64encode(raw).decode('ascii')}"
+    decoded = image_pipeline.decode_base64_image(payload, UPLOAD_MAX_BYTES)
+
+    def full_request():
+        image_pipeline.normalize_image(image_pipeline.decode_base64_image(payload, UPLOAD_MAX_BYTES))
+
+    fixture = {'format': format_name, 'bytes': len(raw), 'width': dimensions[0], 'height': dimensions[1]}
+    return fixture, {
+        'size_check': lambda: image_pipeline.encoded_image_size(payload),
+        'decode': lambda: image_pipeline.decode_base64_image(payload, UPLOAD_MAX_BYTES),
+        'normalize': lambda: image_pipeline.normalize_image(decoded),
+        'decode_normalize': full_request,
+    }
+
+
+def result_cases(size):
+    generated = make_generated_png(size)
+
+    def encode_json():
+        # server.json_generation_body + jsonify と同じ処理
+        body = {'message': '髪型を変更しました', 'credits': 10}
+        body['generatedImage'] = f"data:image/png;base64,{base64.b64encode(generated).decode('utf-8')}"
+        return json.dumps(body)
+
+    fixture = {'format': 'png', 'bytes': len(generated), 'width': size, 'height': size}
+    return fixture, {
+        'encode_json': encode_json,
+        'convert_webp': lambda: image_pipeline.convert_image(generated, 'WEBP'),
+    }
+
+
+def print_case(name, fixture, stage, result):
+    rss = result['rss_growth_bytes']
+    print(
+        f"{name:<24} {stage:<17} median={result['median_ms']:>9.2f}ms p95={result['p95_ms']:>9.2f}ms "
+        f"heap={result['heap_peak_bytes'] / MEGABYTE:>6.1f}MB "
+        f"rss={'-' if rss is None else f'{rss / MEGABYTE:.1f}MB'}",
+        flush=True,
+    )
+
+
+def compare(baseline_path, current):
+    """同じケース・段階の中央値とメモリピークを前回の結果と比べる"""
+    baseline = bench_report.load_report(baseline_path)
+    previous = {(row['case'], row['stage']): row for row in baseline['results']}
+
+    print(f"\n比較: {baseline['meta']['revision']} → {current['meta']['revision']}")
+    for row in current['results']:
+        before = previous.get((row['case'], row['stage']))
+        if not before:
+            continue
+        time_delta = bench_report.percent_change(row['median_ms'], before['median_ms']) or 0.0
+        heap_delta = bench_report.percent_change(row['heap_peak_bytes'], before['heap_peak_bytes']) or 0.0
+        rss_delta = bench_report.percent_change(row.get('rss_growth_bytes'), before.get('rss_growth_bytes'))
+        rss = '' if rss_delta is None else f'  rss {rss_delta:+.1f}%'
+        print(f"{row['case']:<24} {row['stage']:<17} time {time_delta:+.1f}%  heap {heap_delta:+.1f}%{rss}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='リクエストのホットパスのマイクロベンチマーク')
+    parser.add_argument('--sizes', default='0.5,2,5,10', help='アップロード画像のサイズ（MB）')
+    parser.add_argument('--formats', default='jpeg,png,heic')
+    parser.add_argument('--result-sizes', default='1024,2048', help='生成画像の一辺のピクセル数')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help='結果の JSON（省略時は bench/results/hot_path-<日時>-<リビジョン>.json）')
+    parser.add_argument('--compare', help='比較する前回の結果 JSON')
+    parser.add_argument('--skip-rss', action='store_true', help='段階ごとの子プロセスでの RSS 計測を省く')
+    # 内部用: RSS 計測の子プロセス
+    parser.add_argument('--cold-run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_run:
+        cold_run(args.cold_run)
+        return
+
+    # (名前, 子プロセスで作り直すための kind:arg, fixture, stages)
+    cases = []
+    for format_name in args.formats.split(','):
+        for size_mb in (float(size) for size in args.sizes.split(',')):
+            cases.append((
+                f'upload-{format_name}-{size_mb:g}MB', f'upload:{format_name}@{size_mb:g}',
+                *upload_cases(format_name, size_mb),
+            ))
+    for size in (int(size) for size in args.result_sizes.split(',')):
+        cases.append((f'result-png-{size}px', f'result:{size}', *result_cases(size)))
+
+    report = {
+        'meta': bench_report.report_meta(
+            pillow=Image.__version__,
+            image_max_edge=image_pipeline.IMAGE_MAX_EDGE,
+            image_jpeg_quality=image_pipeline.IMAGE_JPEG_QUALITY,
+            args=vars(args),
+        ),
+        'results': [],
+    }
+    for name, cold_case, fixture, stages in cases:
+        for stage, fn in stages.items():
+            result = measure(fn, args.repeat, cold_case=None if args.skip_rss else f'{cold_case}:{stage}')
+            report['results'].append({'case': name, 'stage': stage, 'fixture': fixture, **result})
+            print_case(name, fixture, stage, result)
+
+    bench_report.save_report(report, args.output, prefix='hot_path')
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+負荷試験ドライバー
+偽の Gemini / Supabase（bench.fake_upstreams）とサーバーを起動し、同時接続数を段階的に上げながら
+シナリオごとの RPS と p50 / p95 / p99 を測って JSON に保存する
+
+python -m bench.load --server gunicorn --workers 2 --concurrency 1,8,32 --duration 20
+python -m bench.load --compare bench/results/load-<前回>.json
+"""
+
+import os
+import sys
+import math
+import time
+import socket
+import argparse
+import itertools
+import threading
+import subprocess
+
+import httpx
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from bench import fake_upstreams, report as bench_report, scenarios
+
+BENCH_JWT_SECRET = 'bench-jwt-secret-do-not-use-in-production'
+REQUEST_TIMEOUT = 150
+
+
+def percentile(sorted_values, fraction):
+    """最近傍順位法のパーセンタイル"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, window):
+    """[(latency, status, bytes)] から 1ステップ分の集計を作る"""
+    latencies = sorted(latency * 1000 for latency, status, _ in samples if status == 200)
+    errors = {}
+    for _, status, _ in samples:
+        if status != 200:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+
+    def rounded(value):
+        return round(value, 1) if value is not None else None
+
+    return {
+        'requests': len(samples),
+        'ok': len(latencies),
+        'errors': errors,
+        'error_rate': round(1 - len(latencies) / len(samples), 4) if samples else 0.0,
+        'window_seconds': round(window, 2),
+        'rps': round(len(samples) / window, 2) if window > 0 else 0.0,
+        'ok_rps': round(len(latencies) / window, 2) if window > 0 else 0.0,
+        'latency_ms': {
+            'p50': rounded(percentile(latencies, 0.50)),
+            'p90': rounded(percentile(latencies, 0.90)),
+            'p95': rounded(percentile(latencies, 0.95)),
+            'p99': rounded(percentile(latencies, 0.99)),
+            'max': rounded(latencies[-1] if latencies else None),
+            'mean': rounded(sum(latencies) / len(latencies) if latencies else None),
+        },
+        'response_bytes_mean': round(sum(size for _, _, size in samples) / len(samples)) if samples else 0,
+    }
+
+
+def run_step(base_url, scenario, fixtures, concurrency, duration, warmup, counter):
+    """concurrency 本の閉ループで duration 秒リクエストし続ける（最初の warmup 秒は集計しない）"""
+    started = time.monotonic()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+    samples = []
+    samples_lock = threading.Lock()
+    last_finished = [measure_from]
+
+    def worker():
+        with httpx.Client(base_url=base_url, timeout=REQUEST_TIMEOUT) as client:
+            while time.monotonic() < stop_at:
+                path, headers, body = fixtures.request_for(scenario, next(counter))
+                request_started = time.monotonic()
+                try:
+                    response = client.post(path, headers=headers, json=body)
+                    status, size = response.status_code, len(response.content)
+                except httpx.HTTPError as e:
+                    status, size = type(e).__name__, 0
+                finished = time.monotonic()
+                if request_started >= measure_from:
+                    with samples_lock:
+                        samples.append((finished - request_started, status, size))
+                        last_finished[0] = max(last_finished[0], finished)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, max(stop_at, last_finished[0]) - measure_from)
+
+
+def fetch_health(base_url):
+    try:
+        return httpx.get(f'{base_url}/health', timeout=10).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+# --- サーバーの起動 ---
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(kind, port, workers, threads):
+    if kind == 'gunicorn':
+        return [
+            'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--threads', str(threads),
+            '--timeout', '120', 'backend.server:app',
+        ]
+    if kind == 'uvicorn':
+        return [
+            'uvicorn', 'backend.asgi:app', '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(workers), '--log-level', 'warning',
+        ]
+    return [sys.executable, os.path.join('backend', 'server.py')]
+
+
+def server_env(port, gemini_url, supabase_url, overrides):
+    """偽サーバーを向き、レート制限・同時予約数の上限で測定が止まらない設定"""
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'GEMINI_API_KEY': 'bench-key',
+        'GEMINI_BASE_URL': gemini_url,
+        'SUPABASE_URL': supabase_url,
+        'SUPABASE_ANON_KEY': '',
+        'SUPABASE_SERVICE_KEY': scenarios.mint_token(BENCH_JWT_SECRET, 'service', ttl=86400),
+        'SUPABASE_JWT_SECRET': BENCH_JWT_SECRET,
+        'STRIPE_SECRET_KEY': '',
+        'RATE_LIMIT_MAX': '1000000000',
+        'RATE_LIMIT_USER_MAX': '1000000000',
+        'CREDIT_MAX_INFLIGHT': '1000000',
+        'PYTHONUNBUFFERED': '1',
+    })
+    env.update(overrides)
+    return env
+
+
+def wait_until_healthy(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'サーバーが終了しました（終了コード {process.returncode}）')
+        if fetch_health(base_url):
+            return
+        time.sleep(0.5)
+    raise RuntimeError('サーバーが起動しませんでした')
+
+
+# --- 結果の表示・比較 ---
+
+def print_step(scenario, concurrency, result):
+    latency = result['latency_ms']
+    print(
+        f"{scenario:<9} c={concurrency:<4} rps={result['rps']:<8} ok_rps={result['ok_rps']:<8} "
+        f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms "
+        f"errors={result['errors'] or '-'}",
+        flush=True,
+    )
+
+
+def compare(baseline_path, current):
+    """同じシナリオ・同時接続数の RPS と p95 を前回の結果と比べる"""
+    baseline = bench_report.load_report(baseline_path)
+    previous = {(step['scenario'], step['concurrency']): step for step in baseline['results']}
+
+    print(f"\n比較: {baseline['meta']['revision']} → {current['meta']['revision']}")
+    for step in current['results']:
+        before = previous.get((step['scenario'], step['concurrency']))
+        if not before:
+            continue
+        rps_delta = bench_report.percent_change(step['rps'], before['rps']) or 0.0
+        p95_delta = bench_report.percent_change(step['latency_ms']['p95'], before['latency_ms']['p95']) or 0.0
+        print(f"{step['scenario']:<9} c={step['concurrency']:<4} rps {rps_delta:+.1f}%  p95 {p95_delta:+.1f}%")
+
+
+def parse_env_overrides(values):
+    overrides = {}
+    for value in values:
+        name, _, setting = value.partition('=')
+        overrides[name] = setting
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description='髪型生成 API の負荷試験')
+    parser.add_argument('--target', help='起動済みサーバーの URL（省略時は偽サーバーとサーバーを起動する）')
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn', 'flask'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=32, help='gunicorn のワーカーごとのスレッド数')
+    parser.add_argument('--server-env', action='append', default=[], metavar='NAME=VALUE',
+                        help='起動するサーバーに渡す環境変数（複数指定可）')
+    parser.add_argument('--scenarios', default='guest,generate,adjust')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='段階的に上げる同時接続数')
+    parser.add_argument('--duration', type=float, default=20, help='1ステップの測定秒数')
+    parser.add_argument('--warmup', type=float, default=3, help='各ステップの集計しない最初の秒数')
+    parser.add_argument('--face-size', type=int, default=1024, help='送信する顔写真の一辺のピクセル数')
+    parser.add_argument('--response-format', choices=('json', 'binary', 'url'))
+    parser.add_argument('--jwt-secret', default=None, help='--target 使用時のサーバーの SUPABASE_JWT_SECRET')
+    parser.add_argument('--gemini-latency', type=float, default=8.0)
+    parser.add_argument('--gemini-jitter', type=float, default=0.2)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-error-status', type=int, default=503, choices=(429, 500, 503))
+    parser.add_argument('--image-size', type=int, default=1024, help='偽 Gemini が返す PNG の一辺のピクセル数')
+    parser.add_argument('--supabase-latency', type=float, default=0.03)
+    parser.add_argument('--supabase-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='結果の JSON（省略時は bench/results/<日時>-<リビジョン>.json）')
+    parser.add_argument('--compare', help='比較する前回の結果 JSON')
+    args = parser.parse_args()
+
+    selected = [scenarios.SCENARIOS[name] for name in args.scenarios.split(',')]
+    levels = [int(level) for level in args.concurrency.split(',')]
+    jwt_secret = args.jwt_secret if args.target else BENCH_JWT_SECRET
+    fixtures = scenarios.Fixtures(
+        face_size=args.face_size, jwt_secret=jwt_secret or '', users=max(levels),
+        response_format=args.response_format,
+    )
+
+    process = None
+    log_file = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        _, gemini_url = fake_upstreams.start_fake_gemini(
+            latency=args.gemini_latency, jitter=args.gemini_jitter, error_rate=args.gemini_error_rate,
+            error_status=args.gemini_error_status, image_size=args.image_size,
+        )
+        _, supabase_url = fake_upstreams.start_fake_supabase(
+            latency=args.supabase_latency, error_rate=args.supabase_error_rate,
+        )
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        os.makedirs(bench_report.RESULTS_DIR, exist_ok=True)
+        log_file = open(os.path.join(bench_report.RESULTS_DIR, 'server.log'), 'w')
+        process = subprocess.Popen(
+            server_command(args.server, port, args.workers, args.threads), cwd=BASE_DIR,
+            env=server_env(port, gemini_url, supabase_url, parse_env_overrides(args.server_env)),
+            stdout=log_file, stderr=subprocess.STDOUT,
+        )
+
+    report = {
+        'meta': bench_report.report_meta(
+            server='external' if args.target else args.server,
+            workers=None if args.target else args.workers,
+            threads=None if args.target else args.threads,
+            face_bytes=fixtures.face_bytes,
+            args=vars(args),
+        ),
+        'results': [],
+    }
+
+    try:
+        if process:
+            wait_until_healthy(base_url, process)
+        counter = itertools.count()
+        for scenario in selected:
+            for concurrency in levels:
+                result = run_step(base_url, scenario, fixtures, concurrency, args.duration, args.warmup, counter)
+                result.update({'scenario': scenario.name, 'concurrency': concurrency})
+                result['server_health'] = fetch_health(base_url)
+                report['results'].append(result)
+                print_step(scenario.name, concurrency, result)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+            log_file.close()
+
+    bench_report.save_report(report, args.output, prefix='load')
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+ベンチマーク結果の JSON 保存（コミット間で比較できるようリビジョンと実行環境を記録）
+"""
+
+import os
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BASE_DIR, 'bench', 'results')
+
+
+def git_revision():
+    """短いコミットハッシュ（未コミットの変更があれば -dirty を付ける）"""
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=BASE_DIR, capture_output=True, text=True).stdout.strip()
+        return f'{revision}-dirty' if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def report_meta(**extra):
+    return {
+        'revision': git_revision(),
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        **extra,
+    }
+
+
+def save_report(report, output=None, prefix='load'):
+    """output 省略時は bench/results/<prefix>-<日時>-<リビジョン>.json"""
+    output = output or os.path.join(
+        RESULTS_DIR, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['meta']['revision']}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}")
+    return output
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def percent_change(after, before):
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
@@ -0,0 +1,114 @@
+"""
+負荷試験のシナリオ（ゲスト生成・ログイン生成・髪型調整）
+リクエストごとにプリセット文言を変え、結果キャッシュに当たらないようにする
+"""
+
+import io
+import time
+import uuid
+import base64
+import random
+
+SAMPLE_PRESETS = [
+    ('ショート', '清潔感のある短髪、サイドすっきり、トップに軽い動き'),
+    ('マッシュ', '丸みのあるマッシュヘア、前髪重め、柔らかい印象'),
+    ('ボブ', '顎ラインの前下がりボブ、毛先は内巻き'),
+    ('ロング', '胸下までのロングヘア、つやつやストレート、清楚'),
+]
+
+SAMPLE_ADJUSTMENTS = [
+    {'lengthId': 'shorter'},
+    {'colorId': 'ash'},
+    {'style': '毛先に軽いウェーブ'},
+    {'lengthId': 'longer', 'colorId': 'darkBrown'},
+]
+
+
+def make_face_jpeg(size=1024, seed=0, quality=90):
+    """顔写真の代わりのグラデーション + ノイズの JPEG（実際の写真に近いバイト数になる）"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize((size, size))
+    noise = Image.frombytes('L', (size, size), rng.randbytes(size * size))
+    image = Image.merge('RGB', (gradient, noise, gradient.rotate(90)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def data_url(data, mime_type='image/jpeg'):
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def mint_token(secret, user_id, ttl=3600):
+    """SUPABASE_JWT_SECRET で署名した Supabase 互換のアクセストークン"""
+    import jwt
+
+    now = int(time.time())
+    return jwt.encode({
+        'sub': user_id,
+        'aud': 'authenticated',
+        'role': 'authenticated',
+        'iat': now,
+        'exp': now + ttl,
+    }, secret, algorithm='HS256')
+
+
+class Scenario:
+    """1種類のリクエスト（path に body を POST する）"""
+
+    def __init__(self, name, path, requires_auth, build_body):
+        self.name = name
+        self.path = path
+        self.requires_auth = requires_auth
+        self.build_body = build_body
+
+
+def _generate_body(fixtures, n):
+    name, prompt = SAMPLE_PRESETS[n % len(SAMPLE_PRESETS)]
+    return {
+        'face': fixtures.face,
+        'preset': f'{prompt} #{n}',
+        'presetName': name,
+        'gender': 'mens',
+    }
+
+
+def _adjust_body(fixtures, n):
+    return {
+        'face': fixtures.face,
+        'currentImage': fixtures.current_image,
+        'adjustments': SAMPLE_ADJUSTMENTS[n % len(SAMPLE_ADJUSTMENTS)],
+    }
+
+
+SCENARIOS = {
+    'guest': Scenario('guest', '/api/v1/vision/hairstyle/generate/guest', False, _generate_body),
+    'generate': Scenario('generate', '/api/v1/vision/hairstyle/generate', True, _generate_body),
+    'adjust': Scenario('adjust', '/api/v1/vision/hairstyle/adjust', True, _adjust_body),
+}
+
+
+class Fixtures:
+    """全リクエストで共有する画像とトークン（仮想ユーザーごとに別のユーザーID）"""
+
+    def __init__(self, face_size=1024, jwt_secret='', users=32, response_format=None):
+        face = make_face_jpeg(face_size, seed=1)
+        self.face = data_url(face)
+        self.current_image = data_url(make_face_jpeg(face_size, seed=2))
+        self.face_bytes = len(face)
+        self.response_format = response_format
+        self.tokens = [mint_token(jwt_secret, str(uuid.uuid4())) for _ in range(users)] if jwt_secret else []
+
+    def request_for(self, scenario, n):
+        """n 番目のリクエストの (path, headers, body)"""
+        headers = {'Content-Type': 'application/json'}
+        if scenario.requires_auth:
+            if not self.tokens:
+                raise ValueError(f'{scenario.name} シナリオには JWT シークレットが必要です')
+            headers['Authorization'] = f'Bearer {self.tokens[n % len(self.tokens)]}'
+        body = scenario.build_body(self, n)
+        if self.response_format:
+            body['responseFormat'] = self.response_format
+        return scenario.path, headers, body
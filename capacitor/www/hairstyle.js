@@ -51,27 +51,6 @@ const PRESETS = {
     ]
 };
 
-const LENGTH_MAP = {
-    shorter: 'make the hair shorter',
-    same: '',
-    longer: 'make the hair longer'
-};
-
-const COLOR_MAP = {
-    same: '',
-    black: 'jet black hair color',
-    darkBrown: 'dark brown hair color',
-    brown: 'brown hair color',
-    lightBrown: 'light brown hair color',
-    ash: 'ash gray hair color',
-    blonde: 'blonde hair color',
-    red: 'red hair color',
-    pink: 'pink hair color',
-    purple: 'purple hair color',
-    blue: 'blue hair color',
-    silver: 'silver gray hair color'
-};
-
 const HAIR_COLORS = [
     { id: 'none', name: 'なし', color: 'linear-gradient(135deg, #2a2f3e, #1a1f2e)', prompt: '' },
     { id: 'black', name: '黒髪', color: '#1a1a1a', prompt: 'jet black hair color' },
@@ -389,9 +368,10 @@ async function regenerate() {
             body: JSON.stringify({
                 face: photoData,
                 currentImage: generatedData,
+                // 指示文はサーバーが presets.json の id から組み立てる
                 adjustments: {
-                    length: LENGTH_MAP[lengthAdj],
-                    color: COLOR_MAP[colorAdj]
+                    lengthId: lengthAdj === 'same' ? null : lengthAdj,
+                    colorId: colorAdj === 'same' ? null : colorAdj
                 }
             })
         });
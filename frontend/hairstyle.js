@@ -29,65 +29,114 @@ const ICONS = {
     </svg>`
 };
 
-// ===== Preset Data with Image Paths =====
-const PRESETS = {
-    mens: [
-        { id: 'none', name: 'なし', prompt: null, image: null },
-        { id: 'short', name: 'ショート', prompt: '清潔感のある短髪、サイドすっきり、トップに軽い動き', image: '/images/presets/mens/short.png' },
-        { id: 'twoblock', name: 'ツーブロック', prompt: 'サイドを刈り上げたツーブロック、トップは長めで流す', image: '/images/presets/mens/twoblock.png' },
-        { id: 'mash', name: 'マッシュ', prompt: '丸みのあるマッシュヘア、前髪重め、柔らかい印象', image: '/images/presets/mens/mash.png' },
-        { id: 'center', name: 'センターパート', prompt: 'センター分け、顔周りをフレーミング、韓国風', image: '/images/presets/mens/center.png' },
-        { id: 'wolf', name: 'ウルフ', prompt: 'ウルフカット、襟足長め、レイヤー多め、動きのあるスタイル', image: '/images/presets/mens/wolf.png' },
-        { id: 'perm', name: 'パーマ', prompt: 'ゆるめのパーマ、ナチュラルなウェーブ、こなれ感', image: '/images/presets/mens/perm.png' },
-        { id: 'long', name: 'ロング', prompt: '肩につく長さ、ナチュラルなストレート、清潔感', image: '/images/presets/mens/long.png' },
-    ],
-    ladies: [
-        { id: 'none', name: 'なし', prompt: null, image: null },
-        { id: 'short', name: 'ショート', prompt: '耳が出るショートヘア、すっきりシルエット、女性らしい', image: '/images/presets/ladies/short.png' },
-        { id: 'bob', name: 'ボブ', prompt: 'あご下ラインのボブ、内巻き、清楚な印象', image: '/images/presets/ladies/bob.png' },
-        { id: 'lob', name: 'ロブ', prompt: '肩につくロングボブ、外ハネ、こなれ感', image: '/images/presets/ladies/lob.png' },
-        { id: 'medium', name: 'ミディアム', prompt: '鎖骨ラインのミディアム、レイヤー入り、ナチュラル', image: '/images/presets/ladies/medium.png' },
-        { id: 'layer', name: 'レイヤー', prompt: 'たっぷりレイヤーの動きのあるスタイル、顔周りに軽さ', image: '/images/presets/ladies/layer.png' },
-        { id: 'long', name: 'ロング', prompt: '胸下までのロングヘア、つやつやストレート、清楚', image: '/images/presets/ladies/long.png' },
-        { id: 'wave', name: 'ウェーブ', prompt: 'ゆるふわウェーブ、巻き髪、華やかな印象', image: '/images/presets/ladies/wave.png' },
-    ]
-};
+// ===== Preset Data =====
+// プリセット・髪色・長さの一覧は /api/v1/presets（backend/presets.json）だけから作る
+// 読み込むまでは null（読み込み中の表示）。生成・調整のプロンプトはサーバー側で id から組み立てる
+let PRESETS = null;
+let HAIR_COLORS = null;
+let presetCatalogFailed = false;
+
+// プリセット一覧（backend/presets.json。変わっていなければ ETag で 304 になる）
+async function loadPresetCatalog() {
+    presetCatalogFailed = false;
+    renderPresets(currentGender);
+    renderColors();
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/v1/presets`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const catalog = await response.json();
+        PRESETS = catalog.presets;
+        HAIR_COLORS = catalog.colors.map(color => ({ id: color.id, name: color.name, color: color.swatch }));
+        renderAdjustOptions(adjustLength, catalog.lengths || []);
+        renderAdjustOptions(adjustColor, catalog.colors.filter(color => color.id !== 'none'));
+    } catch (error) {
+        console.log('Preset catalog not available');
+        presetCatalogFailed = true;
+    }
+    renderPresets(currentGender);
+    renderColors();
+}
 
-const LENGTH_MAP = {
-    shorter: 'make the hair shorter',
-    same: '',
-    longer: 'make the hair longer'
-};
+// 一覧の読み込み中・失敗時の表示（失敗時はタップで再読み込み）
+function renderCatalogPlaceholder(row) {
+    row.innerHTML = '';
+    const message = document.createElement('div');
+    message.className = 'preset-label';
+    if (presetCatalogFailed) {
+        message.textContent = '読み込みに失敗しました（タップで再読み込み）';
+        message.style.cursor = 'pointer';
+        message.addEventListener('click', loadPresetCatalog);
+    } else {
+        message.textContent = '読み込み中...';
+    }
+    row.appendChild(message);
+}
 
-const COLOR_MAP = {
-    same: '',
-    black: 'jet black hair color',
-    darkBrown: 'dark brown hair color',
-    brown: 'brown hair color',
-    lightBrown: 'light brown hair color',
-    ash: 'ash gray hair color',
-    blonde: 'blonde hair color',
-    red: 'red hair color',
-    pink: 'pink hair color',
-    purple: 'purple hair color',
-    blue: 'blue hair color',
-    silver: 'silver gray hair color'
-};
+// 調整の選択肢（先頭の「そのまま」は HTML 側に残す）
+function renderAdjustOptions(select, items) {
+    select.querySelectorAll('option:not([value="same"])').forEach(option => option.remove());
+    items.forEach(item => {
+        const option = document.createElement('option');
+        option.value = item.id;
+        option.textContent = item.name;
+        select.appendChild(option);
+    });
+}
+
+// プリセットのサムネイル一覧（backend/preset_thumbnails.py が作る thumbnails.json）
+const PRESET_THUMBNAILS_URL = '/images/presets/thumbnails.json';
+let presetThumbnails = null;
+
+async function loadPresetThumbnails() {
+    try {
+        const response = await fetch(PRESET_THUMBNAILS_URL);
+        if (!response.ok) return;
+        presetThumbnails = await response.json();
+        renderPresets(currentGender);
+    } catch (error) {
+        // 一覧がなければ元画像（preset.image）を表示する
+        console.log('Preset thumbnails not available');
+    }
+}
+
+function thumbnailSrcset(files, version) {
+    return Object.entries(files)
+        .map(([density, path]) => `/images/presets/${path}?v=${version} ${density}`)
+        .join(', ');
+}
 
-const HAIR_COLORS = [
-    { id: 'none', name: 'なし', color: 'linear-gradient(135deg, #2a2f3e, #1a1f2e)', prompt: '' },
-    { id: 'black', name: '黒髪', color: '#1a1a1a', prompt: 'jet black hair color' },
-    { id: 'darkBrown', name: 'ダークブラウン', color: '#3d2817', prompt: 'dark brown hair color' },
-    { id: 'brown', name: 'ブラウン', color: '#6d4c3d', prompt: 'brown hair color' },
-    { id: 'lightBrown', name: 'ライトブラウン', color: '#a67c52', prompt: 'light brown hair color' },
-    { id: 'ash', name: 'アッシュ', color: 'linear-gradient(135deg, #8b9194, #b8bfc2)', prompt: 'ash gray hair color' },
-    { id: 'blonde', name: 'ブロンド', color: 'linear-gradient(135deg, #f4e4c1, #e6d5a8)', prompt: 'blonde hair color' },
-    { id: 'red', name: 'レッド', color: 'linear-gradient(135deg, #a0353a, #c9484d)', prompt: 'red hair color' },
-    { id: 'pink', name: 'ピンク', color: 'linear-gradient(135deg, #ffc0cb, #ff69b4)', prompt: 'pink hair color' },
-    { id: 'purple', name: 'パープル', color: 'linear-gradient(135deg, #8b7d99, #b19cd9)', prompt: 'purple hair color' },
-    { id: 'blue', name: 'ブルー', color: 'linear-gradient(135deg, #4a6fa5, #6b8cce)', prompt: 'blue hair color' },
-    { id: 'silver', name: 'シルバー', color: 'linear-gradient(135deg, #c0c0c0, #e8e8e8)', prompt: 'silver gray hair color' }
-];
+// AVIF / WebP / PNG の 1x・2x・3x からブラウザに選ばせる
+function createPresetPicture(gender, preset) {
+    const entry = presetThumbnails && presetThumbnails.presets[`${gender}/${preset.id}`];
+    const img = document.createElement('img');
+    img.alt = preset.name;
+    img.width = presetThumbnails ? presetThumbnails.size : 72;
+    img.height = img.width;
+    img.decoding = 'async';
+    img.loading = 'lazy';
+
+    if (!entry) {
+        img.src = preset.image;
+        return { picture: img, img };
+    }
+
+    const picture = document.createElement('picture');
+    presetThumbnails.formats.forEach(format => {
+        const files = entry.srcset[format.name];
+        if (!files) return;
+        if (format.name === 'png') {
+            img.src = `/images/presets/${files['1x']}?v=${entry.version}`;
+            img.srcset = thumbnailSrcset(files, entry.version);
+            return;
+        }
+        const source = document.createElement('source');
+        source.type = format.type;
+        source.srcset = thumbnailSrcset(files, entry.version);
+        picture.appendChild(source);
+    });
+    picture.appendChild(img);
+    return { picture, img };
+}
 
 // ===== DOM Elements =====
 const inputSection = document.getElementById('inputSection');
@@ -123,8 +172,8 @@ let selectedColor = null;
 
 // ===== Initialize =====
 document.addEventListener('DOMContentLoaded', () => {
-    renderPresets(currentGender);
-    renderColors();
+    loadPresetCatalog();
+    loadPresetThumbnails();
 });
 
 // ===== Event Listeners =====
@@ -178,13 +227,19 @@ downloadBtn.addEventListener('click', download);
 // ===== Functions =====
 
 function renderPresets(gender) {
-    const presets = PRESETS[gender];
+    if (!PRESETS) {
+        renderCatalogPlaceholder(presetRow);
+        return;
+    }
+    const presets = PRESETS[gender] || [];
     presetRow.innerHTML = '';
 
     presets.forEach(preset => {
         const item = document.createElement('div');
         item.className = 'preset-item';
         item.dataset.presetId = preset.id;
+        // 一覧の読み込み後に描き直しても選択を残す
+        if (selectedPreset && selectedPreset.id === preset.id) item.classList.add('selected');
 
         const thumb = document.createElement('div');
         thumb.className = 'preset-thumb';
@@ -196,9 +251,7 @@ function renderPresets(gender) {
             </svg>`;
         } else if (preset.image) {
             // サムネイル画像を表示
-            const img = document.createElement('img');
-            img.src = preset.image;
-            img.alt = preset.name;
+            const { picture, img } = createPresetPicture(gender, preset);
             img.style.width = '100%';
             img.style.height = '100%';
             img.style.objectFit = 'cover';
@@ -208,7 +261,7 @@ function renderPresets(gender) {
                 thumb.innerHTML = `<span style="font-size:12px;color:#999;">${preset.name.charAt(0)}</span>`;
                 thumb.style.background = `linear-gradient(135deg, #e0e0e0, #f5f5f5)`;
             };
-            thumb.appendChild(img);
+            thumb.appendChild(picture);
         } else {
             // フォールバック
             thumb.style.background = `linear-gradient(135deg, #e0e0e0, #f5f5f5)`;
@@ -240,12 +293,17 @@ function selectPreset(preset, element) {
 }
 
 function renderColors() {
+    if (!HAIR_COLORS) {
+        renderCatalogPlaceholder(colorRow);
+        return;
+    }
     colorRow.innerHTML = '';
 
     HAIR_COLORS.forEach(color => {
         const item = document.createElement('div');
         item.className = 'color-item';
         item.dataset.colorId = color.id;
+        if (selectedColor && selectedColor.id === color.id) item.classList.add('selected');
 
         const swatch = document.createElement('div');
         swatch.className = 'color-swatch';
@@ -327,14 +385,11 @@ function updateGenerateButton() {
 }
 
 function buildPayload() {
-    let fullPrompt = selectedPreset.prompt;
-    if (selectedColor && selectedColor.prompt) {
-        fullPrompt = `${selectedPreset.prompt}, ${selectedColor.prompt}`;
-    }
+    // プロンプトはサーバーが presetId / colorId から組み立てる
     return {
         face: photoData,
-        preset: fullPrompt,
-        presetName: `${selectedPreset.name}${selectedColor ? ' (' + selectedColor.name + ')' : ''}`,
+        presetId: selectedPreset.id,
+        colorId: selectedColor ? selectedColor.id : null,
         gender: currentGender
     };
 }
@@ -457,9 +512,10 @@ async function regenerate() {
             body: JSON.stringify({
                 face: photoData,
                 currentImage: generatedData,
+                // 指示文はサーバーが presets.json の id から組み立てる
                 adjustments: {
-                    length: LENGTH_MAP[lengthAdj],
-                    color: COLOR_MAP[colorAdj]
+                    lengthId: lengthAdj === 'same' ? null : lengthAdj,
+                    colorId: colorAdj === 'same' ? null : colorAdj
                 }
             })
         });
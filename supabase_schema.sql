@@ -81,3 +81,274 @@ alter table public.purchases enable row level security;
 create policy "Users can view own purchases"
   on public.purchases for select
   using (auth.uid() = user_id);
+
+-- クレジット操作（サーバーから service_role で呼ぶ）
+-- 残高チェック・減算・履歴追加・残高取得を1トランザクション / 1往復で行う
+
+-- プレミアムユーザーの使用回数だけ加算
+create or replace function public.increment_generations(user_id_input uuid)
+returns void as $$
+  update public.profiles
+     set total_generations = total_generations + 1,
+         updated_at = now()
+   where id = user_id_input;
+$$ language sql security definer set search_path = public;
+
+-- クレジットを1消費して残高を返す
+-- ok = false: 残高不足 / remaining = -1: プレミアム（無制限）
+-- 予約中（credit_holds の held）のクレジットは使えない残高として扱う
+create or replace function public.consume_credit(p_user_id uuid, p_reason text default '髪型生成')
+returns table (ok boolean, remaining integer, premium boolean) as $$
+declare
+  v_credits integer;
+  v_premium boolean;
+  v_held integer;
+begin
+  -- プロフィールが無ければ作成（handle_new_user 導入前のユーザー向け）
+  insert into public.profiles (id) values (p_user_id) on conflict (id) do nothing;
+
+  -- 行ロックで同時リクエストの二重消費を防ぐ（予約の確定・解放と同じく profiles → credit_holds の順）
+  select p.credits, (p.is_premium and coalesce(p.premium_expires_at > now(), false))
+    into v_credits, v_premium
+    from public.profiles p
+   where p.id = p_user_id
+     for update;
+
+  if v_premium then
+    perform public.increment_generations(p_user_id);
+    return query select true, -1, true;
+    return;
+  end if;
+
+  select coalesce(sum(h.amount), 0)
+    into v_held
+    from public.credit_holds h
+   where h.user_id = p_user_id and h.status = 'held' and h.expires_at >= now();
+
+  if v_credits - v_held <= 0 then
+    return query select false, v_credits - v_held, false;
+    return;
+  end if;
+
+  update public.profiles p
+     set credits = p.credits - 1,
+         total_generations = p.total_generations + 1,
+         updated_at = now()
+   where p.id = p_user_id
+  returning p.credits into v_credits;
+
+  insert into public.credit_history (user_id, amount, reason)
+  values (p_user_id, -1, p_reason);
+
+  return query select true, v_credits, false;
+end;
+$$ language plpgsql security definer set search_path = public;
+
+-- クレジットを加算して残高を返す（購入時）
+create or replace function public.grant_credits(p_user_id uuid, p_amount integer, p_reason text)
+returns integer as $$
+declare
+  v_credits integer;
+begin
+  insert into public.profiles (id) values (p_user_id) on conflict (id) do nothing;
+
+  update public.profiles p
+     set credits = p.credits + p_amount,
+         updated_at = now()
+   where p.id = p_user_id
+  returning p.credits into v_credits;
+
+  insert into public.credit_history (user_id, amount, reason)
+  values (p_user_id, p_amount, p_reason);
+
+  return v_credits;
+end;
+$$ language plpgsql security definer set search_path = public;
+
+-- クライアント（anon / authenticated）からは呼べないようにする
+revoke execute on function public.increment_generations(uuid) from public, anon, authenticated;
+revoke execute on function public.consume_credit(uuid, text) from public, anon, authenticated;
+revoke execute on function public.grant_credits(uuid, integer, text) from public, anon, authenticated;
+
+-- クレジット予約（Gemini 呼び出し前に確保 → 成功で確定 / 失敗で解放）
+create table if not exists public.credit_holds (
+  id uuid primary key default gen_random_uuid(),
+  user_id uuid references public.profiles(id) on delete cascade not null,
+  -- 確保したクレジット（プレミアムは 0）
+  amount integer not null,
+  -- 予約した生成回数
+  generations integer not null,
+  status text not null default 'held',  -- held / committed / released / expired
+  expires_at timestamptz not null,
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now()
+);
+
+create index if not exists credit_holds_active_idx
+  on public.credit_holds (user_id) where status = 'held';
+
+-- ポリシーなし = service_role からのみ操作可能
+alter table public.credit_holds enable row level security;
+
+-- 期限切れの予約を解放
+create or replace function public.expire_credit_holds(p_user_id uuid default null)
+returns integer as $$
+declare
+  v_count integer;
+begin
+  update public.credit_holds h
+     set status = 'expired', updated_at = now()
+   where h.status = 'held'
+     and h.expires_at < now()
+     and (p_user_id is null or h.user_id = p_user_id);
+  get diagnostics v_count = row_count;
+  return v_count;
+end;
+$$ language plpgsql security definer set search_path = public;
+
+-- クレジットを予約する
+-- reason: insufficient_credits（残高不足）/ too_many_inflight（同時実行数の上限）
+create or replace function public.reserve_credits(
+  p_user_id uuid,
+  p_amount integer default 1,
+  p_ttl_seconds integer default 180,
+  p_max_inflight integer default 3
+)
+returns table (ok boolean, hold_id uuid, available integer, premium boolean, reason text) as $$
+declare
+  v_credits integer;
+  v_premium boolean;
+  v_held integer;
+  v_inflight integer;
+  v_hold_id uuid;
+begin
+  insert into public.profiles (id) values (p_user_id) on conflict (id) do nothing;
+
+  -- プロフィール行をロックして同一ユーザーの予約を直列化
+  select p.credits, (p.is_premium and coalesce(p.premium_expires_at > now(), false))
+    into v_credits, v_premium
+    from public.profiles p
+   where p.id = p_user_id
+     for update;
+
+  perform public.expire_credit_holds(p_user_id);
+
+  select coalesce(sum(h.amount), 0), count(*)
+    into v_held, v_inflight
+    from public.credit_holds h
+   where h.user_id = p_user_id and h.status = 'held';
+
+  if v_inflight >= p_max_inflight then
+    return query select false, null::uuid, v_credits - v_held, v_premium, 'too_many_inflight';
+    return;
+  end if;
+
+  if not v_premium and v_credits - v_held < p_amount then
+    return query select false, null::uuid, v_credits - v_held, false, 'insufficient_credits';
+    return;
+  end if;
+
+  insert into public.credit_holds (user_id, amount, generations, expires_at)
+  values (
+    p_user_id,
+    case when v_premium then 0 else p_amount end,
+    p_amount,
+    now() + make_interval(secs => p_ttl_seconds)
+  )
+  returning id into v_hold_id;
+
+  if v_premium then
+    return query select true, v_hold_id, -1, true, null::text;
+  else
+    return query select true, v_hold_id, v_credits - v_held - p_amount, false, null::text;
+  end if;
+end;
+$$ language plpgsql security definer set search_path = public;
+
+-- 予約を確定して残高を返す（p_used: 実際に成功した生成回数。null なら予約数すべて）
+-- ロック順は reserve_credits と同じ profiles → credit_holds（逆順だと同じユーザーの予約と確定がデッドロックする）
+-- 期限切れの予約は確定しない（ok = false。呼び出し側は通常の消費に切り替える）
+create or replace function public.commit_credit_hold(
+  p_hold_id uuid,
+  p_used integer default null,
+  p_reason text default '髪型生成'
+)
+returns table (ok boolean, remaining integer) as $$
+declare
+  v_hold public.credit_holds%rowtype;
+  v_used integer;
+  v_charge integer;
+  v_credits integer;
+begin
+  select p.credits into v_credits
+    from public.profiles p
+   where p.id = (select h.user_id from public.credit_holds h where h.id = p_hold_id)
+     for update;
+
+  select * into v_hold
+    from public.credit_holds h
+   where h.id = p_hold_id and h.status = 'held'
+     for update;
+
+  if not found then
+    return query select false, null::integer;
+    return;
+  end if;
+
+  if v_hold.expires_at < now() then
+    update public.credit_holds
+       set status = 'expired', updated_at = now()
+     where id = p_hold_id;
+    return query select false, null::integer;
+    return;
+  end if;
+
+  v_used := greatest(least(coalesce(p_used, v_hold.generations), v_hold.generations), 0);
+  -- 残高を超えては減らさない（予約中の分は consume_credit から守られているので通常は足りる）
+  v_charge := least(v_used, v_hold.amount, greatest(v_credits, 0));
+
+  update public.profiles p
+     set credits = p.credits - v_charge,
+         total_generations = p.total_generations + v_used,
+         updated_at = now()
+   where p.id = v_hold.user_id
+  returning p.credits into v_credits;
+
+  if v_charge > 0 then
+    insert into public.credit_history (user_id, amount, reason)
+    values (v_hold.user_id, -v_charge, p_reason);
+  end if;
+
+  update public.credit_holds
+     set status = 'committed', updated_at = now()
+   where id = p_hold_id;
+
+  -- プレミアムの予約は amount = 0
+  if v_hold.amount = 0 and v_hold.generations > 0 then
+    return query select true, -1;
+  else
+    return query select true, v_credits;
+  end if;
+end;
+$$ language plpgsql security definer set search_path = public;
+
+-- 予約を解放（生成失敗・タイムアウト時）。ロック順は profiles → credit_holds
+create or replace function public.release_credit_hold(p_hold_id uuid)
+returns boolean as $$
+begin
+  perform 1
+     from public.profiles p
+    where p.id = (select h.user_id from public.credit_holds h where h.id = p_hold_id)
+      for update;
+
+  update public.credit_holds
+     set status = 'released', updated_at = now()
+   where id = p_hold_id and status = 'held';
+  return found;
+end;
+$$ language plpgsql security definer set search_path = public;
+
+revoke execute on function public.expire_credit_holds(uuid) from public, anon, authenticated;
+revoke execute on function public.reserve_credits(uuid, integer, integer, integer) from public, anon, authenticated;
+revoke execute on function public.commit_credit_hold(uuid, integer, text) from public, anon, authenticated;
+revoke execute on function public.release_credit_hold(uuid) from public, anon, authenticated;
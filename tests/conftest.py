@@ -0,0 +1,97 @@
+"""テスト共通のフィクスチャ（Gemini・Supabase は偽物に差し替える）"""
+
+import io
+import base64
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+GENERATED_IMAGE = b'\x89PNG generated'
+
+
+def fake_gemini_response(image=GENERATED_IMAGE, text='ok'):
+    """extract_image_and_text が読める形の generate_content 応答"""
+    parts = [SimpleNamespace(text=text, inline_data=None)]
+    if image:
+        parts.append(SimpleNamespace(text=None, inline_data=SimpleNamespace(data=image)))
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))])
+
+
+class FakeGemini:
+    """generate_image_content の代わり。送られた contents を記録する
+
+    fail_prompts に含まれる文字列をプロンプトに持つ呼び出しは例外にする
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.fail_prompts = ()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = None
+        self._lock = threading.Lock()
+
+    def __call__(self, contents, model=None):
+        prompt = contents[-1]
+        with self._lock:
+            self.calls.append(contents)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                self.delay.wait(5)
+            if any(marker in prompt for marker in self.fail_prompts):
+                raise RuntimeError('gemini failed')
+            return fake_gemini_response()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    @property
+    def prompts(self):
+        return [contents[-1] for contents in self.calls]
+
+
+def make_jpeg(size=(64, 48), color=(120, 90, 60)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def face_data_url():
+    return 'data:image/jpeg;base64,' + base64.b64encode(make_jpeg()).decode('ascii')
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Supabase 未設定・Gemini は偽物・ログイン済み（Bearer のトークンがそのままユーザーID）の server"""
+    pytest.importorskip('flask')
+    from backend import server, rate_limiter, upstream_governor
+
+    gemini = FakeGemini()
+    monkeypatch.setattr(server.gemini_pool, 'generate_image_content', gemini)
+    monkeypatch.setattr(server, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(server, 'is_auth_validation_configured', lambda: True)
+    monkeypatch.setattr(server, 'get_user_from_token', lambda token: token)
+    monkeypatch.setattr(server, 'request_limiter', rate_limiter.MemoryRateLimiter())
+    monkeypatch.setattr(server, 'upstream', upstream_governor.UpstreamGovernor(max_limit=16, min_limit=2))
+    monkeypatch.setattr(server, 'generation_cache', None)
+    monkeypatch.setattr(server, 'supabase_client', None)
+    monkeypatch.setattr(server.credit_reservations, 'client_getter', lambda: None)
+    server.app.config['TESTING'] = True
+    server.fake_gemini = gemini
+    yield server
+    del server.fake_gemini
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+def auth_headers(user_id='user-1'):
+    return {'Authorization': f'Bearer {user_id}'}
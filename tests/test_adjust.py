@@ -0,0 +1,41 @@
+"""髪型調整 API の入力（id / 旧クライアントの指示文）"""
+
+from conftest import auth_headers
+
+
+def adjust(client, face_data_url, adjustments):
+    return client.post('/api/v1/vision/hairstyle/adjust', headers=auth_headers(), json={
+        'face': face_data_url,
+        'currentImage': face_data_url,
+        'adjustments': adjustments,
+    })
+
+
+def test_adjust_ids_build_prompt(server, client, face_data_url):
+    response = adjust(client, face_data_url, {'lengthId': 'shorter', 'colorId': 'ash'})
+    assert response.status_code == 200
+    prompt = server.fake_gemini.prompts[-1]
+    assert 'make the hair shorter' in prompt
+    assert 'ash gray hair color' in prompt
+
+
+def test_legacy_adjust_text_still_changes_prompt(server, client, face_data_url):
+    # 旧クライアント（LENGTH_MAP / COLOR_MAP の指示文を送る）
+    response = adjust(client, face_data_url, {'length': 'make the hair longer', 'color': 'jet black hair color'})
+    assert response.status_code == 200
+    prompt = server.fake_gemini.prompts[-1]
+    assert 'make the hair longer' in prompt
+    assert 'jet black hair color' in prompt
+
+
+def test_unknown_or_empty_adjustments_rejected_before_reserving(server, client, face_data_url, monkeypatch):
+    reserved = []
+    monkeypatch.setattr(server.credit_reservations, 'reserve', lambda *args, **kwargs: reserved.append(args))
+
+    for adjustments in ({'colorId': 'green'}, {'color': 'neon hair'}, {'lengthId': ['shorter']}, {}, 'shorter'):
+        response = adjust(client, face_data_url, adjustments)
+        assert response.status_code == 400, adjustments
+
+    assert reserved == []
+    assert server.fake_gemini.calls == []
+    assert server.upstream.stats()['in_flight'] == 0
@@ -0,0 +1,94 @@
+"""ASGI エントリポイントの生成系API（受け付け順・枠の扱い）"""
+
+import json
+import asyncio
+
+import pytest
+
+from conftest import auth_headers, fake_gemini_response
+
+
+@pytest.fixture
+def asgi(server, monkeypatch):
+    from backend import asgi
+
+    calls = []
+
+    async def generate_async(contents, model=None):
+        calls.append(contents)
+        return fake_gemini_response()
+
+    monkeypatch.setattr(asgi.gemini_pool, 'generate_image_content_async', generate_async)
+    asgi.fake_gemini_calls = calls
+    return asgi
+
+
+def call(asgi, path, payload, headers=None):
+    """1リクエストを ASGI アプリに通して (ステータス, JSON) を返す"""
+    body = json.dumps(payload).encode('utf-8')
+    raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    raw_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': path, 'query_string': b'', 'headers': raw_headers,
+        'client': ('10.0.0.1', 1234), 'server': ('testserver', 80), 'scheme': 'http', 'http_version': '1.1',
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    status = sent[0]['status']
+    return status, json.loads(b''.join(message.get('body', b'') for message in sent[1:]) or b'null')
+
+
+def generate_payload(face_data_url):
+    return {'face': face_data_url, 'presetId': 'wolf', 'gender': 'mens'}
+
+
+def test_generates_through_async_gemini(asgi, face_data_url):
+    status, body = call(asgi, '/api/v1/vision/hairstyle/generate', generate_payload(face_data_url), auth_headers())
+    assert status == 200
+    assert body['generatedImage'].startswith('data:image/png;base64,')
+    assert len(asgi.fake_gemini_calls) == 1
+    assert asgi.server.upstream.stats()['in_flight'] == 0
+
+
+def test_unauthenticated_request_does_not_take_a_permit(asgi, server, face_data_url, monkeypatch):
+    # 実行枠が埋まっていて待ち行列もない状態
+    monkeypatch.setattr(server, 'upstream', server.upstream_governor.UpstreamGovernor(max_limit=1, min_limit=1, max_queue=0))
+    held = server.upstream.acquire()
+
+    status, _ = call(asgi, '/api/v1/vision/hairstyle/generate', generate_payload(face_data_url))
+    assert status == 401
+    assert server.upstream.stats()['shed'] == 0
+
+    # ログイン済みなら枠の確認まで進んで 503
+    status, _ = call(asgi, '/api/v1/vision/hairstyle/generate', generate_payload(face_data_url), auth_headers())
+    assert status == 503
+    held.cancel()
+
+
+def test_rate_limited_request_does_not_take_a_permit(asgi, server, face_data_url, monkeypatch):
+    monkeypatch.setattr(server, 'RATE_LIMIT_USER_MAX_REQUESTS', 2)
+    admitted = []
+    acquire_async = server.upstream.acquire_async
+
+    async def counting_acquire(*args, **kwargs):
+        admitted.append(True)
+        return await acquire_async(*args, **kwargs)
+
+    monkeypatch.setattr(server.upstream, 'acquire_async', counting_acquire)
+
+    statuses = [
+        call(asgi, '/api/v1/vision/hairstyle/generate', generate_payload(face_data_url), auth_headers())[0]
+        for _ in range(3)
+    ]
+    # 受け付け前の確認と前半で二重に数えない
+    assert statuses == [200, 200, 429]
+    assert len(admitted) == 2
+    assert server.upstream.stats()['in_flight'] == 0
@@ -0,0 +1,129 @@
+"""JWT のローカル検証と Supabase へのフォールバック"""
+
+import time
+from types import SimpleNamespace
+
+import jwt
+import pytest
+
+from backend import auth_tokens
+from backend.auth_tokens import JwksCache, TokenVerifier
+
+SECRET = 'test-secret-with-enough-length-for-hs256'
+
+
+def make_token(sub='user-1', key=SECRET, algorithm='HS256', expires_in=3600, **headers):
+    payload = {'sub': sub, 'aud': 'authenticated', 'exp': int(time.time()) + expires_in}
+    return jwt.encode(payload, key, algorithm=algorithm, headers=headers or None)
+
+
+class FakeAuthClient:
+    """client.auth.get_user(token) だけを持つ Supabase クライアントの代わり"""
+
+    def __init__(self, user_id='remote-user'):
+        self.tokens = []
+        self.auth = self
+        self.user_id = user_id
+
+    def get_user(self, token):
+        self.tokens.append(token)
+        return SimpleNamespace(user=SimpleNamespace(id=self.user_id))
+
+
+def test_hs256_is_verified_locally_and_cached():
+    remote = FakeAuthClient()
+    verifier = TokenVerifier(jwt_secret=SECRET, remote_clients=[remote])
+    token = make_token()
+
+    assert verifier.verify(token) == 'user-1'
+    assert verifier.verify(token) == 'user-1'
+    assert verifier.cache.stats()['hits'] == 1
+    assert remote.tokens == []
+
+
+@pytest.mark.parametrize('token', [
+    make_token(key='another-secret-with-enough-length-000'),
+    make_token(expires_in=-10),
+    'not-a-jwt',
+])
+def test_invalid_tokens_are_rejected_without_remote_call(token):
+    remote = FakeAuthClient()
+    verifier = TokenVerifier(jwt_secret=SECRET, remote_clients=[remote])
+    assert verifier.verify(token) is None
+    assert remote.tokens == []
+
+
+def test_undecided_token_falls_back_to_remote():
+    # シークレット未設定では HS256 を判定できない
+    remote = FakeAuthClient()
+    token = make_token()
+    assert TokenVerifier(remote_clients=[remote]).verify(token) == 'remote-user'
+    assert remote.tokens == [token]
+
+    assert TokenVerifier(remote_clients=[remote], remote_fallback=False).verify(token) is None
+    assert len(remote.tokens) == 1
+
+
+@pytest.fixture
+def rsa_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def jwks_with(private_key, kid):
+    jwk = jwt.PyJWK.from_dict({**jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True),
+                               'kid': kid, 'alg': 'RS256'})
+    return {kid: jwk}
+
+
+def test_rs256_uses_jwks_and_refetches_for_unknown_kid(rsa_key, monkeypatch):
+    fetches = []
+    keys = jwks_with(rsa_key, 'old')
+
+    def fetch(self):
+        fetches.append(time.time())
+        return keys
+
+    monkeypatch.setattr(JwksCache, '_fetch', fetch)
+    remote = FakeAuthClient()
+    verifier = TokenVerifier(jwks_url='https://example.invalid/jwks.json', remote_clients=[remote])
+
+    assert verifier.verify(make_token(key=rsa_key, algorithm='RS256', kid='old')) == 'user-1'
+    assert len(fetches) == 1
+
+    # 鍵ローテーション直後: 未知の kid はその場で取り直す（間隔をおいて）
+    keys = jwks_with(rsa_key, 'new')
+    monkeypatch.setattr(JwksCache, 'MIN_REFETCH_INTERVAL', -1)
+    assert verifier.verify(make_token(key=rsa_key, algorithm='RS256', kid='new')) == 'user-1'
+    assert len(fetches) == 2
+    assert remote.tokens == []
+
+
+def test_unknown_kid_refetch_is_throttled(monkeypatch):
+    fetches = []
+
+    def fetch(self):
+        fetches.append(True)
+        return {}
+
+    monkeypatch.setattr(JwksCache, '_fetch', fetch)
+    jwks = JwksCache('https://example.invalid/jwks.json')
+
+    # 任意の kid を送り続けても MIN_REFETCH_INTERVAL に1回しか取りに行かない
+    assert [jwks.get_key(f'kid-{n}') for n in range(5)] == [None] * 5
+    assert len(fetches) == 1
+
+    now = time.time() + JwksCache.MIN_REFETCH_INTERVAL + 1
+    monkeypatch.setattr(auth_tokens.time, 'time', lambda: now)
+    assert jwks.get_key('kid-5') is None
+    assert len(fetches) == 2
+
+
+def test_key_missing_from_jwks_uses_remote_fallback(rsa_key, monkeypatch):
+    monkeypatch.setattr(JwksCache, '_fetch', lambda self: {})
+    remote = FakeAuthClient()
+    verifier = TokenVerifier(jwks_url='https://example.invalid/jwks.json', remote_clients=[remote])
+
+    assert verifier.verify(make_token(key=rsa_key, algorithm='RS256', kid='unknown')) == 'remote-user'
+    assert verifier.remote_calls == 1
@@ -0,0 +1,92 @@
+"""一括生成API（NDJSON・成功件数だけの課金・ユーザーごとの同時実行枠）"""
+
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import auth_headers
+
+BATCH_PATH = '/api/v1/vision/hairstyle/generate/batch'
+
+
+@pytest.fixture
+def credits(server, monkeypatch):
+    """予約した件数（reserved）と確定した件数（committed）を記録する"""
+    recorded = SimpleNamespace(reserved=[], committed=[])
+    reserve = server.credit_reservations.reserve
+
+    def recording_reserve(user_id, amount=1, ttl=None):
+        recorded.reserved.append(amount)
+        return reserve(user_id, amount=amount, ttl=ttl)
+
+    def recording_commit(hold, used=None, reason=''):
+        server.credit_reservations._release_local(hold)
+        recorded.committed.append(used)
+        return 10
+
+    monkeypatch.setattr(server.credit_reservations, 'reserve', recording_reserve)
+    monkeypatch.setattr(server.credit_reservations, 'commit', recording_commit)
+    return recorded
+
+
+def batch(client, face_data_url, presets):
+    response = client.post(BATCH_PATH, headers=auth_headers(), json={
+        'face': face_data_url, 'gender': 'mens', 'presets': presets,
+    })
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines() if line]
+    return response, lines
+
+
+def test_partial_failure_charges_only_successes(server, client, face_data_url, credits):
+    server.fake_gemini.fail_prompts = ('マッシュ',)
+    response, lines = batch(client, face_data_url, ['wolf', 'mash', 'short'])
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    items, summary = lines[:-1], lines[-1]
+    statuses = {item['presetId']: item['status'] for item in items}
+    assert statuses == {'wolf': 200, 'mash': 500, 'short': 200}
+    assert all(item['generatedImage'].startswith('data:image/png;base64,') for item in items if item['status'] == 200)
+    assert summary == {'done': True, 'succeeded': 2, 'failed': 1, 'credits': 10}
+
+    # 3件分を予約し、成功した2件分だけ確定する
+    assert credits.reserved == [3]
+    assert credits.committed == [2]
+    assert server.credit_reservations.stats()['local_inflight'] == 0
+
+
+def test_duplicate_presets_are_generated_once(server, client, face_data_url, credits):
+    response, lines = batch(client, face_data_url, ['wolf', {'presetId': 'wolf'}])
+    assert response.status_code == 200
+    assert len(lines) == 2
+    assert len(server.fake_gemini.calls) == 1
+    assert credits.committed == [1]
+
+
+def test_rate_limit_counts_each_generated_item(server, client, face_data_url, credits, monkeypatch):
+    monkeypatch.setattr(server, 'RATE_LIMIT_USER_MAX_REQUESTS', 2)
+    response, _ = batch(client, face_data_url, ['wolf', 'mash', 'short'])
+
+    assert response.status_code == 429
+    assert server.fake_gemini.calls == []
+    assert credits.reserved == []
+
+
+def test_per_user_slot_caps_concurrency(server, client, face_data_url, credits, monkeypatch):
+    monkeypatch.setattr(server, 'BATCH_USER_CONCURRENCY', 2)
+    monkeypatch.setattr(server, 'BATCH_SLOT_POLL_INTERVAL', 0.01)
+    # 同じユーザーの別の一括生成が枠を1つ使っている
+    other = server.request_limiter.acquire_slot('batch:user-1', 2, 60)
+
+    gemini = server.fake_gemini
+    gemini.delay = threading.Event()
+    threading.Timer(0.2, gemini.delay.set).start()
+    response, lines = batch(client, face_data_url, ['wolf', 'mash', 'short', 'twoblock'])
+
+    assert response.status_code == 200
+    assert lines[-1]['succeeded'] == 4
+    assert gemini.max_in_flight == 1
+    server.request_limiter.release_slot('batch:user-1', other)
+    assert server.request_limiter.stats()['slot_keys'] == 0
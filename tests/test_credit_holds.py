@@ -0,0 +1,182 @@
+"""クレジット予約（reserve / commit / release）の精算"""
+
+import pytest
+
+from backend import credit_holds
+from backend.credit_holds import CreditReservations, ReservationError
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeCall:
+    def __init__(self, client, name, params):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        self.client.calls.append((self.name, self.params))
+        response = self.client.responses.get(self.name)
+        if isinstance(response, Exception):
+            raise response
+        return FakeResult(response(self.params) if callable(response) else response)
+
+
+class FakeSupabase:
+    """rpc(name, params).execute().data だけを持つ Supabase クライアントの代わり"""
+
+    def __init__(self, **responses):
+        self.responses = responses
+        self.calls = []
+
+    def rpc(self, name, params):
+        return FakeCall(self, name, params)
+
+    def params_of(self, name):
+        return [params for called, params in self.calls if called == name]
+
+
+class Ledger:
+    """関数未作成時・期限切れ時に使う従来の消費処理"""
+
+    def __init__(self, credits):
+        self.credits = credits
+        self.consumed = []
+
+    def consume(self, user_id, reason):
+        if self.credits <= 0:
+            return None
+        self.credits -= 1
+        self.consumed.append(reason)
+        return self.credits
+
+    def balance(self, user_id):
+        return self.credits
+
+
+@pytest.fixture(autouse=True)
+def no_sweeper(monkeypatch):
+    monkeypatch.setattr(CreditReservations, 'start_sweeper', lambda self: None)
+
+
+def make_reservations(client, ledger, commits=None, max_inflight=3):
+    def on_commit(user_id, remaining, used):
+        commits.append((user_id, remaining, used))
+
+    return CreditReservations(
+        lambda: client, ledger.consume, ledger.balance,
+        on_commit=on_commit if commits is not None else None, max_inflight=max_inflight,
+    )
+
+
+def reserved(hold_id='hold-1', available=2):
+    return [{'ok': True, 'hold_id': hold_id, 'available': available, 'premium': False, 'reason': None}]
+
+
+def test_commit_charges_reserved_amount():
+    client = FakeSupabase(reserve_credits=reserved(), commit_credit_hold=[{'ok': True, 'remaining': 4}])
+    commits = []
+    reservations = make_reservations(client, Ledger(5), commits)
+
+    hold = reservations.reserve('user-1')
+    assert hold['id'] == 'hold-1' and not hold['local']
+    assert reservations.commit(hold) == 4
+    assert client.params_of('commit_credit_hold') == [{'p_hold_id': 'hold-1', 'p_used': None, 'p_reason': '髪型生成'}]
+    assert commits == [('user-1', 4, 1)]
+
+
+def test_reserve_failure_raises_reason():
+    client = FakeSupabase(reserve_credits=[{'ok': False, 'hold_id': None, 'available': 0, 'reason': 'insufficient_credits'}])
+    reservations = make_reservations(client, Ledger(0))
+
+    with pytest.raises(ReservationError) as excinfo:
+        reservations.reserve('user-1')
+    assert excinfo.value.reason == 'insufficient_credits'
+    assert excinfo.value.available == 0
+
+
+def test_batch_partial_failure_commits_only_successes():
+    client = FakeSupabase(reserve_credits=reserved(available=2), commit_credit_hold=[{'ok': True, 'remaining': 3}])
+    commits = []
+    reservations = make_reservations(client, Ledger(5), commits)
+
+    hold = reservations.reserve('user-1', amount=3, ttl=600)
+    assert client.params_of('reserve_credits')[0]['p_amount'] == 3
+    assert client.params_of('reserve_credits')[0]['p_ttl_seconds'] == 600
+
+    # 3件中2件だけ成功
+    assert reservations.commit(hold, used=2, reason='一括髪型生成') == 3
+    assert client.params_of('commit_credit_hold')[0]['p_used'] == 2
+    assert commits == [('user-1', 3, 2)]
+
+
+def test_expired_hold_falls_back_to_direct_consume():
+    client = FakeSupabase(reserve_credits=reserved(), commit_credit_hold=[{'ok': False, 'remaining': None}])
+    ledger = Ledger(5)
+    commits = []
+    reservations = make_reservations(client, ledger, commits)
+
+    hold = reservations.reserve('user-1', amount=3)
+    assert reservations.commit(hold, used=2, reason='一括髪型生成') == 3
+    assert ledger.consumed == ['一括髪型生成', '一括髪型生成']
+    assert commits == []
+    assert reservations.stats()['commit_expired'] == 1
+
+
+def test_release_swallows_errors():
+    client = FakeSupabase(reserve_credits=reserved(), release_credit_hold=RuntimeError('connection reset'))
+    reservations = make_reservations(client, Ledger(5))
+
+    hold = reservations.reserve('user-1')
+    reservations.release(hold)
+    assert client.params_of('release_credit_hold') == [{'p_hold_id': 'hold-1'}]
+
+
+def test_local_fallback_without_client_limits_inflight():
+    reservations = make_reservations(None, Ledger(0), max_inflight=2)
+
+    first = reservations.reserve('user-1')
+    second = reservations.reserve('user-1')
+    assert first['local'] and second['local']
+    with pytest.raises(ReservationError) as excinfo:
+        reservations.reserve('user-1')
+    assert excinfo.value.reason == 'too_many_inflight'
+    # 別ユーザーは影響を受けない
+    reservations.release(reservations.reserve('user-2'))
+
+    # 設定なし（ローカル開発）では課金しない
+    assert reservations.commit(first) == 999
+    reservations.release(second)
+    assert reservations.stats()['local_inflight'] == 0
+    reservations.release(reservations.reserve('user-1'))
+
+
+def test_missing_function_falls_back_to_legacy_consume():
+    missing = Exception('Could not find the function public.reserve_credits (PGRST202)')
+    client = FakeSupabase(reserve_credits=missing)
+    ledger = Ledger(2)
+    reservations = make_reservations(client, ledger)
+
+    with pytest.raises(ReservationError) as excinfo:
+        reservations.reserve('user-1', amount=3)
+    assert excinfo.value.reason == 'insufficient_credits'
+    assert excinfo.value.available == 2
+
+    hold = reservations.reserve('user-1', amount=2)
+    assert hold['local']
+    # 一括生成で1件だけ成功
+    assert reservations.commit(hold, used=1) == 1
+    assert ledger.consumed == ['髪型生成']
+    assert reservations.stats()['local_inflight'] == 0
+
+
+def test_other_reserve_errors_propagate():
+    client = FakeSupabase(reserve_credits=RuntimeError('timeout'))
+    reservations = make_reservations(client, Ledger(5))
+
+    with pytest.raises(RuntimeError):
+        reservations.reserve('user-1')
+    assert not credit_holds.is_missing_function_error(RuntimeError('timeout'), 'reserve_credits')
@@ -0,0 +1,124 @@
+"""Gemini 呼び出しの再試行・期限・ヘッジ"""
+
+import time
+import asyncio
+
+import pytest
+
+from backend.gemini_resilience import GeminiDeadlineExceeded, ResilientCaller
+
+
+class ServerError(Exception):
+    code = 503
+
+
+class BadRequest(Exception):
+    code = 400
+
+
+def flaky(failures, error=ServerError):
+    """最初の failures 回は error を投げ、その後は 'ok' を返す fn"""
+    timeouts = []
+
+    def fn(timeout):
+        timeouts.append(timeout)
+        if len(timeouts) <= failures:
+            raise error('failed')
+        return 'ok'
+
+    fn.timeouts = timeouts
+    return fn
+
+
+def test_retries_retryable_errors():
+    caller = ResilientCaller(max_attempts=3, base_delay=0, attempt_timeout=5, deadline=10)
+    fn = flaky(2)
+    assert caller.call(fn) == 'ok'
+    assert len(fn.timeouts) == 3
+    assert caller.counters['retries'] == 2
+    # 1回の期限は attempt_timeout と残り時間の小さい方
+    assert all(timeout <= 5 for timeout in fn.timeouts)
+
+
+def test_gives_up_after_max_attempts():
+    caller = ResilientCaller(max_attempts=2, base_delay=0, deadline=10)
+    fn = flaky(5)
+    with pytest.raises(ServerError):
+        caller.call(fn)
+    assert len(fn.timeouts) == 2
+    assert caller.counters['failures'] == 1
+
+
+def test_does_not_retry_bad_request():
+    caller = ResilientCaller(max_attempts=3, base_delay=0, deadline=10)
+    fn = flaky(1, BadRequest)
+    with pytest.raises(BadRequest):
+        caller.call(fn)
+    assert len(fn.timeouts) == 1
+
+
+def test_attempt_timeout_is_capped_by_deadline():
+    caller = ResilientCaller(max_attempts=3, base_delay=0, attempt_timeout=60, deadline=0.05)
+
+    def slow(timeout):
+        time.sleep(timeout)
+        raise TimeoutError('read timeout')
+
+    started = time.monotonic()
+    with pytest.raises((TimeoutError, GeminiDeadlineExceeded)):
+        caller.call(slow)
+    assert time.monotonic() - started < 1
+    assert caller.counters['timeouts'] >= 1
+
+
+def test_sync_call_never_hedges():
+    # 同期ではヘッジを有効にしても2本目を送らない（スレッドは止められないため）
+    caller = ResilientCaller(max_attempts=1, deadline=5, hedge=True, hedge_delay=0.01)
+    calls = []
+
+    def slow(timeout):
+        calls.append(timeout)
+        time.sleep(0.05)
+        return 'ok'
+
+    assert caller.call(slow) == 'ok'
+    assert len(calls) == 1
+    assert caller.counters['hedges'] == 0
+
+
+def test_async_hedge_wins_and_cancels_primary():
+    caller = ResilientCaller(max_attempts=1, deadline=5, hedge=True, hedge_delay=0.02)
+    started = []
+    cancelled = []
+
+    async def fn(timeout):
+        index = len(started)
+        started.append(timeout)
+        try:
+            # 1本目だけが遅い
+            await asyncio.sleep(2 if index == 0 else 0)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+        return index
+
+    assert asyncio.run(caller.call_async(fn)) == 1
+    assert len(started) == 2
+    assert cancelled == [0]
+    assert caller.counters['hedges'] == 1
+    assert caller.counters['hedge_wins'] == 1
+
+
+def test_async_attempt_timeout_is_retried():
+    caller = ResilientCaller(max_attempts=2, base_delay=0, attempt_timeout=0.02, deadline=5)
+    calls = []
+
+    async def fn(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return 'ok'
+
+    assert asyncio.run(caller.call_async(fn)) == 'ok'
+    assert len(calls) == 2
+    assert caller.counters['timeouts'] == 1
@@ -0,0 +1,116 @@
+"""アップロード画像のデコードと正規化"""
+
+import io
+import base64
+
+import pytest
+from PIL import Image
+
+from backend import image_pipeline
+from backend.image_pipeline import ImageTooLargeError, InvalidImageError
+
+RAW = bytes(range(256)) * 4
+
+
+def encode(raw=RAW):
+    return base64.b64encode(raw).decode('ascii')
+
+
+@pytest.mark.parametrize('data', [
+    encode(),
+    'data:image/jpeg;base64,' + encode(),
+    'data:image/png;base64,' + encode() + '\r\n',
+    encode() + '\n',
+])
+def test_decodes_plain_base64_and_data_urls(data):
+    assert image_pipeline.decode_base64_image(data, len(RAW)) == RAW
+
+
+def test_encoded_size_matches_decoded_length():
+    for length in (1, 2, 3, 1000, 1001, 1002):
+        raw = RAW[:length]
+        assert image_pipeline.encoded_image_size(encode(raw)) == length
+        assert image_pipeline.encoded_image_size('data:image/jpeg;base64,' + encode(raw)) == length
+
+
+def test_rejects_oversized_payload_before_decoding(monkeypatch):
+    def fail(*args):
+        raise AssertionError('decoded an oversized payload')
+
+    monkeypatch.setattr(image_pipeline.binascii, 'a2b_base64', fail)
+    with pytest.raises(ImageTooLargeError):
+        image_pipeline.decode_base64_image(encode(), len(RAW) - 1)
+
+
+def test_decodes_line_wrapped_base64():
+    # 改行入りは文字数からの見積もりが実際より大きくなる（上限内なら通る）
+    wrapped = base64.encodebytes(RAW).decode('ascii')
+    assert image_pipeline.encoded_image_size(wrapped) > len(RAW)
+    assert image_pipeline.decode_base64_image(wrapped, image_pipeline.encoded_image_size(wrapped)) == RAW
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    '',
+    b'aGVsbG8=',
+    ['aGVsbG8='],
+    'data:image/jpeg;base64,aGVsbG8',
+    'aGVsbG8=あ',
+    'data:image/jpeg;base64,éééé',
+])
+def test_rejects_invalid_input(data):
+    with pytest.raises(InvalidImageError):
+        image_pipeline.decode_base64_image(data, 1024)
+
+
+def make_image(fmt, size=(64, 48), quality=95, **save_args):
+    image = Image.new('RGB', size)
+    # 再エンコードで小さくなりにくいノイズ画像
+    image.putdata([((x * 37) % 256, (y * 91) % 256, (x * y) % 256) for y in range(size[1]) for x in range(size[0])])
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=quality, **save_args)
+    return buffer.getvalue()
+
+
+def test_small_compressed_jpeg_is_kept_as_is():
+    raw = make_image('JPEG', quality=30)
+    normalized = image_pipeline.normalize_image(raw, quality=95)
+    assert normalized.data == raw
+    assert normalized.bytes_saved == 0
+    assert (normalized.width, normalized.height) == (64, 48)
+
+
+def test_jpeg_with_metadata_is_reencoded_even_if_larger():
+    exif = Image.Exif()
+    exif[0x010E] = 'taken at home'  # ImageDescription
+    raw = make_image('JPEG', quality=30, exif=exif.tobytes())
+    normalized = image_pipeline.normalize_image(raw, quality=95)
+    assert normalized.data != raw
+    assert b'taken at home' not in normalized.data
+    assert normalized.bytes_saved >= 0
+
+
+def test_large_image_is_shrunk_and_counts_savings():
+    raw = make_image('PNG', size=(800, 600))
+    normalized = image_pipeline.normalize_image(raw, max_edge=200)
+    assert max(normalized.width, normalized.height) == 200
+    assert normalized.data[:2] == b'\xff\xd8'
+    assert normalized.bytes_saved == len(raw) - len(normalized.data) > 0
+
+
+def test_pipeline_stats_never_report_negative_savings():
+    before = image_pipeline.pipeline_stats()['bytes_saved']
+    # 小さな PNG は JPEG にすると大きくなりうる
+    image_pipeline.normalize_image(make_image('PNG', size=(4, 4)), quality=95)
+    assert image_pipeline.pipeline_stats()['bytes_saved'] >= before
+
+
+def test_decompression_bomb_is_too_large(monkeypatch):
+    monkeypatch.setattr(image_pipeline.Image, 'MAX_IMAGE_PIXELS', 100)
+    with pytest.raises(ImageTooLargeError):
+        image_pipeline.normalize_image(make_image('PNG', size=(64, 48)))
+
+
+def test_truncated_image_is_invalid():
+    with pytest.raises(InvalidImageError):
+        image_pipeline.normalize_image(make_image('JPEG', size=(256, 256))[:300])
@@ -0,0 +1,114 @@
+"""生成ジョブキューとジョブの保存先"""
+
+import time
+import threading
+
+import pytest
+
+from backend import jobs
+from backend.jobs import InMemoryJobStore, JobQueue, QueueFullError, SqliteJobStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path, monkeypatch):
+    if request.param == 'memory':
+        return InMemoryJobStore(ttl=60)
+    monkeypatch.setattr(SqliteJobStore, 'POLL_INTERVAL', 0.01)
+    return SqliteJobStore(path=str(tmp_path / 'jobs.sqlite3'), ttl=60)
+
+
+def test_store_create_get_update(store):
+    job = jobs.new_job_record('user-1', 'hairstyle')
+    store.create(job)
+    assert store.get(job['id'])['status'] == jobs.STATUS_QUEUED
+    assert store.get('missing') is None
+
+    store.update(job['id'], status=jobs.STATUS_SUCCEEDED, result={'ok': True}, http_status=200)
+    saved = store.get(job['id'])
+    assert saved['status'] == jobs.STATUS_SUCCEEDED
+    assert saved['result'] == {'ok': True}
+    assert saved['updated_at'] >= job['updated_at']
+
+
+def test_store_wait_returns_on_update(store):
+    job = jobs.new_job_record('user-1', 'hairstyle')
+    store.create(job)
+    timer = threading.Timer(0.05, store.update, (job['id'],), {'status': jobs.STATUS_RUNNING})
+    timer.start()
+    try:
+        updated = store.wait(job['id'], job['updated_at'], 2)
+    finally:
+        timer.join()
+    assert updated['status'] == jobs.STATUS_RUNNING
+
+
+def test_store_wait_times_out_unchanged(store):
+    job = jobs.new_job_record('user-1', 'hairstyle')
+    store.create(job)
+    started = time.time()
+    assert store.wait(job['id'], job['updated_at'], 0.05)['status'] == jobs.STATUS_QUEUED
+    assert time.time() - started < 1
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    # 同じファイルを開いた別のワーカー（インスタンス）からも見える
+    path = str(tmp_path / 'jobs.sqlite3')
+    job = jobs.new_job_record('user-1', 'hairstyle')
+    SqliteJobStore(path=path).create(job)
+    assert SqliteJobStore(path=path).get(job['id'])['id'] == job['id']
+
+
+def test_queue_rejects_beyond_max_pending():
+    queue = JobQueue(InMemoryJobStore(), max_workers=1, max_pending=2)
+    release = threading.Event()
+
+    def blocked():
+        release.wait(5)
+        return {'ok': True}, 200
+
+    first = queue.submit('user-1', 'hairstyle', blocked)
+    queue.submit('user-1', 'hairstyle', blocked)
+    with pytest.raises(QueueFullError):
+        queue.submit('user-1', 'hairstyle', blocked)
+
+    release.set()
+    assert queue.store.wait(first['id'], first['updated_at'], 2)
+    deadline = time.time() + 2
+    while queue.stats()['pending'] and time.time() < deadline:
+        time.sleep(0.01)
+    assert queue.stats()['pending'] == 0
+    assert queue.store.get(first['id'])['status'] == jobs.STATUS_SUCCEEDED
+
+
+def test_failed_job_is_recorded():
+    queue = JobQueue(InMemoryJobStore(), max_workers=1, max_pending=1)
+
+    def failing():
+        raise RuntimeError('boom')
+
+    job = queue.submit('user-1', 'hairstyle', failing)
+    deadline = time.time() + 2
+    while queue.store.get(job['id'])['status'] not in jobs.FINISHED_STATUSES and time.time() < deadline:
+        time.sleep(0.01)
+    saved = queue.store.get(job['id'])
+    assert saved['status'] == jobs.STATUS_FAILED
+    assert saved['http_status'] == 500
+
+
+def test_job_releases_hold_when_settlement_raises(server, monkeypatch):
+    class BrokenCache:
+        def put(self, *args):
+            raise OSError('disk full')
+
+    monkeypatch.setattr(server, 'generation_cache', BrokenCache())
+    hold = server.credit_reservations.reserve('user-1')
+    assert server.credit_reservations.stats()['local_inflight'] == 1
+
+    with pytest.raises(OSError):
+        server.run_hairstyle_generation('user-1', b'jpeg', 'prompt', 'wolf', hold, cache_key='key')
+    assert server.credit_reservations.stats()['local_inflight'] == 0
+    # 同じ予約を再度解放しても他の予約の数は減らない
+    other = server.credit_reservations.reserve('user-1')
+    server.credit_reservations.release(hold)
+    assert server.credit_reservations.stats()['local_inflight'] == 1
+    server.credit_reservations.release(other)
@@ -0,0 +1,71 @@
+"""プリセット定義（presets.json）からのプロンプト解決"""
+
+import pytest
+
+from backend import preset_registry
+from backend.preset_registry import UnknownPresetError
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    return preset_registry.load()
+
+
+def test_prompt_for_combines_preset_and_color(catalog):
+    plain = catalog.prompt_for('mens', 'wolf')
+    colored = catalog.prompt_for('mens', 'wolf', 'ash')
+    assert 'ウルフカット' in plain.prompt
+    assert 'ash gray hair color' in colored.prompt
+    assert colored.label == 'ウルフ (アッシュ)'
+    # 「なし」は指定なしと同じプロンプト
+    assert catalog.prompt_for('mens', 'wolf', 'none') is plain
+    assert catalog.prompt_for('mens', 'wolf', '') is plain
+
+
+@pytest.mark.parametrize('gender, preset_id, color_id', [
+    ('mens', 'unknown', None),
+    ('mens', 'wolf', 'unknown'),
+    ('others', 'wolf', None),
+    # JSON の配列・オブジェクト・数値は辞書を引く前に登録外として扱う
+    (['mens'], 'wolf', None),
+    ('mens', ['wolf'], None),
+    ('mens', {'id': 'wolf'}, None),
+    ('mens', 'wolf', ['ash']),
+    ('mens', 'wolf', 3),
+])
+def test_prompt_for_rejects_unknown_and_non_string(catalog, gender, preset_id, color_id):
+    with pytest.raises(UnknownPresetError):
+        catalog.prompt_for(gender, preset_id, color_id)
+
+
+def test_adjust_prompts_resolves_ids(catalog):
+    assert catalog.adjust_prompts('shorter', 'ash') == ['make the hair shorter', 'ash gray hair color']
+    assert catalog.adjust_prompts(None, 'blonde') == ['blonde hair color']
+    assert catalog.adjust_prompts('same', 'none') == []
+    assert catalog.adjust_prompts() == []
+
+
+@pytest.mark.parametrize('length_id, color_id', [
+    ('much-shorter', None),
+    (None, 'green'),
+    (['shorter'], None),
+    (None, {'id': 'ash'}),
+])
+def test_adjust_prompts_rejects_unknown_and_non_string(catalog, length_id, color_id):
+    with pytest.raises(UnknownPresetError):
+        catalog.adjust_prompts(length_id, color_id)
+
+
+def test_legacy_adjust_text_maps_to_ids(catalog):
+    assert catalog.legacy_adjust_id('length', 'make the hair shorter') == 'shorter'
+    assert catalog.legacy_adjust_id('color', 'jet black hair color') == 'black'
+    assert catalog.legacy_adjust_id('color', '') is None
+    with pytest.raises(UnknownPresetError):
+        catalog.legacy_adjust_id('color', 'neon hair')
+
+
+def test_public_view_has_no_prompts(catalog):
+    body = catalog.public_body.decode('utf-8')
+    assert 'make the hair shorter' not in body
+    assert 'ash gray hair color' not in body
+    assert '"lengths"' in body
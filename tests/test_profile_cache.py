@@ -0,0 +1,84 @@
+"""プロフィールキャッシュ（TTL・バージョンによる無効化・書き通し）"""
+
+import pytest
+
+from backend import profile_cache
+from backend.profile_cache import LocalVersions, ProfileCache, SqliteVersions
+
+
+@pytest.fixture(params=['local', 'sqlite'])
+def versions(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteVersions(str(tmp_path / 'versions.sqlite3'))
+    return LocalVersions()
+
+
+def fill(cache, user_id, profile):
+    version = cache.begin_fill(user_id)
+    cache.put(user_id, profile, version)
+
+
+def test_hit_until_ttl(monkeypatch):
+    now = [1_000.0]
+    monkeypatch.setattr(profile_cache.time, 'time', lambda: now[0])
+    cache = ProfileCache(ttl=30)
+    fill(cache, 'user-1', {'credits': 5})
+
+    profile = cache.get('user-1')
+    assert profile == {'credits': 5}
+    # 返した dict を書き換えてもキャッシュは変わらない
+    profile['credits'] = 0
+    assert cache.get('user-1') == {'credits': 5}
+
+    now[0] += 31
+    assert cache.get('user-1') is None
+
+
+def test_write_from_another_worker_invalidates(versions):
+    # 同じバージョン保存先を共有する2つのワーカー
+    mine, other = ProfileCache(versions), ProfileCache(versions)
+    fill(mine, 'user-1', {'credits': 5})
+    assert mine.get('user-1') == {'credits': 5}
+
+    other.write_through('user-1', increments={'credits': -1})
+    assert mine.get('user-1') is None
+    assert mine.stats()['stale'] == 1
+
+
+def test_write_during_fill_is_not_cached(versions):
+    cache = ProfileCache(versions)
+    version = cache.begin_fill('user-1')
+    # DB から読んでいる間に別のワーカーが書き込んだ
+    ProfileCache(versions).write_through('user-1')
+    cache.put('user-1', {'credits': 5}, version)
+    assert cache.get('user-1') is None
+
+
+def test_write_through_updates_cached_profile(versions):
+    cache = ProfileCache(versions)
+    fill(cache, 'user-1', {'credits': 5, 'plan': 'free', 'total_generations': 2})
+
+    cache.write_through('user-1', fields={'plan': 'pro'}, increments={'credits': -1, 'total_generations': 1})
+    assert cache.get('user-1') == {'credits': 4, 'plan': 'pro', 'total_generations': 3}
+    assert cache.stats()['hits'] == 1
+
+
+def test_write_through_drops_entry_after_concurrent_write(versions):
+    cache = ProfileCache(versions)
+    fill(cache, 'user-1', {'credits': 5})
+
+    # 他のワーカーの書き込みを反映していない値に自分の差分を足して残さない
+    ProfileCache(versions).write_through('user-1', increments={'credits': -1})
+    cache.write_through('user-1', increments={'credits': -1})
+    assert cache.get('user-1') is None
+
+
+def test_invalidate_and_lru_limit():
+    cache = ProfileCache(max_entries=2)
+    for user_id in ('user-1', 'user-2', 'user-3'):
+        fill(cache, user_id, {'credits': 1})
+    assert cache.get('user-1') is None
+    assert cache.get('user-3') == {'credits': 1}
+
+    cache.invalidate('user-3')
+    assert cache.get('user-3') is None
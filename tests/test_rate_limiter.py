@@ -0,0 +1,109 @@
+"""レート制限のスライディングウィンドウ"""
+
+import pytest
+
+from backend import rate_limiter
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1_000_040.0)  # 60秒ウィンドウの開始から20秒後
+    monkeypatch.setattr(rate_limiter.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request, tmp_path):
+    if request.param == 'sqlite':
+        return rate_limiter.SqliteRateLimiter(str(tmp_path / 'ratelimit.sqlite3'))
+    return rate_limiter.MemoryRateLimiter()
+
+
+def test_sliding_window_weights_previous_window():
+    assert rate_limiter.sliding_window_count(10, 2, 15, 60) == 10 * 0.75 + 2
+    assert rate_limiter.sliding_window_count(10, 2, 60, 60) == 2
+
+
+def test_limit_within_window(limiter, clock):
+    assert [limiter.hit('ip:a', 3, 60)[0] for _ in range(4)] == [True, True, True, False]
+    allowed, retry_after = limiter.hit('ip:a', 3, 60)
+    assert not allowed
+    assert retry_after == 40
+    # キーごとに数える
+    assert limiter.hit('ip:b', 3, 60) == (True, 0)
+
+
+def test_previous_window_counts_until_it_slides_out(limiter, clock):
+    for _ in range(4):
+        assert limiter.hit('ip:a', 4, 60)[0]
+
+    # 次のウィンドウの 15 秒目: 直前の4件が 3 件分として残る
+    clock.now = 1_000_095.0
+    assert limiter.hit('ip:a', 4, 60) == (True, 0)
+    allowed, retry_after = limiter.hit('ip:a', 4, 60)
+    assert not allowed and retry_after >= 1
+
+    # 2ウィンドウ以上空けばリセット
+    clock.now = 1_000_240.0
+    assert [limiter.hit('ip:a', 4, 60)[0] for _ in range(5)] == [True, True, True, True, False]
+
+
+def test_memory_limiter_prunes_idle_slot_keys(clock):
+    limiter = rate_limiter.MemoryRateLimiter()
+    token = limiter.acquire_slot('batch:a', 1, 30)
+    limiter.release_slot('batch:a', token)
+    assert limiter.stats()['slot_keys'] == 0
+
+    # 上限 0 で断ってもキーを残さない
+    assert limiter.acquire_slot('batch:b', 0, 30) is None
+    assert limiter.stats()['slot_keys'] == 0
+
+    # 解放されないまま期限が切れた枠は、他のキーへのアクセスで掃除される
+    assert limiter.acquire_slot('batch:c', 1, 30)
+    clock.now += 31
+    limiter.hit('ip:a', 10, 60)
+    assert limiter.stats()['slot_keys'] == 0
+
+
+def test_cost_counts_several_hits(limiter, clock):
+    assert limiter.hit('user:a', 10, 60, cost=4) == (True, 0)
+    assert limiter.hit('user:a', 10, 60, cost=4) == (True, 0)
+    allowed, _ = limiter.hit('user:a', 10, 60, cost=4)
+    assert not allowed
+    # 断った分は数えない
+    assert limiter.hit('user:a', 10, 60, cost=2) == (True, 0)
+    assert not limiter.hit('user:a', 10, 60)[0]
+
+
+def test_retry_after_with_cost():
+    assert rate_limiter.retry_after_seconds(0, 10, 20, 60, 10) == 40
+    # 直前ウィンドウの 8 件が減るのを待つ
+    assert rate_limiter.retry_after_seconds(8, 0, 0, 60, 10, cost=4) == 8
+
+
+def test_slots_cap_and_release(limiter, clock):
+    first = limiter.acquire_slot('batch:a', 2, 30)
+    second = limiter.acquire_slot('batch:a', 2, 30)
+    assert first and second and first != second
+    assert limiter.acquire_slot('batch:a', 2, 30) is None
+    assert limiter.acquire_slot('batch:b', 2, 30)
+
+    limiter.release_slot('batch:a', first)
+    assert limiter.acquire_slot('batch:a', 2, 30)
+
+
+def test_slots_expire(limiter, clock):
+    assert limiter.acquire_slot('batch:a', 1, 30)
+    assert limiter.acquire_slot('batch:a', 1, 30) is None
+
+    # 解放されなかった枠も期限が過ぎれば空く
+    clock.now += 31
+    assert limiter.acquire_slot('batch:a', 1, 30)
@@ -0,0 +1,117 @@
+"""生成結果キャッシュ（メモリ LRU とディスク層）"""
+
+import os
+
+import pytest
+
+from backend import result_cache
+from backend.result_cache import ResultCache
+
+
+def key(n):
+    return f'{n:02x}' * 32
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(result_cache.time, 'time', lambda: now[0])
+    return now
+
+
+def make_cache(tmp_path=None, **kwargs):
+    # 背景の掃除はテストから明示的に呼ぶ
+    kwargs.setdefault('sweep_interval', 10 ** 12)
+    return ResultCache(disk_dir=str(tmp_path) if tmp_path else '', **kwargs)
+
+
+def test_memory_hit_and_lru_eviction_by_bytes():
+    cache = make_cache(max_bytes=10)
+    cache.put(key(1), b'aaaa', 'one')
+    cache.put(key(2), b'bbbb')
+    assert cache.get(key(1)) == (b'aaaa', 'one')
+
+    # key(2) が最も古いので追い出される
+    cache.put(key(3), b'cccc')
+    assert cache.get(key(2)) is None
+    assert cache.get(key(1)) and cache.get(key(3))
+    stats = cache.stats()
+    assert stats['bytes'] == 8 and stats['evictions'] == 1 and stats['misses'] == 1
+
+    # 上限より大きいものは置かない
+    cache.put(key(4), b'x' * 11)
+    assert cache.get(key(4)) is None
+
+
+def test_memory_entry_expires(clock):
+    cache = make_cache(ttl=60)
+    cache.put(key(1), b'image')
+    clock[0] += 61
+    assert cache.get(key(1)) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    make_cache(tmp_path).put(key(1), b'image', 'text')
+
+    # 別のワーカー（メモリは空）でもディスクから返し、メモリに載せる
+    cache = make_cache(tmp_path)
+    assert cache.get(key(1)) == (b'image', 'text')
+    assert cache.get(key(1)) == (b'image', 'text')
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['disk_hits'] == 1 and stats['entries'] == 1
+
+
+def test_expired_disk_entry_is_removed_on_read(tmp_path, clock):
+    make_cache(tmp_path, ttl=60).put(key(1), b'image')
+    clock[0] += 61
+    cache = make_cache(tmp_path, ttl=60)
+    assert cache.get(key(1)) is None
+    assert os.listdir(tmp_path / key(1)[:2]) == []
+
+
+def test_sweep_removes_expired_and_evicts_least_recently_used(tmp_path, clock):
+    cache = make_cache(tmp_path, ttl=60, disk_max_bytes=10 ** 9)
+    cache.put(key(1), b'a' * 100)
+    cache.put(key(2), b'b' * 100)
+    clock[0] += 30
+    cache.put(key(3), b'c' * 100)
+
+    def data_path(n):
+        return cache._disk_paths(key(n))[0]
+
+    # key(1) が最近読まれ、key(2) が最も古いアクセス
+    os.utime(data_path(2), (1, 1))
+    os.utime(data_path(1), (3, 3))
+    os.utime(data_path(3), (2, 2))
+    entry_size = os.path.getsize(data_path(3)) + os.path.getsize(cache._disk_paths(key(3))[1])
+
+    cache.disk_max_bytes = 2 * entry_size
+    assert cache.sweep_disk() == (0, 1)
+    assert not os.path.exists(data_path(2))
+    assert os.path.exists(data_path(1)) and os.path.exists(data_path(3))
+
+    # key(1) は期限切れ、key(3) はまだ有効
+    clock[0] += 40
+    assert cache.sweep_disk() == (1, 0)
+    assert not os.path.exists(data_path(1))
+    assert cache.stats()['disk_bytes'] == entry_size
+
+
+def test_sweep_removes_stale_temp_files(tmp_path, clock):
+    cache = make_cache(tmp_path, ttl=60)
+    cache.put(key(1), b'image')
+    shard = tmp_path / key(1)[:2]
+    stale = shard / '.tmp-crashed'
+    orphan = shard / f'{key(9)}.bin'
+    for path in (stale, orphan):
+        path.write_bytes(b'partial')
+        os.utime(path, (clock[0] - 120, clock[0] - 120))
+    fresh = shard / '.tmp-writing'
+    fresh.write_bytes(b'partial')
+    os.utime(fresh, (clock[0], clock[0]))
+
+    cache.sweep_disk()
+    assert not stale.exists() and not orphan.exists()
+    assert fresh.exists()
+    assert cache.get(key(1)) == (b'image', '')
@@ -0,0 +1,126 @@
+"""Gemini 同時実行ガバナーの受け付け・待ち・取り消し"""
+
+import asyncio
+import threading
+
+import pytest
+
+from backend.upstream_governor import UpstreamGovernor, UpstreamOverloaded
+
+
+class OverloadError(Exception):
+    code = 429
+
+
+def test_admits_up_to_limit_then_sheds():
+    governor = UpstreamGovernor(max_limit=2, min_limit=1, max_queue=0, queue_timeout=1)
+    first = governor.acquire()
+    second = governor.acquire()
+
+    with pytest.raises(UpstreamOverloaded) as excinfo:
+        governor.acquire()
+    assert excinfo.value.retry_after >= 1
+    assert governor.stats()['shed'] == 1
+
+    first.cancel()
+    governor.acquire().cancel()
+    second.cancel()
+    assert governor.stats()['in_flight'] == 0
+
+
+def test_finish_hands_slot_to_waiter():
+    governor = UpstreamGovernor(max_limit=1, min_limit=1, max_queue=4, queue_timeout=60)
+    permit = governor.acquire()
+    permit.start()
+
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(governor.acquire()))
+    waiter.start()
+    while governor.stats()['waiting'] == 0:
+        pass
+
+    permit.finish()
+    waiter.join(5)
+    assert len(acquired) == 1
+    assert governor.stats()['in_flight'] == 1
+    acquired[0].cancel()
+    assert governor.stats()['in_flight'] == 0
+
+
+def test_wait_timeout_abandons_queue():
+    # 見込み待ち時間（latency_threshold / 2）が短いので、断らずに待ち行列へ入る
+    governor = UpstreamGovernor(max_limit=1, min_limit=1, max_queue=4, queue_timeout=60, latency_threshold=0.01)
+    permit = governor.acquire()
+
+    with pytest.raises(UpstreamOverloaded):
+        governor.acquire(timeout=0.05)
+    stats = governor.stats()
+    assert stats['timeouts'] == 1
+    assert stats['waiting'] == 0
+    permit.cancel()
+    assert governor.stats()['in_flight'] == 0
+
+
+def test_permit_finishes_once():
+    governor = UpstreamGovernor(max_limit=2, min_limit=1)
+    permit = governor.acquire()
+    permit.start()
+    permit.finish()
+    permit.finish()
+    permit.cancel()
+    assert governor.stats()['in_flight'] == 0
+
+
+def test_overload_decreases_limit_and_success_recovers():
+    governor = UpstreamGovernor(max_limit=10, min_limit=2, latency_threshold=30)
+    permit = governor.acquire()
+    permit.start()
+    permit.finish(OverloadError('RESOURCE_EXHAUSTED'))
+    assert governor.stats()['limit'] == 7
+    assert governor.stats()['overloaded'] == 1
+
+    for _ in range(10):
+        permit = governor.acquire()
+        permit.start()
+        permit.finish()
+    assert 7 < governor.stats()['limit'] <= 10
+
+
+def test_cancelled_async_waiter_is_withdrawn():
+    governor = UpstreamGovernor(max_limit=1, min_limit=1, max_queue=4, queue_timeout=60)
+
+    async def scenario():
+        permit = governor.acquire()
+        task = asyncio.ensure_future(governor.acquire_async())
+        await asyncio.sleep(0.01)
+        assert governor.stats()['waiting'] == 1
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert governor.stats()['waiting'] == 0
+
+        # 取り消した待ちに枠を渡さず、次の呼び出しがすぐ入れる
+        permit.cancel()
+        assert governor.stats()['in_flight'] == 0
+        (await governor.acquire_async()).cancel()
+
+    asyncio.run(scenario())
+
+
+def test_cancel_after_grant_returns_slot():
+    governor = UpstreamGovernor(max_limit=1, min_limit=1, max_queue=4, queue_timeout=60)
+
+    async def scenario():
+        permit = governor.acquire()
+        task = asyncio.ensure_future(governor.acquire_async())
+        await asyncio.sleep(0.01)
+
+        # 枠が渡された直後（まだ再開していない）に取り消される
+        permit.cancel()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert governor.stats()['in_flight'] == 0
+
+    asyncio.run(scenario())